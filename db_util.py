@@ -1,51 +1,108 @@
+from datetime import datetime
 from json import loads
 from os import listdir
-from typing import List
+from os.path import exists
+from time import monotonic
+from typing import Iterator, List, Optional, Tuple
 
 from psycopg2 import connect
 
-from flask_recon import DatabaseHandler, IncomingRequest, RequestMethod
+from flask_recon import DatabaseHandler
+from flask_recon.classify import rescore_all
+from flask_recon.export import batched
+from flask_recon.geoip import GeoIndex, compile_index
+from flask_recon.structures import classify_rows
 
 
-def get_all_requests(dbname: str, user: str, password: str, host: str, port: str) -> List[IncomingRequest]:
+def stream_source_requests(dbname: str, user: str, password: str, host: str, port: str,
+                           batch_size: int = 50_000) -> Iterator[Tuple]:
     """
-    request_id | actor_id | timestamp | method | path | body | headers | query_string | port | acceptable
-    :param dbname:
-    :param user:
-    :param password:
-    :param host:
-    :param port:
-    :return:
+    Yields (host, timestamp, method, path, body, headers, query_string, port, acceptable) rows in request_id order from
+    a named cursor on the source database, with body and headers as JSON text whether stored as TEXT or JSONB.
     """
+    connection = connect(dbname=dbname, user=user, password=password, host=host, port=port)
+    try:
+        with connection.cursor(name="migrate_requests") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute("SELECT a.host, r.timestamp, r.method, r.path, r.body::text, r.headers::text, "
+                           "r.query_string, r.port, r.acceptable "
+                           "FROM requests r JOIN actors a ON a.actor_id = r.actor_id ORDER BY r.request_id")
+            yield from cursor
+    finally:
+        connection.close()
+
+
+def get_source_hosts(dbname: str, user: str, password: str, host: str, port: str) -> List[str]:
+    connection = connect(dbname=dbname, user=user, password=password, host=host, port=port)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT host FROM actors")
+            return [row[0] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+def get_source_first_timestamp(dbname: str, user: str, password: str, host: str, port: str) -> Optional[datetime]:
+    connection = connect(dbname=dbname, user=user, password=password, host=host, port=port)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(timestamp) FROM requests")
+            return cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+
+def migrate_new_data(batch_size: int = 50_000, rescore: bool = True):
+    """
+    Copies every request from the old database into the new one, batch_size rows per COPY. Actors are resolved in one
+    bulk pass up front, and the monthly partitions covering the source's requests are created before any are copied,
+    so that they do not all land in requests_default. With rescore, requests are classified in the same pass;
+    otherwise they are left unclassified for the Reclassifier.
+    """
+    source = {"dbname": "temp_flask_recon", "user": "postgres", "password": "postgres", "host": "localhost",
+              "port": "5432"}
+    new_db = DatabaseHandler(
+        dbname="new_flask_recon",
+        user="postgres",
+        password="postgres",
+        host="localhost",
+        port="5432"
+    )
+
+    actor_ids = new_db.resolve_actor_ids(get_source_hosts(**source))
+    print(f"Resolved {len(actor_ids)} actors")
+
+    if created := new_db.create_request_partitions(since=get_source_first_timestamp(**source)):
+        print(f"Created request partitions {', '.join(created)}")
+
+    done, started = 0, monotonic()
+    for batch in batched(stream_source_requests(**source, batch_size=batch_size), batch_size):
+        rows = [(actor_ids[row[0]], *row[1:]) for row in batch]
+        classified = None
+        if rescore:
+            classified = classify_rows([(index, method, path, query_string, headers and loads(headers),
+                                         body and loads(body), request_port)
+                                        for index, (_, _, method, path, body, headers, query_string, request_port, _)
+                                        in enumerate(rows)])
+        new_db.copy_requests(rows, classified)
+        done += len(rows)
+        print(f"Migrated {done} requests ({done / (monotonic() - started):.0f}/s)")
 
-    connection = connect(
-        dbname=dbname,
-        user=user,
-        password=password,
-        host=host,
-        port=port
+
+def update_threat_levels():
+    new_db = DatabaseHandler(
+        dbname="new_flask_recon",
+        user="postgres",
+        password="postgres",
+        host="localhost",
+        port="5432"
     )
-    cursor = connection.cursor()
-    cursor.execute("SELECT * FROM requests")
-    rows = cursor.fetchall()
-    for row in rows:
-        cursor.execute("SELECT host FROM actors WHERE actor_id = %s", (row[1],))
-        host = cursor.fetchone()[0]
-        yield IncomingRequest(row[8]).from_components(
-            host=host,
-            request_method=RequestMethod[row[3]],
-            request_headers=loads(row[6]),
-            request_uri=row[4],
-            query_string=row[7],
-            request_body=loads(row[5]),
-            timestamp=row[2]
-        )
-
-
-def migrate_new_data():
-    requests = get_all_requests(dbname="temp_flask_recon", user="postgres", password="postgres", host="localhost",
-                                port="5432")
 
+    # resumes from the last checkpoint if a previous run was interrupted
+    rescore_all(new_db)
+
+
+def backfill_endpoint_stats():
     new_db = DatabaseHandler(
         dbname="new_flask_recon",
         user="postgres",
@@ -54,11 +111,16 @@ def migrate_new_data():
         port="5432"
     )
 
-    for request in requests:
-        new_db.insert_request(request)
+    new_db.backfill_endpoint_stats()
 
 
-def update_threat_levels():
+def enrich_actors(sources: Tuple[str, ...] = ("static/geoip.mmdb", "static/geoip.csv")):
+    """Looks up the country and autonomous system of existing actors in the first GeoIP dataset in sources found."""
+    source = next((path for path in sources if exists(path)), None)
+    if source is None:
+        print(f"No GeoIP dataset at {' or '.join(sources)}")
+        return
+
     new_db = DatabaseHandler(
         dbname="new_flask_recon",
         user="postgres",
@@ -67,10 +129,8 @@ def update_threat_levels():
         port="5432"
     )
 
-    requests = new_db.get_requests()
-    for request in requests:
-        request.determine_threat_level()
-        new_db.update_request_threat_level(request_id=request.request_id, threat_level=request.threat_level)
+    new_db.set_geo_index(GeoIndex(compile_index(source)))
+    print(f"Located {new_db.enrich_actors()} actors")
 
 
 def add_honeypots():
@@ -1,14 +1,78 @@
-from os.path import isdir
+from os.path import exists, isdir
 from sys import argv
+from typing import Optional, TYPE_CHECKING
 
 from flask import Flask
 
-from flask_recon import Listener, download_templates, add_routes
+from flask_recon import DatabaseHandler, Listener, download_templates, add_routes
+from flask_recon.geoip import compile_index
+
+if TYPE_CHECKING:
+    from flask_recon.writer import RequestWriter
+
+DATABASE_CONFIG = {
+    "dbname": "new_flask_recon",
+    "user": "postgres",
+    "password": "postgres",
+    "host": "localhost",
+    "port": "5432"
+}
+GEOIP_SOURCES = ("static/geoip.mmdb", "static/geoip.csv")
+
+
+def geoip_source() -> Optional[str]:
+    return next((path for path in GEOIP_SOURCES if exists(path)), None) if "geoip" in argv else None
+
+
+def create_listener(port: int, writer: Optional["RequestWriter"] = None) -> Listener:
+    listener = Listener(
+        flask=Flask(__name__, template_folder="templates"),
+        halt_scanner_threads="halt" in argv,
+        max_halt_messages=100_000,
+        port=port
+    )
+    if writer is not None:
+        # the writer process does the writing and the background jobs, this process only needs reads
+        listener.connect_database(**DATABASE_CONFIG, min_connections=0, max_connections=2,
+                                  background_jobs=False)
+        listener.enable_writer(writer)
+    else:
+        listener.connect_database(**DATABASE_CONFIG)
+        if "spool" in argv:
+            listener.enable_spool()
+        if geoip_source() is not None:
+            listener.enable_geoip(geoip_source())
+    if "halt" in argv:
+        listener.enable_tarpit()
+    if "rates" in argv:
+        listener.enable_rate_tracking()
+    if "async" in argv:
+        listener.enable_async_ingestion()
+    if "capture" in argv:
+        listener.enable_capture()
+    add_routes(
+        listener=listener,
+        run_api="api" in argv,
+        run_webapp="webapp" in argv
+    )
+    return listener
+
 
 if __name__ == '__main__':
-    if not 3 <= len(argv) <= 7:
+    workers = None
+    if "--workers" in argv:
+        index = argv.index("--workers")
+        try:
+            workers = int(argv[index + 1])
+        except (IndexError, ValueError):
+            print("Workers must be an integer.")
+            exit(1)
+        del argv[index:index + 2]
+
+    if not 3 <= len(argv) <= 13:
         print("Usage: python main.py <port> <host> [Optional[api]] [Optional[webapp]] [Optional[halt]] [Optional[ssl]] "
-              "[Optional[gen_admin_key]]")
+              "[Optional[gen_admin_key]] [Optional[async]] [Optional[capture]] [Optional[spool]] [Optional[rates]] "
+              "[Optional[geoip]] [Optional[writer]] [Optional[--workers N]]")
         exit(1)
     port = argv[1]
     if "webapp" in argv and not isdir("flask_recon/templates"):
@@ -24,28 +88,34 @@ if __name__ == '__main__':
         print("Port must be an integer.")
         exit(1)
 
-    listener = Listener(
-        flask=Flask(__name__, template_folder="templates"),
-        halt_scanner_threads="halt" in argv,
-        max_halt_messages=100_000,
-        port=port
-    )
-    listener.connect_database(
-        dbname="new_flask_recon",
-        user="postgres",
-        password="postgres",
-        host="localhost",
-        port="5432"
-    )
-    add_routes(
-        listener=listener,
-        run_api="api" in argv,
-        run_webapp="webapp" in argv
-    )
+    if "geoip" in argv and geoip_source() is None:
+        print(f"geoip needs a dataset at {' or '.join(GEOIP_SOURCES)}.")
+        exit(1)
+
+    ssl_context = ("cert.pem", "key.pem",) if "ssl" in argv else None
+    if workers is not None:
+        # imported here because os.fork, SIGHUP and AF_UNIX do not exist on Windows
+        from flask_recon.prefork import PreforkServer
+        from flask_recon.writer import RequestWriter
+
+        if "gen_admin_key" in argv:
+            # the parent keeps no connections open, so that none are shared with the workers it forks
+            database_handler = DatabaseHandler(**DATABASE_CONFIG)
+            print("Admin Registration Key: ", database_handler.generate_admin_key())
+            database_handler.close()
+        if geoip_source() is not None:
+            # compiled once here rather than by every worker at the same time
+            compile_index(geoip_source())
+        writer = RequestWriter(DATABASE_CONFIG, geoip_source=geoip_source()) if "writer" in argv else None
+        PreforkServer(lambda: create_listener(port, writer), argv[2], port, workers, ssl_context=ssl_context,
+                      writer=writer).run()
+        exit(0)
+
+    listener = create_listener(port)
     if "gen_admin_key" in argv:
         print("Admin Registration Key: ", listener.database_handler.generate_admin_key())
 
-    if "ssl" in argv:
-        listener.run(host=argv[2], port=port, ssl_context=("cert.pem", "key.pem",))
+    if ssl_context is not None:
+        listener.run(host=argv[2], port=port, ssl_context=ssl_context)
     else:
         listener.run(host=argv[2], port=port)
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+
+
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entry and counts hits and misses."""
+    _capacity: int
+    _entries: OrderedDict
+    _lock: Lock
+    _hits: int
+    _misses: int
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("Cache capacity must be at least 1.")
+        self._capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if (value := self._entries.get(key)) is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "capacity": self._capacity,
+            "hits": self._hits,
+            "misses": self._misses
+        }
+
+
+class HoneypotCache:
+    """In-memory copy of the honeypots table, with contents pre-encoded and their lengths precomputed."""
+    _honeypots: Dict[str, Tuple[bytes, int]]
+    _version: int
+
+    def __init__(self):
+        self._honeypots = {}
+        self._version = 0
+
+    def load(self, honeypots: Iterable[Tuple[str, str]]) -> None:
+        loaded = {}
+        for file_name, contents in honeypots:
+            encoded = contents.encode()
+            loaded[file_name] = (encoded, len(encoded))
+        # swapping the whole map keeps concurrent lookups consistent without a lock
+        self._honeypots = loaded
+        self._version += 1
+
+    def get(self, file_name: str) -> Optional[Tuple[bytes, int]]:
+        return self._honeypots.get(file_name)
+
+    def __len__(self) -> int:
+        return len(self._honeypots)
+
+    @property
+    def version(self) -> int:
+        return self._version
@@ -0,0 +1,115 @@
+from datetime import datetime
+from io import BytesIO
+from re import compile
+from typing import Any, Dict, Optional, Tuple
+
+from werkzeug import Request
+
+from flask_recon.structures import IncomingRequest, RequestMethod
+
+CLOUDFLARE_HEADERS = ("X-Forwarded-For", "Cf-Ray", "Cf-Connecting-Ip")
+CLOUDFLARE_ENVIRON_KEYS = tuple((header, "HTTP_" + header.upper().replace("-", "_")) for header in CLOUDFLARE_HEADERS)
+IP_REGEX = compile(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
+# environ keys that carry request headers without the HTTP_ prefix
+CONTENT_KEYS = ("CONTENT_TYPE", "CONTENT_LENGTH")
+
+
+def resolve_remote_address(headers: Dict[str, str], remote_address: str) -> str:
+    """The connecting client's address, taken from the Cloudflare headers when the request came through Cloudflare."""
+    if not all(header in headers for header in CLOUDFLARE_HEADERS):
+        return remote_address
+    connecting_ip = headers["Cf-Connecting-Ip"]
+    forwarded_for = headers["X-Forwarded-For"]
+    source = connecting_ip if connecting_ip != forwarded_for else forwarded_for
+    return source if IP_REGEX.match(source) else remote_address
+
+
+def resolve_environ_address(environ: Dict[str, Any]) -> str:
+    """resolve_remote_address for a WSGI environ, reading only the Cloudflare headers from it."""
+    headers = {header: environ[key] for header, key in CLOUDFLARE_ENVIRON_KEYS if key in environ}
+    return resolve_remote_address(headers, environ.get("REMOTE_ADDR"))
+
+
+def unpack_request(req: Request) -> Tuple[Dict[str, str], str, str, str, str, Dict[str, str]]:
+    args = req.args.to_dict()
+    query_string = "&".join([f"{k}={v}" for k, v in args.items()])
+    if 'Content-Type' in req.headers and req.headers['Content-Type'] == 'application/json':
+        body = dict(req.json)
+    else:
+        body = {}
+    return dict(req.headers), req.method, req.remote_addr, req.path, query_string, body
+
+
+class CapturedRequest:
+    """
+    The raw pieces of a request as they arrived in the WSGI environ: header items, method, path, query string and the
+    body bytes read from its input stream. Recording one copies no more than that, so the response can go out straight
+    away; parse turns it into an IncomingRequest later, off the request thread.
+    """
+    __slots__ = ("_local_port", "_environ_headers", "_method", "_path", "_query_string", "_remote_address", "_body",
+                 "_timestamp")
+    _local_port: int
+    _environ_headers: Tuple[Tuple[str, Any], ...]
+    _method: str
+    _path: str
+    _query_string: str
+    _remote_address: Optional[str]
+    _body: bytes
+    _timestamp: datetime
+
+    def __init__(self, local_port: int, environ: Dict[str, Any], body: bytes):
+        self._local_port = local_port
+        self._environ_headers = tuple(
+            (key, value) for key, value in environ.items() if key.startswith("HTTP_") or key in CONTENT_KEYS
+        )
+        self._method = environ.get("REQUEST_METHOD", "GET")
+        self._path = environ.get("PATH_INFO", "")
+        self._query_string = environ.get("QUERY_STRING", "")
+        self._remote_address = environ.get("REMOTE_ADDR")
+        self._body = body
+        self._timestamp = datetime.now()
+
+    def environ(self) -> Dict[str, Any]:
+        """A minimal WSGI environ holding the captured pieces, from which Werkzeug parses the request as Flask would."""
+        environ = dict(self._environ_headers)
+        environ.update({
+            "REQUEST_METHOD": self._method,
+            "PATH_INFO": self._path,
+            "QUERY_STRING": self._query_string,
+            "REMOTE_ADDR": self._remote_address,
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": str(self._local_port),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": BytesIO(self._body),
+            # the body is already complete, and may have been cut short of the Content-Length it was sent with
+            "wsgi.input_terminated": True,
+        })
+        return environ
+
+    def parse(self) -> IncomingRequest:
+        headers, method, remote_address, uri, query_string, body = unpack_request(Request(self.environ()))
+        return IncomingRequest(self._local_port).from_components(
+            host=resolve_remote_address(headers, remote_address),
+            request_method=RequestMethod.from_str(method),
+            request_headers=headers,
+            request_uri=uri,
+            query_string=query_string,
+            request_body=body,
+            timestamp=self._timestamp,
+        )
+
+    @property
+    def method(self) -> str:
+        return self._method
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def is_acceptable(self) -> bool:
+        return self._method == "GET" and self._path in ["/", "/robots.txt"]
+
+    @property
+    def timestamp(self) -> datetime:
+        return self._timestamp
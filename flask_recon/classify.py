@@ -0,0 +1,146 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from os.path import getmtime
+from threading import Thread, Event
+from time import monotonic
+from typing import Optional
+
+from flask_recon.database import DatabaseHandler
+from flask_recon.export import batched
+from flask_recon.flags import KnownFlags, KNOWN_FLAGS, diff_flag_sets
+from flask_recon.structures import classify_rows
+
+try:
+    from flask_recon.scoring import score_rows
+except ImportError:  # numpy is optional, without it requests are scored one at a time
+    score_rows = classify_rows
+
+
+class Reclassifier:
+    """
+    Keeps stored request classifications in step with the flags file. The file is reloaded when it changes, and only
+    requests that matched a changed flag, may match an added one, or were never classified are rescored, in batches
+    from a background thread.
+    """
+    _database_handler: DatabaseHandler
+    _known_flags: KnownFlags
+    _poll_interval: float
+    _batch_size: int
+    _loaded_mtime: float
+    _worker: Thread
+    _stopping: Event
+
+    def __init__(self, database_handler: DatabaseHandler, known_flags: KnownFlags = KNOWN_FLAGS,
+                 poll_interval: float = 30.0, batch_size: int = 1000):
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1.")
+
+        self._database_handler = database_handler
+        self._known_flags = known_flags
+        self._poll_interval = poll_interval
+        self._batch_size = batch_size
+        self._loaded_mtime = getmtime(known_flags.flags_file)
+        self._worker = Thread(target=self.run, name="flask-recon-reclassifier", daemon=True)
+        self._stopping = Event()
+
+    def start(self) -> None:
+        self._worker.start()
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Stops after the batch in progress. Anything still queued is picked up on the next start."""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        if self._worker.is_alive():
+            self._worker.join(timeout)
+
+    def run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self.reload_if_changed()
+                self.sync()
+            except Exception as e:
+                print(f"Reclassification failed: {e}")
+            self._stopping.wait(self._poll_interval)
+
+    def reload_if_changed(self) -> None:
+        if (mtime := getmtime(self._known_flags.flags_file)) == self._loaded_mtime:
+            return
+        self._known_flags.load_flags()
+        self._loaded_mtime = mtime
+
+    def sync(self) -> None:
+        """Queues the requests the loaded flag set can affect and rescores them."""
+        version = self._known_flags.version
+        if self._database_handler.register_flag_set(version, self._known_flags.flag_data):
+            # requests inserted before this process first connected may still be unclassified
+            queued = self._database_handler.enqueue_reclassification(version, {}, {})
+        elif (previous := self._database_handler.get_last_reclassified_flag_set(version)) is None:
+            queued = self._database_handler.enqueue_all_reclassification(version)
+        else:
+            added, changed = diff_flag_sets(previous[1], self._known_flags.flag_data)
+            queued = self._database_handler.enqueue_reclassification(version, added, changed)
+
+        if queued:
+            print(f"Reclassifying {queued} requests with flag set {version[:12]}")
+        started, done = monotonic(), 0
+        while not self._stopping.is_set():
+            if not (taken := self._database_handler.reclassify_batch(self._batch_size)):
+                break
+            done += taken
+        else:
+            return
+
+        self._database_handler.mark_flag_set_reclassified(version)
+        if done:
+            print(f"Reclassified {done} requests in {monotonic() - started:.1f}s")
+
+
+def rescore_all(database_handler: DatabaseHandler, processes: Optional[int] = None, chunk_size: int = 5_000,
+                restart: bool = False, report_interval: float = 5.0) -> int:
+    """
+    Rescores every request with the loaded flags file. Requests are streamed in request_id order, scored chunk by
+    chunk across a pool of worker processes, in batches when numpy is installed, and written back in order, one
+    transaction per chunk that also advances a checkpoint. An interrupted run resumes after the last chunk written;
+    restart rescores from the beginning.
+    Returns the number of requests rescored.
+    """
+    version = KNOWN_FLAGS.version
+    processes = processes or cpu_count() or 1
+    if restart:
+        database_handler.clear_rescore_checkpoint(version)
+    if (after := database_handler.get_rescore_checkpoint(version)) > 0:
+        print(f"Resuming rescore with flag set {version[:12]} after request {after}")
+    database_handler.register_flag_set(version, KNOWN_FLAGS.flag_data)
+
+    done, started, reported = 0, monotonic(), monotonic()
+    rows = database_handler.stream_classification_rows(after, chunk_size)
+    pending = deque()
+    try:
+        with ProcessPoolExecutor(processes) as pool:
+            for chunk in batched(rows, chunk_size):
+                pending.append((chunk[-1][0], pool.submit(score_rows, chunk)))
+                # bounding the chunks in flight keeps memory flat however far the reader gets ahead
+                if len(pending) >= processes * 2:
+                    done += save_next_chunk(database_handler, pending, version)
+                if monotonic() - reported >= report_interval:
+                    reported = monotonic()
+                    print(f"Rescored {done} requests ({done / (reported - started):.0f}/s)")
+            while pending:
+                done += save_next_chunk(database_handler, pending, version)
+    finally:
+        rows.close()
+
+    database_handler.mark_flag_set_reclassified(version)
+    elapsed = monotonic() - started
+    print(f"Rescored {done} requests in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f}/s)")
+    return done
+
+
+def save_next_chunk(database_handler: DatabaseHandler, pending: deque, version: str) -> int:
+    """Waits for the oldest chunk in flight and saves it, so the checkpoint only ever moves past written rows."""
+    last_request_id, future = pending.popleft()
+    classified = future.result()
+    database_handler.save_classifications(classified, version, last_request_id)
+    return len(classified)
@@ -0,0 +1,80 @@
+from datetime import datetime
+from threading import Thread, Event
+from typing import Any, Dict, Optional
+
+from flask_recon.database import DatabaseHandler
+
+
+class DashboardSnapshot:
+    """
+    In-memory copy of the home page metrics, refreshed from the database by a background thread every refresh_interval
+    seconds, so that rendering the home page never queries the database.
+    """
+    _database_handler: DatabaseHandler
+    _refresh_interval: float
+    _metrics: Dict[str, Any]
+    _refreshed: Optional[datetime] = None
+    _worker: Thread
+    _stopping: Event
+
+    def __init__(self, database_handler: DatabaseHandler, refresh_interval: float = 30.0):
+        if refresh_interval <= 0:
+            raise ValueError("Refresh interval must be positive.")
+
+        self._database_handler = database_handler
+        self._refresh_interval = refresh_interval
+        self._metrics = {}
+        self._worker = Thread(target=self.run, name="flask-recon-dashboard", daemon=True)
+        self._stopping = Event()
+
+    def start(self) -> None:
+        # the first snapshot is taken before any page can be served
+        self.try_refresh()
+        self._worker.start()
+
+    def close(self) -> None:
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        if self._worker.is_alive():
+            self._worker.join(5)
+
+    def run(self) -> None:
+        while not self._stopping.wait(self._refresh_interval):
+            self.try_refresh()
+
+    def try_refresh(self) -> None:
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Dashboard refresh failed: {e}")
+
+    def refresh(self) -> None:
+        try:
+            last_actor, last_actor_time = self._database_handler.get_last_actor()
+        except TypeError:
+            last_actor, last_actor_time = None, None
+        last_method, last_endpoint, last_threat_level = self._database_handler.get_last_endpoint() or (None,) * 3
+        metrics = {
+            "total_requests": self._database_handler.get_request_count(),
+            "total_endpoints": self._database_handler.get_endpoint_count(),
+            "total_actors": self._database_handler.get_actor_count(),
+            "last_request_time": self._database_handler.get_last_request_time(),
+            "time_between_requests": self._database_handler.get_average_time_between_requests(),
+            "last_endpoint": last_endpoint,
+            "last_request_method": last_method,
+            "last_threat_level": last_threat_level,
+            "last_actor": last_actor,
+            "last_actor_time": last_actor_time,
+        }
+        # swapping the whole map keeps concurrent renders consistent without a lock
+        self._metrics = metrics
+        self._refreshed = datetime.now()
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        return self._metrics
+
+    @property
+    def refreshed(self) -> Optional[datetime]:
+        return self._refreshed
@@ -1,84 +1,484 @@
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from hashlib import sha256
-from json import dumps, loads
-from typing import Optional, List, Tuple, Dict, Union, Any
+from io import StringIO
+from json import dumps
+from select import select
+from threading import BoundedSemaphore, Event, Thread
+from typing import Optional, List, Tuple, Dict, Union, Any, Iterator, Set
 from uuid import uuid4
 
-from psycopg2 import connect
-from psycopg2.extensions import cursor, connection
+from psycopg2 import connect, OperationalError
+from psycopg2.extensions import cursor, connection, ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extras import execute_values, Json
+from psycopg2.pool import ThreadedConnectionPool
 
-from flask_recon.structures import IncomingRequest, RemoteHost
+from flask_recon.cache import LRUCache, HoneypotCache
+from flask_recon.geoip import GeoIndex, GeoInfo
+from flask_recon.structures import IncomingRequest, RemoteHost, RequestBatch, classify_rows
 
+HOST_SORT_COLUMNS = ("total", "valid", "invalid", "threat_level", "host")
+REQUEST_DETAIL_FIELDS = ("headers", "body")
+PARTITION_NAME_FORMAT = "requests_%Y_%m"
+DEFAULT_PARTITION = "requests_default"
+CLASSIFICATION_COLUMNS = '"requests"."request_id", "requests"."method", "requests"."path", ' \
+                         '"requests"."query_string", "requests"."headers", "requests"."body", "requests"."port"'
 
-class DatabaseHandler(cursor):
-    _conn: connection
 
-    def __init__(self, dbname: str, user: str, password: str, host: str, port: str):
-        self._conn = connect(database=dbname, user=user, password=password, host=host, port=port)
-        super().__init__(self._conn)
+class DatabaseHandler:
+    """
+    Query methods are safe to call from many threads at once. Each call checks a connection out of the pool for the
+    duration of one transaction, blocking while all max_connections connections are in use.
+    """
+    _connection_parameters: Dict[str, str]
+    _pool: ThreadedConnectionPool
+    _available: BoundedSemaphore
+    _actor_cache: LRUCache
+    _honeypot_cache: HoneypotCache
+    _honeypot_watcher: Optional[Thread] = None
+    _geo_index: Optional[GeoIndex] = None
+    _closing: Event
+
+    def __init__(self, dbname: str, user: str, password: str, host: str, port: str, min_connections: int = 1,
+                 max_connections: int = 10, actor_cache_size: int = 100_000):
+        self._connection_parameters = {"database": dbname, "user": user, "password": password, "host": host,
+                                       "port": port}
+        self._pool = ThreadedConnectionPool(min_connections, max_connections, **self._connection_parameters)
+        self._available = BoundedSemaphore(max_connections)
+        self._closing = Event()
+        self._actor_cache = LRUCache(actor_cache_size)
+        self._honeypot_cache = HoneypotCache()
+        self.preload_actor_cache()
+        self.reload_honeypots()
 
     def __del__(self):
-        self._conn.close()
-        super().close()
+        if hasattr(self, "_pool"):
+            self.close()
+
+    def close(self) -> None:
+        self._closing.set()
+        if not self._pool.closed:
+            self._pool.closeall()
+
+    @contextmanager
+    def connection(self) -> Iterator[connection]:
+        """Checks out a connection for one transaction, committing on success and rolling back on error."""
+        self._available.acquire()
+        try:
+            conn = self._pool.getconn()
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self._pool.putconn(conn)
+        finally:
+            self._available.release()
+
+    @contextmanager
+    def cursor(self) -> Iterator[cursor]:
+        with self.connection() as conn, conn.cursor() as cur:
+            yield cur
 
     def actor_exists(self, remote_host: RemoteHost) -> bool:
-        self.execute("SELECT EXISTS(SELECT actor_id FROM actors WHERE host = %s)", (remote_host.address,))
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT EXISTS(SELECT actor_id FROM actors WHERE host = %s)", (remote_host.address,))
+            return cur.fetchone()[0]
 
     def insert_actor(self, remote_host: RemoteHost, flagged: bool = False) -> None:
-        self.execute("INSERT INTO actors (host, flagged) VALUES (%s, %s)", (remote_host.address, flagged,))
-        self._conn.commit()
+        with self.cursor() as cur:
+            cur.execute("INSERT INTO actors (host, flagged, country, asn, as_organisation) VALUES (%s, %s, %s, %s, %s)",
+                        (remote_host.address, flagged, *self.geolocate(remote_host.address)))
 
     def get_actor_average_threat_level(self, actor_id: int) -> int:
-        self.execute("SELECT threat_level FROM requests WHERE actor_id = %s", (actor_id,))
-        result = self.fetchall()
+        with self.cursor() as cur:
+            cur.execute("SELECT threat_level FROM requests WHERE actor_id = %s", (actor_id,))
+            result = cur.fetchall()
         if not result:
             return 0
         levels = [row[0] for row in result]
         return sum(levels) // len(levels) if levels else 0
 
     def get_actor_id(self, remote_host: RemoteHost) -> int:
-        self.execute("SELECT actor_id FROM actors WHERE host = %s", (remote_host.address,))
-        result = self.fetchone()
+        if (actor_id := self._actor_cache.get(remote_host.address)) is not None:
+            return actor_id
+        with self.cursor() as cur:
+            cur.execute("SELECT actor_id FROM actors WHERE host = %s", (remote_host.address,))
+            result = cur.fetchone()
         if not result:
             return -1
+        self._actor_cache.put(remote_host.address, result[0])
         return result[0]
 
+    def resolve_actor_id(self, remote_host: RemoteHost) -> int:
+        """Returns the actor_id for a host, inserting the actor if it has not been seen before."""
+        return self.resolve_actor_ids([remote_host.address])[remote_host.address]
+
+    def resolve_actor_ids(self, hosts: List[str]) -> Dict[str, int]:
+        actor_ids, missing = self.cached_actor_ids(hosts)
+        if missing:
+            with self.cursor() as cur:
+                inserted = self.upsert_actors(cur, missing)
+            self.cache_actor_ids(inserted)
+            actor_ids.update(inserted)
+        return actor_ids
+
+    def cached_actor_ids(self, hosts: List[str]) -> Tuple[Dict[str, int], List[str]]:
+        actor_ids, missing = {}, []
+        for host in hosts:
+            if (actor_id := self._actor_cache.get(host)) is not None:
+                actor_ids[host] = actor_id
+            else:
+                missing.append(host)
+        return actor_ids, missing
+
+    def cache_actor_ids(self, actor_ids: Dict[str, int]) -> None:
+        # only called once the transaction that resolved the ids has committed
+        for host, actor_id in actor_ids.items():
+            self._actor_cache.put(host, actor_id)
+
+    def upsert_actors(self, cur: cursor, hosts: List[str]) -> Dict[str, int]:
+        # rows are locked in sorted order so that concurrent batches cannot deadlock, and actors that already exist
+        # keep the location they were created with
+        return dict(execute_values(cur, "INSERT INTO actors (host, country, asn, as_organisation) VALUES %s "
+                                        "ON CONFLICT (host) DO UPDATE SET host = EXCLUDED.host "
+                                        "RETURNING host, actor_id",
+                                   [(host, *self.geolocate(host)) for host in sorted(hosts)], fetch=True))
+
+    def set_geo_index(self, geo_index: GeoIndex) -> None:
+        """Looks up the country and autonomous system of every actor created from now on in geo_index."""
+        self._geo_index = geo_index
+
+    def geolocate(self, host: str) -> GeoInfo:
+        if self._geo_index is None:
+            return None, None, None
+        return self._geo_index.lookup(host) or (None, None, None)
+
+    def enrich_actors(self, batch_size: int = 10_000) -> int:
+        """
+        Looks up the location of actors created before a GeoIP index was set, or last looked up in none of its ranges,
+        returning how many were found.
+        """
+        if self._geo_index is None:
+            raise ValueError("No GeoIP index has been set.")
+        enriched, after = 0, 0
+        while True:
+            with self.cursor() as cur:
+                cur.execute("SELECT actor_id, host FROM actors WHERE actor_id > %s AND country IS NULL AND asn IS NULL "
+                            "AND as_organisation IS NULL ORDER BY actor_id LIMIT %s", (after, batch_size))
+                if not (actors := cur.fetchall()):
+                    return enriched
+                after = actors[-1][0]
+                found = [(actor_id, *info) for actor_id, host in actors if (info := self._geo_index.lookup(host))]
+                if found:
+                    execute_values(cur, "UPDATE actors SET country = found.country, asn = found.asn, "
+                                        "as_organisation = found.as_organisation "
+                                        "FROM (VALUES %s) AS found (actor_id, country, asn, as_organisation) "
+                                        "WHERE actors.actor_id = found.actor_id", found,
+                                   template="(%s, %s::CHAR(2), %s::BIGINT, %s::VARCHAR)")
+                enriched += len(found)
+
+    @staticmethod
+    def update_endpoint_stats(cur: cursor, requests: List[Tuple[str, int, datetime, str, int]]) -> None:
+        """
+        Folds newly inserted requests, as (path, actor_id, timestamp, method, threat_level) rows, into endpoint_stats
+        within the inserting transaction.
+        """
+        stats = {}
+        for path, actor_id, timestamp, method, threat_level in requests:
+            if (row := stats.get(path)) is None:
+                stats[path] = [path, 1, 0, timestamp, timestamp, threat_level, method]
+                continue
+            row[1] += 1
+            row[3] = min(row[3], timestamp)
+            if timestamp >= row[4]:
+                row[4], row[6] = timestamp, method
+            row[5] = max(row[5], threat_level)
+
+        new_actors = execute_values(
+            cur,
+            "INSERT INTO endpoint_actors (path, actor_id) VALUES %s ON CONFLICT DO NOTHING RETURNING path",
+            sorted({(path, actor_id) for path, actor_id, *_ in requests}), fetch=True)
+        for (path,) in new_actors:
+            stats[path][2] += 1
+
+        # rows are locked in sorted order so that concurrent batches cannot deadlock
+        execute_values(cur, """
+            INSERT INTO endpoint_stats (path, hits, distinct_actors, first_seen, last_seen, max_threat_level, last_method)
+            VALUES %s
+            ON CONFLICT (path) DO UPDATE SET
+                hits = endpoint_stats.hits + EXCLUDED.hits,
+                distinct_actors = endpoint_stats.distinct_actors + EXCLUDED.distinct_actors,
+                first_seen = LEAST(endpoint_stats.first_seen, EXCLUDED.first_seen),
+                last_seen = GREATEST(endpoint_stats.last_seen, EXCLUDED.last_seen),
+                max_threat_level = GREATEST(endpoint_stats.max_threat_level, EXCLUDED.max_threat_level),
+                last_method = CASE WHEN EXCLUDED.last_seen >= endpoint_stats.last_seen
+                                   THEN EXCLUDED.last_method ELSE endpoint_stats.last_method END
+        """, sorted(stats.values()))
+
+    def backfill_endpoint_stats(self) -> None:
+        """Rebuilds endpoint_stats from the requests table, blocking ingestion while it runs."""
+        with self.cursor() as cur:
+            cur.execute("LOCK TABLE requests IN SHARE MODE")
+            cur.execute("TRUNCATE endpoint_stats, endpoint_actors")
+            cur.execute("INSERT INTO endpoint_actors (path, actor_id) SELECT DISTINCT path, actor_id FROM requests")
+            cur.execute("""
+                INSERT INTO endpoint_stats (path, hits, distinct_actors, first_seen, last_seen, max_threat_level, last_method)
+                SELECT path, COUNT(*), COUNT(DISTINCT actor_id), MIN(timestamp), MAX(timestamp), MAX(threat_level),
+                       (ARRAY_AGG(method ORDER BY timestamp DESC, request_id DESC))[1]
+                FROM requests
+                GROUP BY path
+            """)
+
+    def create_request_partitions(self, months_ahead: int = 3, since: Optional[datetime] = None) -> List[str]:
+        """
+        Creates the monthly requests partitions from the month of since, or of the current month, to months_ahead
+        months ahead, returning the names of any that were missing. Creation starts earlier if requests_default holds
+        older rows, and rows in requests_default for a month being created, written before its partition existed, are
+        moved into the new partition. Each month is created under its own savepoint, so a month that fails is reported
+        without holding back the rest.
+        """
+        now, created = datetime.now(), []
+        with self.cursor() as cur:
+            # serialises maintenance across processes, released on commit
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('requests_partitions'))")
+            existing = {name for name, _, _ in self.get_request_partitions(cur)}
+            cur.execute(f'SELECT MIN("timestamp") FROM "{DEFAULT_PARTITION}"')
+            stranded = cur.fetchone()[0]
+            month = self.month_start(min(timestamp for timestamp in (since, stranded, now) if timestamp is not None))
+            last = self.month_start(now)
+            for _ in range(months_ahead):
+                last = self.month_start(last + timedelta(days=32))
+            while month <= last:
+                end = self.month_start(month + timedelta(days=32))
+                if (name := month.strftime(PARTITION_NAME_FORMAT)) not in existing:
+                    cur.execute("SAVEPOINT create_partition")
+                    try:
+                        self.create_request_partition(cur, name, month, end)
+                    except Exception as e:
+                        cur.execute("ROLLBACK TO SAVEPOINT create_partition")
+                        print(f"Failed to create request partition {name}, its rows stay in {DEFAULT_PARTITION}: {e}")
+                    else:
+                        cur.execute("RELEASE SAVEPOINT create_partition")
+                        created.append(name)
+                month = end
+        return created
+
+    @staticmethod
+    def create_request_partition(cur: cursor, name: str, start: datetime, end: datetime) -> None:
+        cur.execute(f'SELECT EXISTS (SELECT 1 FROM "{DEFAULT_PARTITION}" WHERE "timestamp" >= %s AND "timestamp" < %s)',
+                    (start, end))
+        if not cur.fetchone()[0]:
+            cur.execute(f'CREATE TABLE "{name}" PARTITION OF "requests" FOR VALUES FROM (%s) TO (%s)', (start, end))
+            return
+        # a partition cannot be created over rows the default partition holds, so they are moved into a standalone
+        # table that is then attached
+        cur.execute(f'CREATE TABLE "{name}" (LIKE "requests" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        cur.execute(f"""
+            WITH "moved" AS (
+                DELETE FROM "{DEFAULT_PARTITION}" WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *
+            )
+            INSERT INTO "{name}" SELECT * FROM "moved"
+        """, (start, end))
+        print(f"Moving {cur.rowcount} requests from {DEFAULT_PARTITION} into {name}")
+        cur.execute(f'ALTER TABLE "requests" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)', (start, end))
+
+    def apply_retention(self, retention_days: int, drop: bool = True) -> List[str]:
+        """
+        Rolls every monthly partition that ends more than retention_days ago up into hourly request_rollups per path
+        and actor, then detaches it, and drops it unless drop is False. Each partition is handled in its own
+        transaction. Returns the names of the partitions removed.
+        """
+        cutoff, removed = datetime.now() - timedelta(days=retention_days), []
+        with self.cursor() as cur:
+            expired = [name for name, _, end in self.get_request_partitions(cur) if end <= cutoff]
+        for name in expired:
+            with self.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext('requests_partitions'))")
+                if name not in {partition for partition, _, _ in self.get_request_partitions(cur)}:
+                    continue
+                cur.execute(f"""
+                    INSERT INTO "request_rollups" ("hour", "path", "actor_id", "hits", "acceptable",
+                                                   "threat_level_sum", "max_threat_level")
+                    SELECT date_trunc('hour', "timestamp"), "path", "actor_id", COUNT(*),
+                           COUNT(*) FILTER (WHERE "acceptable"), SUM("threat_level"), MAX("threat_level")
+                    FROM "{name}"
+                    GROUP BY 1, 2, 3
+                    ON CONFLICT ("hour", "path", "actor_id") DO UPDATE SET
+                        "hits" = "request_rollups"."hits" + EXCLUDED."hits",
+                        "acceptable" = "request_rollups"."acceptable" + EXCLUDED."acceptable",
+                        "threat_level_sum" = "request_rollups"."threat_level_sum" + EXCLUDED."threat_level_sum",
+                        "max_threat_level" = GREATEST("request_rollups"."max_threat_level",
+                                                      EXCLUDED."max_threat_level")
+                """)
+                for table in ("request_flags", "reclassify_queue", "analysed_requests"):
+                    cur.execute(f'DELETE FROM "{table}" WHERE "request_id" IN (SELECT "request_id" FROM "{name}")')
+                cur.execute(f'ALTER TABLE "requests" DETACH PARTITION "{name}"')
+                if drop:
+                    cur.execute(f'DROP TABLE "{name}"')
+            removed.append(name)
+        return removed
+
+    @staticmethod
+    def get_request_partitions(cur: cursor) -> List[Tuple[str, datetime, datetime]]:
+        """Returns (name, start, end) for the monthly partitions of requests, oldest first."""
+        cur.execute("""
+            SELECT "child"."relname"
+            FROM "pg_inherits"
+            JOIN "pg_class" AS "child" ON "child"."oid" = "pg_inherits"."inhrelid"
+            WHERE "pg_inherits"."inhparent" = 'requests'::regclass
+        """)
+        partitions = []
+        for (name,) in cur.fetchall():
+            try:
+                start = datetime.strptime(name, PARTITION_NAME_FORMAT)
+            except ValueError:
+                continue
+            partitions.append((name, start, DatabaseHandler.month_start(start + timedelta(days=32))))
+        return sorted(partitions, key=lambda partition: partition[1])
+
+    @staticmethod
+    def month_start(timestamp: datetime) -> datetime:
+        return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    def preload_actor_cache(self) -> None:
+        with self.cursor() as cur:
+            cur.execute("SELECT host, actor_id FROM actors ORDER BY actor_id DESC LIMIT %s",
+                        (self._actor_cache.capacity,))
+            rows = cur.fetchall()
+        for host, actor_id in reversed(rows):
+            self._actor_cache.put(host, actor_id)
+
     def address_is_authorised(self, remote_host: RemoteHost) -> bool:
-        self.execute("SELECT address FROM authorized_addresses WHERE host = %s", (remote_host.address,))
-        return True if self.fetchone() else False
+        with self.cursor() as cur:
+            cur.execute("SELECT address FROM authorized_addresses WHERE host = %s", (remote_host.address,))
+            return True if cur.fetchone() else False
 
     def update_request_threat_level(self, request_id: int, threat_level: int) -> None:
-        self.execute("UPDATE requests SET threat_level = %s WHERE request_id = %s", (threat_level, request_id))
-        self._conn.commit()
+        with self.cursor() as cur:
+            cur.execute("UPDATE requests SET threat_level = %s WHERE request_id = %s", (threat_level, request_id))
 
     def update_actor_threat_level(self, actor_id: int) -> None:
         threat_level = self.get_actor_average_threat_level(actor_id)
-        self.execute("UPDATE actors SET threat_level = %s WHERE actor_id = %s", (threat_level, actor_id))
-        self._conn.commit()
+        with self.cursor() as cur:
+            cur.execute("UPDATE actors SET threat_level = %s WHERE actor_id = %s", (threat_level, actor_id))
 
     def insert_request(self, request: IncomingRequest) -> None:
-        if not self.actor_exists(request.host):
-            self.insert_actor(request.host)
-
         request.determine_threat_level()
-        actor_id = self.get_actor_id(request.host)
-        self.execute("SELECT NOW()")
-        timestamp = self.fetchone()[0]
-        # using a parameterized query automatically escapes the input and prevents SQL injection
-        self.execute(
-            "INSERT INTO requests (actor_id, timestamp, method, path, body, headers, query_string, port, acceptable, threat_level) "
-            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-            (actor_id, timestamp, request.method.value, request.uri, dumps(request.body),
-             dumps(request.headers), request.query_string, request.local_port, request.is_acceptable,
-             request.threat_level))
-        self._conn.commit()
-
-    def get_request(self, request_id: int) -> IncomingRequest:
-        self.execute("SELECT * FROM requests WHERE request_id = %s", (request_id,))
-        row = self.fetchone()
-        self.execute("SELECT host FROM actors WHERE actor_id = %s", (row[1],))
-        result = self.fetchone()
+        actor_ids, missing = self.cached_actor_ids([request.host.address])
+        with self.cursor() as cur:
+            inserted = self.upsert_actors(cur, missing) if missing else {}
+            actor_ids.update(inserted)
+            actor_id = actor_ids[request.host.address]
+            # using a parameterized query automatically escapes the input and prevents SQL injection
+            cur.execute(
+                "INSERT INTO requests (actor_id, timestamp, method, path, body, headers, query_string, port, acceptable, "
+                "threat_level, request_types, attack_types, flags_version) "
+                "VALUES (%s, NOW(), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING request_id, timestamp",
+                (actor_id, request.method.value, request.uri, Json(request.body),
+                 Json(request.headers), request.query_string, request.local_port, request.is_acceptable,
+                 request.threat_level, *self.classification_values(request)))
+            request_id, timestamp = cur.fetchone()
+            self.insert_request_flags(cur, [(kind, flag, request_id) for kind, flag in request.matched_flags])
+            self.update_endpoint_stats(
+                cur, [(request.uri, actor_id, timestamp, request.method.value, request.threat_level)])
+        self.cache_actor_ids(inserted)
+
+    def insert_requests(self, requests: List[IncomingRequest]) -> None:
+        """Inserts a batch of requests, and any actors they came from, in a single transaction."""
+        if not requests:
+            return
+
+        actor_ids, missing = self.cached_actor_ids(list({request.host.address for request in requests}))
+        for request in requests:
+            request.determine_threat_level()
+        with self.cursor() as cur:
+            inserted = self.upsert_actors(cur, missing) if missing else {}
+            actor_ids.update(inserted)
+            # execute_values returns the ids in the order the rows were given
+            request_ids = execute_values(
+                cur,
+                "INSERT INTO requests (actor_id, timestamp, method, path, body, headers, query_string, port, acceptable, "
+                "threat_level, request_types, attack_types, flags_version) VALUES %s RETURNING request_id",
+                [(actor_ids[request.host.address], request.timestamp, request.method.value, request.uri,
+                  Json(request.body), Json(request.headers), request.query_string, request.local_port,
+                  request.is_acceptable, request.threat_level, *self.classification_values(request))
+                 for request in requests], fetch=True)
+            self.insert_request_flags(cur, [(kind, flag, request_id) for request, (request_id,) in
+                                            zip(requests, request_ids) for kind, flag in request.matched_flags])
+            self.update_endpoint_stats(
+                cur, [(request.uri, actor_ids[request.host.address], request.timestamp, request.method.value,
+                       request.threat_level) for request in requests])
+        self.cache_actor_ids(inserted)
+
+    def copy_requests(self, rows: List[Tuple], classified: Optional[List[Tuple]] = None) -> None:
+        """
+        Bulk loads (actor_id, timestamp, method, path, body, headers, query_string, port, acceptable) rows, with body
+        and headers as JSON text, through COPY ... FROM STDIN in one transaction. classified is classify_rows output in
+        the same order as rows; without it, requests are stored unclassified and left to the Reclassifier.
+        """
+        if not rows:
+            return
+        with self.cursor() as cur:
+            # ids are drawn up front so that request_flags can be copied alongside the requests that matched them
+            cur.execute("SELECT nextval(pg_get_serial_sequence('requests', 'request_id')) FROM generate_series(1, %s)",
+                        (len(rows),))
+            request_ids = [row[0] for row in cur.fetchall()]
+            classified = classified or [(None, 0, [], [], None, [])] * len(rows)
+
+            requests, request_flags, stats = StringIO(), StringIO(), []
+            for request_id, row, (_, threat_level, request_types, attack_types, flags_version, matched_flags) in zip(
+                    request_ids, rows, classified):
+                actor_id, timestamp, method, path, body, headers, query_string, port, acceptable = row
+                requests.write("\t".join((
+                    str(request_id), str(actor_id), timestamp.isoformat(), self.copy_text(method),
+                    self.copy_text(path), self.copy_text(body), self.copy_text(headers), self.copy_text(query_string),
+                    str(port), "t" if acceptable else "f", str(threat_level), "{" + ",".join(request_types) + "}",
+                    "{" + ",".join(attack_types) + "}", self.copy_text(flags_version)
+                )) + "\n")
+                for kind, flag in matched_flags:
+                    request_flags.write(f"{kind}\t{self.copy_text(flag)}\t{request_id}\n")
+                stats.append((path, actor_id, timestamp, method, threat_level))
+
+            requests.seek(0)
+            cur.copy_expert("COPY requests (request_id, actor_id, timestamp, method, path, body, headers, query_string, "
+                            "port, acceptable, threat_level, request_types, attack_types, flags_version) FROM STDIN",
+                            requests)
+            request_flags.seek(0)
+            cur.copy_expert("COPY request_flags (kind, flag, request_id) FROM STDIN", request_flags)
+            self.update_endpoint_stats(cur, stats)
+
+    @staticmethod
+    def copy_text(value: Optional[str]) -> str:
+        """Escapes a value for COPY's text format, in which NULL is \\N."""
+        if value is None:
+            return "\\N"
+        return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+    @staticmethod
+    def classification_values(request: IncomingRequest) -> Tuple[List[str], List[str], str]:
+        return ([request_type.value for request_type in request.request_types],
+                [attack_type.value for attack_type in request.attack_types], request.flags_version)
+
+    @staticmethod
+    def insert_request_flags(cur: cursor, rows: List[Tuple[str, str, int]]) -> None:
+        """Records the (kind, flag) pairs each request matched, so a changed flag can find the requests it scored."""
+        if rows:
+            execute_values(cur, "INSERT INTO request_flags (kind, flag, request_id) VALUES %s ON CONFLICT DO NOTHING",
+                           rows, page_size=len(rows))
+
+    def get_request(self, request_id: int) -> Optional[IncomingRequest]:
+        with self.cursor() as cur:
+            cur.execute("SELECT request_id, actor_id, timestamp, method, path, body, headers, query_string, port, "
+                        "acceptable, threat_level, request_types, attack_types FROM requests WHERE request_id = %s",
+                        (request_id,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            cur.execute("SELECT host FROM actors WHERE actor_id = %s", (row[1],))
+            result = cur.fetchone()
         if not result:
             return IncomingRequest(row[8]).from_components(
                 host="Unknown",
@@ -91,140 +491,350 @@ class DatabaseHandler(cursor):
                 request_id=-1,
                 threat_level=0,
             )
-        host = RemoteHost(self.fetchone()[0])
-        return IncomingRequest(row[6]).from_components(
+        host = RemoteHost(result[0])
+        return IncomingRequest(row[8]).from_components(
             host=host.address,
             timestamp=row[2],
             request_method=row[3],
-            request_body=loads(row[5]),
-            request_headers=loads(row[6]),
+            request_body=row[5],
+            request_headers=row[6],
             query_string=row[7],
             request_uri=row[4],
             request_id=row[0],
             threat_level=row[10],
+            request_types=row[11],
+            attack_types=row[12],
         )
 
-    def get_honeypot(self, file: str) -> Optional[str]:
-        self.execute("SELECT dummy_contents FROM honeypots WHERE file_name = %s", (file,))
-        return self.fetchone()[0] if self.rowcount > 0 else None
+    def get_honeypot(self, file: str) -> Optional[Tuple[bytes, int]]:
+        """Returns the encoded contents and content length of a honeypot from the in-memory copy of the table."""
+        return self._honeypot_cache.get(file)
+
+    def reload_honeypots(self) -> None:
+        with self.cursor() as cur:
+            cur.execute("SELECT file_name, dummy_contents FROM honeypots")
+            rows = cur.fetchall()
+        self._honeypot_cache.load(rows)
 
     def honeypot_exists(self, file: str) -> bool:
-        self.execute("SELECT EXISTS(SELECT honeypot_id FROM honeypots WHERE file_name = %s)", (file,))
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT EXISTS(SELECT honeypot_id FROM honeypots WHERE file_name = %s)", (file,))
+            return cur.fetchone()[0]
 
     def insert_honeypot(self, file: str, contents: str) -> None:
         if self.honeypot_exists(file):
             return
 
-        self.execute("INSERT INTO honeypots (file_name, dummy_contents) VALUES (%s, %s)", (file, contents))
-        self._conn.commit()
+        with self.cursor() as cur:
+            cur.execute("INSERT INTO honeypots (file_name, dummy_contents) VALUES (%s, %s)", (file, contents))
+            # delivered to every watching handler when the transaction commits
+            cur.execute("NOTIFY honeypots_changed")
+        self.reload_honeypots()
+
+    def watch_honeypots(self, poll_interval: float = 5.0) -> None:
+        """Reloads the honeypot cache whenever any handler, in any process, inserts a honeypot."""
+        if self._honeypot_watcher is not None:
+            return
+        self._honeypot_watcher = Thread(target=self.honeypot_watcher, args=(poll_interval,),
+                                        name="flask-recon-honeypots", daemon=True)
+        self._honeypot_watcher.start()
+
+    def honeypot_watcher(self, poll_interval: float) -> None:
+        while not self._closing.is_set():
+            try:
+                conn = connect(**self._connection_parameters)
+            except OperationalError as e:
+                print(f"Honeypot watcher failed to connect: {e}")
+                self._closing.wait(poll_interval)
+                continue
+
+            try:
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute("LISTEN honeypots_changed")
+                # pick up anything inserted while the watcher was disconnected
+                self.reload_honeypots()
+                while not self._closing.is_set():
+                    if not select([conn], [], [], poll_interval)[0]:
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self.reload_honeypots()
+            except OperationalError as e:
+                print(f"Honeypot watcher lost its connection: {e}")
+            finally:
+                conn.close()
 
     def count_endpoint(self, endpoint: str) -> int:
-        self.execute("SELECT COUNT(*) FROM requests WHERE path = %s", (endpoint,))
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT hits FROM endpoint_stats WHERE path = %s", (endpoint,))
+            result = cur.fetchone()
+        return result[0] if result else 0
 
     def count_requests(self, host: RemoteHost) -> Tuple[int, int]:
         actor_id = self.get_actor_id(host)
-        self.execute("SELECT COUNT(*) FROM requests WHERE actor_id = %s AND acceptable = TRUE", (actor_id,))
-        valid = self.fetchone()[0]
-        self.execute("SELECT COUNT(*) FROM requests WHERE actor_id = %s AND acceptable = FALSE", (actor_id,))
-        invalid = self.fetchone()[0]
-        return valid, invalid
-
-    def get_all_endpoints(self) -> List[Tuple[str, int]]:
-        self.execute("SELECT path FROM requests")
-        r = []
-        e = set()
-        for row in self.fetchall():
-            endpoint = row[0]
-            if endpoint in e:
-                continue
-            e.add(endpoint)
-            r.append((endpoint, self.count_endpoint(endpoint)))
-        return sorted(r, key=lambda x: x[1], reverse=True)
+        with self.cursor() as cur:
+            # requests from partitions removed by apply_retention are counted from their rollups
+            cur.execute("""
+                SELECT "live"."valid" + COALESCE("rolled_up"."valid", 0),
+                       "live"."invalid" + COALESCE("rolled_up"."invalid", 0)
+                FROM (
+                    SELECT COUNT(*) FILTER (WHERE "acceptable") AS "valid",
+                           COUNT(*) FILTER (WHERE NOT "acceptable") AS "invalid"
+                    FROM "requests" WHERE "actor_id" = %s
+                ) AS "live", (
+                    SELECT SUM("acceptable") AS "valid", SUM("hits" - "acceptable") AS "invalid"
+                    FROM "request_rollups" WHERE "actor_id" = %s
+                ) AS "rolled_up"
+            """, (actor_id, actor_id))
+            return cur.fetchone()
+
+    def get_all_endpoints(self) -> List[Tuple[str, int, int, datetime, datetime, int]]:
+        """Returns (path, hits, distinct actors, first seen, last seen, max threat level), most hit first."""
+        with self.cursor() as cur:
+            cur.execute("SELECT path, hits, distinct_actors, first_seen, last_seen, max_threat_level "
+                        "FROM endpoint_stats ORDER BY hits DESC, path")
+            return cur.fetchall()
 
     def count_requests_from_actor(self, actor_id: str, endpoint: str) -> int:
-        self.execute("SELECT COUNT(*) FROM requests WHERE actor_id = %s AND path = %s", (actor_id, endpoint))
-        return self.fetchone()[0]
-
-    def get_hosts_by_endpoint(self, endpoint: str) -> List[Tuple[Dict[str, Union[str, int]], int]]:
-        self.execute("SELECT actor_id FROM requests WHERE path = %s", (endpoint,))
-        actors = self.fetchall()
-        e = set()
-        r = []
-        for row in actors:
-            self.execute("SELECT host, threat_level FROM actors WHERE actor_id = %s", (row[0],))
-            host, threat_level = self.fetchone()
-            if host in e:
-                continue
-            e.add(host)
-            r.append(
-                ({"address": host, "threat_level": threat_level}, self.count_requests_from_actor(row[0], endpoint)))
-        return sorted(r, key=lambda x: x[1], reverse=True)
-
-    def get_remote_hosts(self) -> List[Tuple[str, int, int, int, int]]:
-        self.execute("SELECT actor_id, host, threat_level FROM actors")
-        r = []
-        for row in self.fetchall():
-            host = RemoteHost(row[1])
-            threat_level = self.get_actor_average_threat_level(row[0])
-            valid, invalid = self.count_requests(host)
-            total = valid + invalid
-            r.append((host.address, valid, invalid, total, threat_level))
-        return sorted(r, key=lambda x: x[3], reverse=True)
-
-    def get_requests(self, endpoint: Optional[str] = None, host: Optional[RemoteHost] = None) -> List[IncomingRequest]:
-        if host is None and endpoint is None:
-            self.execute(
-                "SELECT actor_id, timestamp, method, body, headers, query_string, port, acceptable, path, request_id FROM requests")
-        if host is None and endpoint is not None:
-            self.execute(
-                "SELECT actor_id, timestamp, method, body, headers, query_string, port, acceptable, path, request_id FROM requests WHERE path = %s",
-                (endpoint,))
-        if host is not None and endpoint is None:
-            self.execute(
-                "SELECT actor_id, timestamp, method, body, headers, query_string, port, acceptable, path, request_id FROM requests WHERE actor_id = %s",
-                (self.get_actor_id(host),))
-        if host is not None and endpoint is not None:
-            self.execute(
-                "SELECT actor_id, timestamp, method, body, headers, query_string, port, acceptable, path, request_id FROM requests WHERE path = %s AND actor_id = %s",
-                (endpoint, self.get_actor_id(host)))
-
-        requests = self.fetchall()
-        r = []
-        for row in requests:
-            if host is None:
-                self.execute("SELECT host FROM actors WHERE actor_id = %s", (row[0],))
-                host = RemoteHost(self.fetchone()[0])
-            incoming_request = IncomingRequest(row[6]).from_components(
-                host=host.address,
+        with self.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM requests WHERE actor_id = %s AND path = %s", (actor_id, endpoint))
+            return cur.fetchone()[0]
+
+    def get_hosts_by_endpoint(self, endpoint: str, limit: int = 100, descending: bool = True,
+                              after: Optional[List[Any]] = None) -> List[Tuple[Dict[str, Union[str, int]], int]]:
+        """
+        Returns a page of ({address, threat_level, actor_id}, request count) for the actors that requested endpoint,
+        ordered by request count. after is the (count, actor_id) of the last row of the previous page.
+        """
+        if after is not None and len(after) != 2:
+            raise ValueError("Cursor must hold a request count and an actor_id.")
+        direction = "DESC" if descending else "ASC"
+        keyset = f'WHERE ("count", "actor_id") {"<" if descending else ">"} (%s, %s)' if after else ""
+        with self.cursor() as cur:
+            # requests from partitions removed by apply_retention are counted from their rollups
+            cur.execute(f"""
+                SELECT "actor_id", "host", "threat_level", "count"
+                FROM (
+                    SELECT "actors"."actor_id", "actors"."host", "actors"."threat_level",
+                           SUM("counts"."count")::BIGINT AS "count"
+                    FROM (
+                        SELECT "actor_id", COUNT(*) AS "count" FROM "requests" WHERE "path" = %s GROUP BY "actor_id"
+                        UNION ALL
+                        SELECT "actor_id", SUM("hits") FROM "request_rollups" WHERE "path" = %s GROUP BY "actor_id"
+                    ) AS "counts"
+                    JOIN "actors" ON "actors"."actor_id" = "counts"."actor_id"
+                    GROUP BY "actors"."actor_id"
+                ) AS "hosts"
+                {keyset}
+                ORDER BY "count" {direction}, "actor_id" {direction}
+                LIMIT %s
+            """, (endpoint, endpoint, *(after or ()), limit))
+            rows = cur.fetchall()
+        return [({"address": host, "threat_level": threat_level, "actor_id": actor_id}, count)
+                for actor_id, host, threat_level, count in rows]
+
+    def get_remote_hosts(self, limit: int = 100, order_by: str = "total", descending: bool = True,
+                         after: Optional[List[Any]] = None) -> List[Tuple[str, int, int, int, int, int, Optional[str],
+                                                                          Optional[int], Optional[str]]]:
+        """
+        Returns a page of (host, acceptable, unacceptable, total, average threat level, actor_id, country, asn,
+        AS organisation) in a single aggregate query. order_by is one of HOST_SORT_COLUMNS, and after is the
+        (sort value, actor_id) of the last row of the previous page.
+        """
+        if order_by not in HOST_SORT_COLUMNS:
+            raise ValueError(f"Hosts can only be ordered by {', '.join(HOST_SORT_COLUMNS)}.")
+        if after is not None and len(after) != 2:
+            raise ValueError("Cursor must hold a sort value and an actor_id.")
+        direction = "DESC" if descending else "ASC"
+        keyset = f'WHERE ("{order_by}", "actor_id") {"<" if descending else ">"} (%s, %s)' if after else ""
+        with self.cursor() as cur:
+            cur.execute(f"""
+                SELECT "host", "valid", "invalid", "total", "threat_level", "actor_id", "country", "asn",
+                       "as_organisation"
+                FROM (
+                    SELECT "actors"."actor_id", "actors"."host", "actors"."country", "actors"."asn",
+                           "actors"."as_organisation",
+                           COALESCE(SUM("counts"."valid"), 0)::BIGINT AS "valid",
+                           COALESCE(SUM("counts"."total") - SUM("counts"."valid"), 0)::BIGINT AS "invalid",
+                           COALESCE(SUM("counts"."total"), 0)::BIGINT AS "total",
+                           COALESCE(DIV(SUM("counts"."threat_level_sum"), NULLIF(SUM("counts"."total"), 0)),
+                                    0)::BIGINT AS "threat_level"
+                    FROM "actors"
+                    LEFT JOIN (
+                        SELECT "actor_id", COUNT(*) FILTER (WHERE "acceptable") AS "valid", COUNT(*) AS "total",
+                               SUM("threat_level") AS "threat_level_sum"
+                        FROM "requests"
+                        GROUP BY "actor_id"
+                        UNION ALL
+                        -- requests from partitions removed by apply_retention
+                        SELECT "actor_id", SUM("acceptable"), SUM("hits"), SUM("threat_level_sum")
+                        FROM "request_rollups"
+                        GROUP BY "actor_id"
+                    ) AS "counts" ON "counts"."actor_id" = "actors"."actor_id"
+                    GROUP BY "actors"."actor_id"
+                ) AS "hosts"
+                {keyset}
+                ORDER BY "{order_by}" {direction}, "actor_id" {direction}
+                LIMIT %s
+            """, (*(after or ()), limit))
+            return cur.fetchall()
+
+    def get_requests(self, endpoint: Optional[str] = None, host: Optional[RemoteHost] = None, limit: int = 100,
+                     descending: bool = True, after: Optional[List[Any]] = None,
+                     fields: Tuple[str, ...] = REQUEST_DETAIL_FIELDS, start: Optional[datetime] = None,
+                     end: Optional[datetime] = None) -> List[IncomingRequest]:
+        """
+        Returns a page of requests ordered by (timestamp, request_id). after is the (timestamp, request_id) of the last
+        row of the previous page, and fields is the subset of REQUEST_DETAIL_FIELDS to fetch. start and end limit the
+        page to [start, end), and the partitions scanned to those months.
+        """
+        conditions, variables = self.request_conditions(endpoint, host, start, end)
+        return self.get_request_page(conditions, variables, limit, descending, after, fields)
+
+    def get_request_batch(self, endpoint: Optional[str] = None, host: Optional[RemoteHost] = None,
+                          limit: int = 100_000, descending: bool = True, after: Optional[List[Any]] = None,
+                          fields: Tuple[str, ...] = (), start: Optional[datetime] = None,
+                          end: Optional[datetime] = None, batch_size: int = 10_000) -> RequestBatch:
+        """
+        Takes the same arguments as get_requests, but returns the page as a columnar RequestBatch for analytics over
+        many rows. Rows are read from a server-side cursor batch_size at a time, so the raw rows are never all held.
+        """
+        conditions, variables = self.request_conditions(endpoint, host, start, end)
+        query, variables = self.request_page_query(conditions, variables, limit, descending, after, fields)
+        batch = RequestBatch(fields)
+        with self.connection() as conn, conn.cursor(name=f"batch_{uuid4().hex}") as cur:
+            cur.itersize = batch_size
+            cur.execute(query, variables)
+            for row in cur:
+                batch.append(row)
+        return batch
+
+    def request_conditions(self, endpoint: Optional[str], host: Optional[RemoteHost], start: Optional[datetime],
+                           end: Optional[datetime]) -> Tuple[List[str], List[Any]]:
+        conditions, variables = [], []
+        if endpoint is not None:
+            conditions.append('"requests"."path" = %s')
+            variables.append(endpoint)
+        if host is not None:
+            conditions.append('"requests"."actor_id" = %s')
+            variables.append(self.get_actor_id(host))
+        if start is not None:
+            conditions.append('"requests"."timestamp" >= %s')
+            variables.append(start)
+        if end is not None:
+            conditions.append('"requests"."timestamp" < %s')
+            variables.append(end)
+        return conditions, variables
+
+    def get_request_page(self, conditions: List[str], variables: List[Any], limit: int, descending: bool,
+                         after: Optional[List[Any]], fields: Tuple[str, ...] = REQUEST_DETAIL_FIELDS
+                         ) -> List[IncomingRequest]:
+        """
+        Runs a keyset-paginated request query. conditions are ANDed together, and must all be bound by variables.
+        Headers and bodies outside fields are neither fetched nor decoded, and are None on the returned requests.
+        Threat levels and types are those stored by the last classification, and are never recomputed here.
+        """
+        query, variables = self.request_page_query(conditions, variables, limit, descending, after, fields)
+        with self.cursor() as cur:
+            cur.execute(query, variables)
+            rows = cur.fetchall()
+
+        return [
+            IncomingRequest(row[4]).from_components(
+                host=row[0],
                 timestamp=row[1],
                 request_method=row[2],
-                request_body=loads(row[3]),
-                request_headers=loads(row[4]),
-                query_string=row[5],
-                request_uri=row[8],
-                request_id=row[-1],
+                request_headers=row[10],
+                request_body=row[11],
+                query_string=row[3],
+                request_uri=row[5],
+                request_id=row[6],
                 threat_level=row[7],
-            )
-            incoming_request.determine_threat_level()
-            r.append(incoming_request)
-        return sorted(r, key=lambda x: x.timestamp, reverse=True)
+                request_types=row[8],
+                attack_types=row[9],
+            ) for row in rows
+        ]
+
+    @staticmethod
+    def request_page_query(conditions: List[str], variables: List[Any], limit: int, descending: bool,
+                           after: Optional[List[Any]], fields: Tuple[str, ...]) -> Tuple[str, Tuple[Any, ...]]:
+        """
+        Builds the query behind get_request_page, selecting (host, timestamp, method, query_string, port, path,
+        request_id, threat_level, request_types, attack_types, headers, body) rows.
+        """
+        if after is not None and len(after) != 2:
+            raise ValueError("Cursor must hold a timestamp and a request_id.")
+        if unknown := set(fields) - set(REQUEST_DETAIL_FIELDS):
+            raise ValueError(f"Unknown request fields: {', '.join(sorted(unknown))}.")
+        details = "".join(f', "requests"."{field}"' if field in fields else ", NULL" for field in REQUEST_DETAIL_FIELDS)
+        direction = "DESC" if descending else "ASC"
+        if after:
+            # the plain timestamp bound lets the planner prune partitions, which the row comparison alone does not
+            conditions = conditions + [
+                f'"requests"."timestamp" {"<=" if descending else ">="} %s::timestamp',
+                f'("requests"."timestamp", "requests"."request_id") {"<" if descending else ">"} (%s::timestamp, %s)']
+            variables = variables + [after[0], *after]
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return f"""
+            SELECT "actors"."host", "requests"."timestamp", "requests"."method", "requests"."query_string",
+                   "requests"."port", "requests"."path", "requests"."request_id", "requests"."threat_level",
+                   "requests"."request_types", "requests"."attack_types"{details}
+            FROM "requests"
+            JOIN "actors" ON "actors"."actor_id" = "requests"."actor_id"
+            {where}
+            ORDER BY "requests"."timestamp" {direction}, "requests"."request_id" {direction}
+            LIMIT %s
+        """, (*variables, limit)
+
+    def stream_requests(self, actor_id: Optional[int] = None, endpoint: Optional[str] = None,
+                        start: Optional[datetime] = None, end: Optional[datetime] = None,
+                        batch_size: int = 2_000) -> Iterator[Tuple]:
+        """
+        Yields (request_id, host, timestamp, method, path, query_string, headers, body, port, acceptable, threat_level)
+        rows in request_id order from a server-side cursor, so only batch_size rows are held in memory at a time.
+        headers and body are returned as JSON text. The connection stays checked out until the generator is exhausted
+        or closed.
+        """
+        conditions, variables = [], []
+        if actor_id is not None:
+            conditions.append("r.actor_id = %s")
+            variables.append(actor_id)
+        if endpoint is not None:
+            conditions.append("r.path = %s")
+            variables.append(endpoint)
+        if start is not None:
+            conditions.append("r.timestamp >= %s")
+            variables.append(start)
+        if end is not None:
+            conditions.append("r.timestamp < %s")
+            variables.append(end)
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+
+        with self.connection() as conn, conn.cursor(name=f"export_{uuid4().hex}") as cur:
+            cur.itersize = batch_size
+            cur.execute("SELECT r.request_id, a.host, r.timestamp, r.method, r.path, r.query_string, r.headers::text, "
+                        "r.body::text, r.port, r.acceptable, r.threat_level "
+                        "FROM requests r JOIN actors a ON a.actor_id = r.actor_id "
+                        f"{where}ORDER BY r.request_id", variables)
+            yield from cur
 
     def connect_target_exists(self, url: str) -> bool:
-        self.execute("SELECT EXISTS(SELECT connect_target_id FROM connect_targets WHERE url = %s)", (url,))
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT EXISTS(SELECT connect_target_id FROM connect_targets WHERE url = %s)", (url,))
+            return cur.fetchone()[0]
 
     def insert_connect_target(self, url: str, body: str) -> None:
         if self.connect_target_exists(url):
             return
 
-        self.execute("INSERT INTO connect_targets (url, body) VALUES (%s, %s)", (url, body))
-        self._conn.commit()
+        with self.cursor() as cur:
+            cur.execute("INSERT INTO connect_targets (url, body) VALUES (%s, %s)", (url, body))
 
     def get_connect_target(self, url: str) -> str:
-        self.execute("SELECT body FROM connect_targets WHERE url = %s", (url,))
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT body FROM connect_targets WHERE url = %s", (url,))
+            return cur.fetchone()[0]
 
     def search(self, actor_id: Optional[int] = None,
                uri: Optional[str] = None,
@@ -237,150 +847,354 @@ class DatabaseHandler(cursor):
                body: Optional[str] = None,
                all_must_match: bool = False,
                case_sensitive: bool = False,
+               full_text: bool = False,
+               has_header: Optional[str] = None,
+               header_contains: Optional[Dict[str, str]] = None,
+               body_contains: Optional[Dict[str, Any]] = None,
+               limit: int = 100,
+               descending: bool = True,
+               after: Optional[List[Any]] = None,
+               fields: Tuple[str, ...] = REQUEST_DETAIL_FIELDS,
                ) -> List[IncomingRequest]:
-        query = ("SELECT actor_id, timestamp, method, body, headers, query_string, port, acceptable, path, request_id "
-                 "FROM requests")
+        """
+        Substring filters are matched with LIKE/ILIKE '%term%' predicates, which the pg_trgm GIN indexes from
+        scripts/migrations/005_search_indexes.sql can serve. With full_text, headers and body match whole tokens
+        through their tsvector indexes instead, and case_sensitive does not apply to them.
+        has_header, header_contains and body_contains are key-existence and containment queries served by the JSONB
+        GIN indexes from scripts/migrations/006_jsonb_headers_body.sql.
+        """
+        like = "LIKE" if case_sensitive else "ILIKE"
         conditions = []
         variables = []
         if actor_id:
-            conditions.append("actor_id = %s")
+            conditions.append('"requests"."actor_id" = %s')
             variables.append(actor_id)
         if uri:
-            conditions.append(f"path {'LIKE' if case_sensitive else 'ILIKE'} %s")
-            variables.append(f"%{uri}%")
+            conditions.append(f'"requests"."path" {like} %s')
+            variables.append(self.contains_pattern(uri))
         if method:
-            conditions.append(f"method {'LIKE' if case_sensitive else 'ILIKE'} %s")
-            variables.append(f"%{method}%")
+            conditions.append(f'"requests"."method" {like} %s')
+            variables.append(self.contains_pattern(method))
         if threat_level:
-            conditions.append("threat_level = %s")
+            conditions.append('"requests"."threat_level" = %s')
             variables.append(threat_level)
         if acceptable is not None:
-            conditions.append("acceptable = %s")
+            conditions.append('"requests"."acceptable" = %s')
             variables.append(acceptable)
         if host:
-            conditions.append(
-                f"actor_id IN (SELECT actor_id FROM actors WHERE host {'LIKE' if not case_sensitive else 'ILIKE'} %s)")
-            variables.append(f"%{host}%")
-        if headers:
-            conditions.append(f"headers {'LIKE' if case_sensitive else 'ILIKE'} %s")
-            variables.append(f"%{headers}%")
+            conditions.append(f'"actors"."host" {like} %s')
+            variables.append(self.contains_pattern(host))
+        for column, term in (("headers", headers), ("body", body)):
+            if not term:
+                continue
+            if full_text:
+                # must match the indexed expressions exactly for the planner to use them
+                conditions.append(f"to_tsvector('simple', requests.{column}) @@ plainto_tsquery('simple', %s)")
+                variables.append(term)
+            else:
+                conditions.append(f'"requests"."{column}"::text {like} %s')
+                variables.append(self.contains_pattern(term))
         if query_string:
-            conditions.append(f"query_string {'LIKE' if case_sensitive else 'ILIKE'} %s")
-            variables.append(f"%{query_string}%")
-        if body:
-            conditions.append(f"body {'LIKE' if case_sensitive else 'ILIKE'} %s")
-            variables.append(f"%{body}%")
+            conditions.append(f'"requests"."query_string" {like} %s')
+            variables.append(self.contains_pattern(query_string))
+        if has_header:
+            # werkzeug stores header names title-cased, as in X-Forwarded-Host
+            conditions.append('"requests"."headers" ? %s')
+            variables.append(has_header.title())
+        if header_contains:
+            conditions.append('"requests"."headers" @> %s')
+            variables.append(Json({key.title(): value for key, value in header_contains.items()}))
+        if body_contains:
+            conditions.append('"requests"."body" @> %s')
+            variables.append(Json(body_contains))
+
+        if conditions and not all_must_match:
+            conditions = [f"({' OR '.join(conditions)})"]
+        return self.get_request_page(conditions, variables, limit, descending, after, fields)
+
+    @staticmethod
+    def contains_pattern(term: str) -> str:
+        """Escapes LIKE wildcards in term, so that it is matched literally anywhere in the column."""
+        return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+    # classification
+    def register_flag_set(self, version: str, flag_data: Dict[str, List[Dict[str, Any]]]) -> bool:
+        """Records a flag set, returning whether every request has already been reclassified with it."""
+        with self.cursor() as cur:
+            cur.execute("INSERT INTO flag_sets (version, flags) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                        (version, Json(flag_data)))
+            cur.execute("SELECT reclassified IS NOT NULL FROM flag_sets WHERE version = %s", (version,))
+            return cur.fetchone()[0]
+
+    def get_last_reclassified_flag_set(self, exclude_version: str
+                                       ) -> Optional[Tuple[str, Dict[str, List[Dict[str, Any]]]]]:
+        with self.cursor() as cur:
+            cur.execute("SELECT version, flags FROM flag_sets WHERE reclassified IS NOT NULL AND version != %s "
+                        "ORDER BY reclassified DESC LIMIT 1", (exclude_version,))
+            return cur.fetchone()
 
+    def mark_flag_set_reclassified(self, version: str) -> None:
+        with self.cursor() as cur:
+            cur.execute("UPDATE flag_sets SET reclassified = NOW() WHERE version = %s", (version,))
+
+    def enqueue_reclassification(self, version: str, added: Dict[str, Set[str]], changed: Dict[str, Set[str]]) -> int:
+        """
+        Queues the requests a flag set change can affect, and any never classified, returning how many were queued.
+        Requests that matched a changed or removed flag are found through request_flags. Added flags have no matches
+        recorded yet, so requests containing them are found with the same LIKE predicates search uses; this may
+        over-select, but reclassification only ever writes what the flag matcher decides.
+        """
+        candidates, variables = ['SELECT "request_id" FROM "requests" WHERE "flags_version" IS NULL'], []
+        for kind, flags in changed.items():
+            if flags:
+                candidates.append('SELECT "request_id" FROM "request_flags" WHERE "kind" = %s AND "flag" = ANY(%s)')
+                variables.extend((kind, list(flags)))
+
+        conditions = []
+        for flag in sorted(added.get("payload", ())):
+            conditions.append('"path" LIKE %s OR "query_string" LIKE %s')
+            variables.extend((self.contains_pattern(flag), self.contains_pattern(flag)))
+        for flag in sorted(added.get("user_agent", ())):
+            # headers are matched as JSON text, so the flag must be escaped the way jsonb prints strings
+            conditions.append('"headers"::text LIKE %s')
+            variables.append(self.contains_pattern(dumps(flag, ensure_ascii=False)[1:-1]))
         if conditions:
-            separator = " AND " if all_must_match else " OR "
-            query += " WHERE " + separator.join(conditions)
-
-        self.execute(query, variables)
-        requests = self.fetchall()
-        r = []
-        for row in requests:
-            self.execute("SELECT host FROM actors WHERE actor_id = %s", (row[0],))
-            host = RemoteHost(self.fetchone()[0])
-            incoming_request = (IncomingRequest(row[6])
-            .from_components(
-                request_method=row[2], request_body=loads(row[3]), threat_level=row[7], request_headers=loads(row[4]),
-                timestamp=row[1], query_string=row[5], request_uri=row[8], request_id=row[-1], host=host.address)
-            )
-            incoming_request.determine_threat_level()
-            r.append(incoming_request)
-        return sorted(r, key=lambda x: x.timestamp, reverse=True)
+            candidates.append(f'SELECT "request_id" FROM "requests" WHERE {" OR ".join(conditions)}')
+
+        with self.cursor() as cur:
+            cur.execute(f"""
+                INSERT INTO "reclassify_queue" ("request_id")
+                SELECT "requests"."request_id"
+                FROM "requests"
+                WHERE "requests"."request_id" IN ({" UNION ".join(candidates)})
+                  AND "requests"."flags_version" IS DISTINCT FROM %s
+                ON CONFLICT DO NOTHING
+            """, (*variables, version))
+            return cur.rowcount
+
+    def enqueue_all_reclassification(self, version: str) -> int:
+        """Queues every request not classified with version, for when there is no earlier flag set to compare with."""
+        with self.cursor() as cur:
+            cur.execute('INSERT INTO "reclassify_queue" ("request_id") SELECT "request_id" FROM "requests" '
+                        'WHERE "flags_version" IS DISTINCT FROM %s ON CONFLICT DO NOTHING', (version,))
+            return cur.rowcount
+
+    def reclassify_batch(self, batch_size: int = 1000) -> int:
+        """
+        Takes up to batch_size requests off the reclassification queue and stores their classification under the
+        currently loaded flags, in one transaction. Locked queue rows are skipped, so several workers can drain the
+        queue at once. Returns the number of requests taken, which is 0 once the queue is empty.
+        """
+        with self.cursor() as cur:
+            cur.execute("""
+                DELETE FROM "reclassify_queue"
+                WHERE "request_id" IN (
+                    SELECT "request_id" FROM "reclassify_queue" ORDER BY "request_id" LIMIT %s FOR UPDATE SKIP LOCKED
+                )
+                RETURNING "request_id"
+            """, (batch_size,))
+            request_ids = [row[0] for row in cur.fetchall()]
+            if not request_ids:
+                return 0
+
+            cur.execute(f'SELECT {CLASSIFICATION_COLUMNS} FROM "requests" WHERE "requests"."request_id" = ANY(%s)',
+                        (request_ids,))
+            self.store_classifications(cur, classify_rows(cur.fetchall()))
+        return len(request_ids)
+
+    def stream_classification_rows(self, after_request_id: int = 0, batch_size: int = 5_000) -> Iterator[Tuple]:
+        """
+        Yields the rows classify_rows takes for requests after after_request_id, in request_id order from a
+        server-side cursor. The connection stays checked out until the generator is exhausted or closed.
+        """
+        with self.connection() as conn, conn.cursor(name=f"rescore_{uuid4().hex}") as cur:
+            cur.itersize = batch_size
+            cur.execute(f'SELECT {CLASSIFICATION_COLUMNS} FROM "requests" WHERE "requests"."request_id" > %s '
+                        'ORDER BY "requests"."request_id"', (after_request_id,))
+            yield from cur
+
+    def save_classifications(self, classified: List[Tuple], version: str, last_request_id: int) -> None:
+        """Stores classify_rows output and advances the rescore checkpoint for version in the same transaction."""
+        with self.cursor() as cur:
+            self.store_classifications(cur, classified)
+            cur.execute("""
+                INSERT INTO "rescore_checkpoints" ("flags_version", "last_request_id") VALUES (%s, %s)
+                ON CONFLICT ("flags_version") DO UPDATE SET "last_request_id" = EXCLUDED."last_request_id",
+                                                            "updated" = NOW()
+            """, (version, last_request_id))
+
+    def get_rescore_checkpoint(self, version: str) -> int:
+        with self.cursor() as cur:
+            cur.execute('SELECT "last_request_id" FROM "rescore_checkpoints" WHERE "flags_version" = %s', (version,))
+            result = cur.fetchone()
+        return result[0] if result else 0
+
+    def clear_rescore_checkpoint(self, version: str) -> None:
+        with self.cursor() as cur:
+            cur.execute('DELETE FROM "rescore_checkpoints" WHERE "flags_version" = %s', (version,))
+
+    @staticmethod
+    def store_classifications(cur: cursor, classified: List[Tuple]) -> None:
+        """
+        Writes (request_id, threat_level, request_types, attack_types, flags_version, matched_flags) rows from
+        classify_rows with one UPDATE ... FROM (VALUES ...), replacing the matched flags recorded for each request, and
+        brings max_threat_level in endpoint_stats in line with the new scores.
+        """
+        if not classified:
+            return
+        cur.execute('SELECT "request_id", "path", "threat_level" FROM "requests" WHERE "request_id" = ANY(%s)',
+                    ([row[0] for row in classified],))
+        previous = {request_id: (path, threat_level) for request_id, path, threat_level in cur.fetchall()}
+        execute_values(cur, """
+            UPDATE "requests" SET "threat_level" = "classified"."threat_level",
+                                  "request_types" = "classified"."request_types",
+                                  "attack_types" = "classified"."attack_types",
+                                  "flags_version" = "classified"."flags_version"
+            FROM (VALUES %s) AS "classified" ("request_id", "threat_level", "request_types", "attack_types",
+                                              "flags_version")
+            WHERE "requests"."request_id" = "classified"."request_id"
+        """, [row[:5] for row in classified], template="(%s, %s, %s::text[], %s::text[], %s)",
+                       page_size=len(classified))
+        request_ids = [row[0] for row in classified]
+        cur.execute('DELETE FROM "request_flags" WHERE "request_id" = ANY(%s)', (request_ids,))
+        DatabaseHandler.insert_request_flags(
+            cur, [(kind, flag, request_id) for request_id, *_, matched_flags in classified
+                  for kind, flag in matched_flags])
+
+        # per path, the highest new score and the highest old score that went down; a path whose stored maximum is
+        # above every lowered score keeps it or is raised, and the rest are recomputed from requests and rollups
+        changed = {}
+        for request_id, threat_level, *_ in classified:
+            if (row := previous.get(request_id)) is None:
+                continue
+            path, previous_level = row
+            raised, lowered = changed.get(path, (0, -1))
+            if threat_level < previous_level:
+                lowered = max(lowered, previous_level)
+            changed[path] = (max(raised, threat_level), lowered)
+        if not changed:
+            return
+        # rows are locked in sorted order so that concurrent batches cannot deadlock
+        cur.execute('SELECT 1 FROM "endpoint_stats" WHERE "path" = ANY(%s) ORDER BY "path" FOR UPDATE',
+                    (sorted(changed),))
+        execute_values(cur, """
+            UPDATE "endpoint_stats" SET "max_threat_level" = CASE
+                WHEN "endpoint_stats"."max_threat_level" > "changed"."lowered"
+                THEN GREATEST("endpoint_stats"."max_threat_level", "changed"."raised")
+                ELSE GREATEST(
+                    (SELECT COALESCE(MAX("threat_level"), 0) FROM "requests"
+                     WHERE "requests"."path" = "endpoint_stats"."path"),
+                    (SELECT COALESCE(MAX("max_threat_level"), 0) FROM "request_rollups"
+                     WHERE "request_rollups"."path" = "endpoint_stats"."path"))
+            END
+            FROM (VALUES %s) AS "changed" ("path", "raised", "lowered")
+            WHERE "endpoint_stats"."path" = "changed"."path"
+        """, [(path, raised, lowered) for path, (raised, lowered) in sorted(changed.items())],
+                       page_size=len(changed))
 
     # stats
     def get_request_count(self) -> int:
-        self.execute("SELECT COUNT(request_id) FROM requests")
-        return self.fetchone()[0]
+        """Counts every request ever stored, including those removed by apply_retention, from endpoint_stats."""
+        with self.cursor() as cur:
+            cur.execute("SELECT COALESCE(SUM(hits), 0)::BIGINT FROM endpoint_stats")
+            return cur.fetchone()[0]
 
     def get_actor_count(self) -> int:
-        self.execute("SELECT COUNT(actor_id) FROM actors")
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT COUNT(actor_id) FROM actors")
+            return cur.fetchone()[0]
 
     def get_endpoint_count(self) -> int:
-        self.execute("SELECT COUNT(DISTINCT path) FROM requests")
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM endpoint_stats")
+            return cur.fetchone()[0]
 
     def get_last_request_time(self) -> datetime:
-        self.execute("SELECT timestamp FROM requests ORDER BY timestamp DESC LIMIT 1")
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT timestamp FROM requests ORDER BY timestamp DESC LIMIT 1")
+            return cur.fetchone()[0]
 
     def get_last_actor(self) -> Tuple[str, str]:
-        self.execute("SELECT actor_id, host FROM actors ORDER BY actor_id DESC LIMIT 1")
-        actor_id, host = self.fetchone()
-        self.execute("SELECT timestamp FROM requests WHERE actor_id = %s ORDER BY timestamp DESC LIMIT 1", (actor_id,))
-        result = self.fetchone()
+        with self.cursor() as cur:
+            cur.execute("SELECT actor_id, host FROM actors ORDER BY actor_id DESC LIMIT 1")
+            actor_id, host = cur.fetchone()
+            cur.execute("SELECT timestamp FROM requests WHERE actor_id = %s ORDER BY timestamp DESC LIMIT 1",
+                        (actor_id,))
+            result = cur.fetchone()
         if not result:
             return host, "Unknown"
         return result[0], host
 
     def get_last_endpoint(self) -> Tuple[Any, ...]:
-        self.execute("""
-            SELECT "requests"."method", "unique_paths"."path", "requests"."threat_level"
-            FROM (
-                SELECT "path", COUNT(*) AS "count"
-                FROM "requests"
-                GROUP BY "path"
-                HAVING COUNT(*) = 1
-            ) AS unique_paths
-            JOIN "requests" ON "unique_paths"."path" = "requests"."path"
-            ORDER BY "requests"."request_id" DESC
-            LIMIT 1;
-        """)
-        return self.fetchone()
+        with self.cursor() as cur:
+            # an endpoint hit exactly once has its only request's method and threat level stored alongside it
+            cur.execute("""
+                SELECT "last_method", "path", "max_threat_level"
+                FROM "endpoint_stats"
+                WHERE "hits" = 1
+                ORDER BY "last_seen" DESC
+                LIMIT 1;
+            """)
+            return cur.fetchone()
 
-    def get_average_time_between_requests(self) -> float:
-        self.execute("""
-            SELECT AVG("time_diff")
-            FROM (
-                SELECT "timestamp" - LAG("timestamp", 1) OVER (ORDER BY "timestamp") AS "time_diff"
-                FROM "requests"
-            ) AS "time_diffs"
-            WHERE "time_diff" IS NOT NULL;
-        """)
-        return self.fetchone()[0]
+    def get_average_time_between_requests(self) -> timedelta:
+        with self.cursor() as cur:
+            # the gaps between consecutive requests sum to the span from the first to the last, so their average comes
+            # from the per-endpoint first_seen, last_seen and hits kept by update_endpoint_stats
+            cur.execute("""
+                SELECT (MAX("last_seen") - MIN("first_seen")) / NULLIF(SUM("hits") - 1, 0)
+                FROM "endpoint_stats";
+            """)
+            return cur.fetchone()[0]
 
     def generate_admin_key(self) -> str:
         key = str(uuid4())
-        self.execute("INSERT INTO admin_keys (key) VALUES (%s)", (key,))
-        self._conn.commit()
+        with self.cursor() as cur:
+            cur.execute("INSERT INTO admin_keys (key) VALUES (%s)", (key,))
         return key
 
     def generate_admin_session_token(self, admin_username: str) -> str:
-        self.execute("SELECT admin_id FROM admins WHERE username = %s", (admin_username,))
-        admin_id = self.fetchone()[0]
         token = str(uuid4())
-        self.execute("INSERT INTO admin_sessions (token, admin_id) VALUES (%s, %s)", (token, admin_id))
-        self._conn.commit()
+        with self.cursor() as cur:
+            cur.execute("SELECT admin_id FROM admins WHERE username = %s", (admin_username,))
+            admin_id = cur.fetchone()[0]
+            cur.execute("INSERT INTO admin_sessions (token, admin_id) VALUES (%s, %s)", (token, admin_id))
         return token
 
     def validate_session_token(self, token: str) -> bool:
-        self.execute("SELECT EXISTS(SELECT token FROM admin_sessions WHERE token = %s)", (token,))
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT EXISTS(SELECT token FROM admin_sessions WHERE token = %s)", (token,))
+            return cur.fetchone()[0]
 
     def validate_and_delete_registration_key(self, key: str) -> bool:
-        self.execute("SELECT EXISTS(SELECT key FROM admin_keys WHERE key = %s)", (key,))
-        if not self.fetchone()[0]:
-            return False
-        self.execute("DELETE FROM admin_keys WHERE key = %s", (key,))
-        self._conn.commit()
-        return True
+        with self.cursor() as cur:
+            cur.execute("DELETE FROM admin_keys WHERE key = %s", (key,))
+            return cur.rowcount > 0
 
     def add_admin(self, username: str, password: str):
-        self.execute("INSERT INTO admins (username, password) VALUES (%s, %s)",
-                     (username, self.hash_password(password)))
-        self._conn.commit()
+        with self.cursor() as cur:
+            cur.execute("INSERT INTO admins (username, password) VALUES (%s, %s)",
+                        (username, self.hash_password(password)))
 
     def validate_admin_credentials(self, username: str, password: str) -> bool:
-        self.execute("SELECT EXISTS(SELECT username FROM admins WHERE username = %s AND password = %s)",
-                     (username, self.hash_password(password)))
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT EXISTS(SELECT username FROM admins WHERE username = %s AND password = %s)",
+                        (username, self.hash_password(password)))
+            return cur.fetchone()[0]
 
     def username_exists(self, username: str) -> bool:
-        self.execute("SELECT EXISTS(SELECT username FROM admins WHERE username = %s)", (username,))
-        return self.fetchone()[0]
+        with self.cursor() as cur:
+            cur.execute("SELECT EXISTS(SELECT username FROM admins WHERE username = %s)", (username,))
+            return cur.fetchone()[0]
+
+    @property
+    def actor_cache_stats(self) -> Dict[str, int]:
+        return self._actor_cache.stats
+
+    @property
+    def honeypot_version(self) -> int:
+        """Incremented each time the honeypot cache is reloaded."""
+        return self._honeypot_cache.version
 
     @staticmethod
     def hash_password(password: str) -> str:
@@ -0,0 +1,80 @@
+from csv import writer
+from io import StringIO
+from itertools import islice
+from json import dumps
+from typing import Iterable, Iterator, Tuple
+from zlib import compressobj
+
+from flask import Response
+
+EXPORT_COLUMNS = ("request_id", "origin_host", "timestamp", "method", "path", "query_string", "headers", "body",
+                  "port", "acceptable", "threat_level")
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def batched(rows: Iterable[Tuple], batch_size: int) -> Iterator[Tuple[Tuple, ...]]:
+    rows = iter(rows)
+    while batch := tuple(islice(rows, batch_size)):
+        yield batch
+
+
+def csv_chunks(rows: Iterable[Tuple], batch_size: int) -> Iterator[str]:
+    """Serialises rows as CSV, yielding one string per batch_size rows. headers and body stay JSON encoded."""
+    buffer = StringIO()
+    csv_writer = writer(buffer)
+    csv_writer.writerow(EXPORT_COLUMNS)
+    for batch in batched(rows, batch_size):
+        csv_writer.writerows(
+            (row[0], row[1], row[2].isoformat(), *row[3:]) for row in batch
+        )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def ndjson_chunks(rows: Iterable[Tuple], batch_size: int) -> Iterator[str]:
+    for batch in batched(rows, batch_size):
+        # headers and body arrive as JSON text from the JSONB columns, and are spliced in without decoding
+        yield "".join(
+            dumps({
+                "request_id": row[0],
+                "origin_host": row[1],
+                "timestamp": row[2].isoformat(),
+                "method": row[3],
+                "path": row[4],
+                "query_string": row[5],
+                "port": row[8],
+                "acceptable": row[9],
+                "threat_level": row[10],
+            })[:-1] + f', "headers": {row[6] or "null"}, "body": {row[7] or "null"}}}\n' for row in batch
+        )
+
+
+def gzip_chunks(chunks: Iterable[str]) -> Iterator[bytes]:
+    compressor = compressobj(wbits=31)  # 16 + MAX_WBITS writes a gzip header and trailer
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk.encode()):
+            yield compressed
+    yield compressor.flush()
+
+
+def export_response(rows: Iterable[Tuple], export_format: str, file_name: str, compress: bool = False,
+                    batch_size: int = 2_000) -> Response:
+    """
+    Builds a streamed download of rows from DatabaseHandler.stream_requests. Rows are serialised and, optionally,
+    gzipped one batch at a time as the client reads, so memory use does not grow with the size of the export.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Format must be one of {', '.join(EXPORT_FORMATS)}.")
+
+    chunks = (csv_chunks if export_format == "csv" else ndjson_chunks)(rows, batch_size)
+    file_name = f"{file_name}.{export_format}"
+    if compress:
+        return Response(gzip_chunks(chunks), content_type="application/gzip", headers={
+            "Content-Disposition": f"attachment; filename={file_name}.gz"
+        })
+    return Response((chunk.encode() for chunk in chunks), content_type=EXPORT_FORMATS[export_format], headers={
+        "Content-Disposition": f"attachment; filename={file_name}"
+    })
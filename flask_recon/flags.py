@@ -1,6 +1,10 @@
+from collections import deque
 from enum import Enum
+from hashlib import sha256
 from json import loads
-from typing import List, Any, Dict, Optional
+from typing import List, Any, Dict, Optional, Tuple, Set
+
+FLAG_KINDS = ("payload", "user_agent")
 
 
 class AttackType(Enum):
@@ -94,19 +98,91 @@ class Flag:
         return self._attack_types
 
 
+class FlagMatcher:
+    """Aho-Corasick automaton over a list of flags, finding every flag contained in a value in one pass."""
+    _flags: List[Flag]
+    _transitions: List[Dict[str, int]]
+    _failures: List[int]
+    _outputs: List[Tuple[int, ...]]
+
+    def __init__(self, flags: List[Flag]):
+        self._flags = flags
+        self._transitions = [{}]
+        self._failures = [0]
+        self._outputs = [()]
+        self.compile()
+
+    def compile(self) -> None:
+        for index, flag in enumerate(self._flags):
+            state = 0
+            for char in flag.flag:
+                if (next_state := self._transitions[state].get(char)) is None:
+                    next_state = len(self._transitions)
+                    self._transitions[state][char] = next_state
+                    self._transitions.append({})
+                    self._failures.append(0)
+                    self._outputs.append(())
+                state = next_state
+            self._outputs[state] += (index,)
+
+        queue = deque(self._transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._transitions[state].items():
+                queue.append(next_state)
+                failure = self._failures[state]
+                while failure and char not in self._transitions[failure]:
+                    failure = self._failures[failure]
+                failure = self._transitions[failure].get(char, 0)
+                self._failures[next_state] = failure
+                self._outputs[next_state] += self._outputs[failure]
+
+    def match(self, value: str) -> List[Flag]:
+        """Returns the flags contained in value, in the order they appear in the flag list."""
+        return [self._flags[index] for index in self.match_indices(value)]
+
+    def match_indices(self, value: str) -> List[int]:
+        """Returns the indices into the flag list of the flags contained in value, in ascending order."""
+        transitions, failures, outputs = self._transitions, self._failures, self._outputs
+        found = set(outputs[0])
+        state = 0
+        for char in value:
+            while state and char not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(char, 0)
+            if outputs[state]:
+                found.update(outputs[state])
+        return sorted(found)
+
+    @property
+    def flags(self) -> List[Flag]:
+        return self._flags
+
+
 class KnownFlags:
     _flags_file: str
-    _payload_flags: List[Flag] = []
-    _ua_flags: List[Flag] = []
+    _flag_data: Dict[str, List[Dict[str, Any]]]
+    _version: str
+    _payload_flags: List[Flag]
+    _ua_flags: List[Flag]
+    _payload_matcher: FlagMatcher
+    _ua_matcher: FlagMatcher
 
     def __init__(self, flags_file: str):
         self._flags_file = flags_file
         self.load_flags()
 
     def load_flags(self):
-        flag_data = loads(open(self._flags_file).read())
-        self.add_flags(flag_data["payload"], self._payload_flags)
-        self.add_flags(flag_data["user_agent"], self._ua_flags)
+        contents = open(self._flags_file, "rb").read()
+        flag_data = loads(contents)
+        payload_flags, ua_flags = [], []
+        self.add_flags(flag_data["payload"], payload_flags)
+        self.add_flags(flag_data["user_agent"], ua_flags)
+        self._payload_matcher = FlagMatcher(payload_flags)
+        self._ua_matcher = FlagMatcher(ua_flags)
+        self._payload_flags, self._ua_flags = payload_flags, ua_flags
+        self._flag_data = flag_data
+        self._version = sha256(contents).hexdigest()
 
     @staticmethod
     def add_flags(flags: List[Dict[str, Any]], target: List[Flag]) -> None:
@@ -124,5 +200,43 @@ class KnownFlags:
     def known_ua_flags(self) -> List[Flag]:
         return self._ua_flags
 
+    @property
+    def payload_matcher(self) -> FlagMatcher:
+        return self._payload_matcher
+
+    @property
+    def ua_matcher(self) -> FlagMatcher:
+        return self._ua_matcher
+
+    @property
+    def flags_file(self) -> str:
+        return self._flags_file
+
+    @property
+    def flag_data(self) -> Dict[str, List[Dict[str, Any]]]:
+        return self._flag_data
+
+    @property
+    def version(self) -> str:
+        """sha256 of the flags file, recorded against every request classified with this flag set."""
+        return self._version
+
+
+def diff_flag_sets(old: Dict[str, List[Dict[str, Any]]], new: Dict[str, List[Dict[str, Any]]]
+                   ) -> Tuple[Dict[str, Set[str]], Dict[str, Set[str]]]:
+    """
+    Compares two flag files, returning (added, changed) flag strings by kind. changed holds flags that were removed or
+    redefined, whose matches are known from the request_flags table. Added flags have never been matched.
+    """
+    added, changed = {}, {}
+    for kind in FLAG_KINDS:
+        old_flags, new_flags = {}, {}
+        for flags, target in ((old.get(kind, []), old_flags), (new.get(kind, []), new_flags)):
+            for flag in flags:
+                target.setdefault(flag["flag"], []).append(flag)
+        added[kind] = new_flags.keys() - old_flags.keys()
+        changed[kind] = {flag for flag, definitions in old_flags.items() if new_flags.get(flag) != definitions}
+    return added, changed
+
 
 KNOWN_FLAGS = KnownFlags("static/flags.json")
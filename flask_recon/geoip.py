@@ -0,0 +1,282 @@
+from array import array
+from bisect import bisect_right
+from csv import DictReader
+from ipaddress import ip_address, ip_network
+from mmap import mmap, ACCESS_READ
+from os import getpid, replace
+from os.path import exists, getmtime
+from socket import inet_pton, AF_INET, AF_INET6
+from struct import Struct
+from sys import byteorder
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import maxminddb
+except ImportError:  # only needed to compile MMDB datasets
+    maxminddb = None
+
+# (country code, ASN, AS organisation), any of which may be unknown
+GeoInfo = Tuple[Optional[str], Optional[int], Optional[str]]
+GeoRange = Tuple[int, int, int, Optional[str], Optional[int], Optional[str]]
+
+INDEX_MAGIC = b"FRGEOIP1"
+# magic, IPv4 ranges, IPv6 ranges, string table bytes
+INDEX_HEADER = Struct("<8sIIQ")
+IPV4_MAPPED_PREFIX = 0xFFFF
+START_COLUMNS = ("start_ip", "range_start", "ip_start", "network_start", "first_ip")
+END_COLUMNS = ("end_ip", "range_end", "ip_end", "network_end", "last_ip")
+NETWORK_COLUMNS = ("network", "cidr", "prefix")
+COUNTRY_COLUMNS = ("country_code", "country", "iso_code", "country_iso_code")
+ASN_COLUMNS = ("asn", "as_number", "autonomous_system_number")
+ORGANISATION_COLUMNS = ("as_name", "as_organization", "as_organisation", "as_description",
+                        "autonomous_system_organization", "organization")
+UNKNOWN_COUNTRIES = ("", "-", "--", "ZZ", "None")
+# the widths of the actors columns the values are stored in
+MAX_ASN = 0xFFFFFFFF
+MAX_ORGANISATION_LENGTH = 255
+
+
+def parse_address(address: str) -> Tuple[int, int]:
+    """(IP version, address as an integer), with IPv4-mapped IPv6 addresses treated as IPv4. Raises ValueError."""
+    try:
+        if ":" not in address:
+            return 4, int.from_bytes(inet_pton(AF_INET, address), "big")
+        value = int.from_bytes(inet_pton(AF_INET6, address), "big")
+    except (OSError, TypeError):
+        raise ValueError(f"{address} is not an IP address.")
+    if value >> 32 == IPV4_MAPPED_PREFIX:
+        return 4, value & 0xFFFFFFFF
+    return 6, value
+
+
+def parse_asn(value: Any) -> Optional[int]:
+    if value is not None and not isinstance(value, int):
+        value = str(value).strip().upper().removeprefix("AS")
+        value = int(value) if value.isascii() and value.isdigit() else None
+    return value if value is not None and 0 < value <= MAX_ASN else None
+
+
+def parse_country(value: Optional[str]) -> Optional[str]:
+    """The ISO 3166 code in value, or None for unknown codes and anything else, such as a full country name."""
+    value = (value or "").strip().upper()
+    if len(value) != 2 or not value.isascii() or not value.isalpha() or value in UNKNOWN_COUNTRIES:
+        return None
+    return value
+
+
+def read_csv(source: str) -> Iterator[GeoRange]:
+    """
+    Reads (version, start, end, country, asn, organisation) ranges from a comma or tab separated file with a header
+    row, taking each range from start and end address columns or from a CIDR network column. Columns are recognised
+    by the names the common free datasets use.
+    """
+    with open(source, newline="", encoding="utf-8") as file:
+        delimiter = "\t" if "\t" in file.readline() else ","
+        file.seek(0)
+        reader = DictReader(file, delimiter=delimiter)
+        columns = {name.strip().lower(): name for name in reader.fieldnames or ()}
+
+        def column(names: Sequence[str]) -> Optional[str]:
+            return next((columns[name] for name in names if name in columns), None)
+
+        start, end, network = column(START_COLUMNS), column(END_COLUMNS), column(NETWORK_COLUMNS)
+        country, asn, organisation = column(COUNTRY_COLUMNS), column(ASN_COLUMNS), column(ORGANISATION_COLUMNS)
+        if network is None and (start is None or end is None):
+            raise ValueError(f"{source} has neither start and end address columns nor a network column.")
+
+        for row in reader:
+            try:
+                if network is not None:
+                    parsed = ip_network(row[network].strip(), strict=False)
+                    first, last = parsed.network_address, parsed.broadcast_address
+                else:
+                    first, last = ip_address(row[start].strip()), ip_address(row[end].strip())
+            except (ValueError, AttributeError):
+                continue
+            yield (first.version, int(first), int(last), row.get(country) if country else None,
+                   parse_asn(row.get(asn)) if asn else None, row.get(organisation) if organisation else None)
+
+
+def read_mmdb(source: str) -> Iterator[GeoRange]:
+    """Reads ranges from a MaxMind DB file, such as GeoLite2 Country or ASN, through the optional maxminddb package."""
+    if maxminddb is None:
+        raise ImportError("Compiling an MMDB dataset requires the maxminddb package.")
+    with maxminddb.open_database(source) as reader:
+        for network, record in reader:
+            record = record if isinstance(record, dict) else {}
+            country = (record.get("country") or record.get("registered_country") or {}).get("iso_code") \
+                or record.get("country_code")
+            asn = parse_asn(record.get("autonomous_system_number") or record.get("asn"))
+            organisation = record.get("autonomous_system_organization") or record.get("as_name")
+            yield (network.version, int(network.network_address), int(network.broadcast_address), country, asn,
+                   organisation)
+
+
+def build_index(source: str, destination: str) -> int:
+    """
+    Compiles a CSV or MMDB dataset into an index file for GeoIndex, returning the number of ranges kept. Ranges are
+    sorted by start address, and a range overlapping the one before it is skipped. The file is written beside
+    destination and moved over it, so processes opening the index never see it half written.
+    """
+    ranges = {4: [], 6: []}
+    read = read_mmdb if source.endswith(".mmdb") else read_csv
+    for version, start, end, country, asn, organisation in read(source):
+        if version == 6 and start >> 32 == IPV4_MAPPED_PREFIX and end >> 32 == IPV4_MAPPED_PREFIX:
+            version, start, end = 4, start & 0xFFFFFFFF, end & 0xFFFFFFFF
+        country = parse_country(country)
+        # truncated by character rather than by byte, so that a multibyte character is never split
+        organisation = (organisation.strip()[:MAX_ORGANISATION_LENGTH].strip() or None) if organisation else None
+        if start <= end and (country or asn or organisation):
+            ranges[version].append((start, end, country, asn, organisation))
+
+    # offset 0 of the string table is an empty string, which stands for unknown
+    strings, table = {"": 0}, bytearray(2)
+
+    def string(value: Optional[str]) -> int:
+        if (offset := strings.get(value or "")) is None:
+            encoded = value.encode()
+            offset = strings[value] = len(table)
+            table.extend(len(encoded).to_bytes(2, "little") + encoded)
+        return offset
+
+    sections, kept = {}, 0
+    for version, rows in ranges.items():
+        rows.sort(key=lambda row: (row[0], row[1]))
+        columns = [array("I") for _ in range(2)] if version == 4 else [array("Q") for _ in range(4)]
+        columns += [array("I") for _ in range(3)]
+        previous_end = -1
+        for start, end, country, asn, organisation in rows:
+            if start <= previous_end:
+                continue
+            previous_end = end
+            if version == 4:
+                bounds = (start, end)
+            else:
+                bounds = (start >> 64, start & 0xFFFFFFFFFFFFFFFF, end >> 64, end & 0xFFFFFFFFFFFFFFFF)
+            for values, value in zip(columns, (*bounds, asn or 0, string(country), string(organisation))):
+                values.append(value)
+        sections[version] = columns
+        kept += len(columns[0])
+
+    temporary = f"{destination}.{getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(sections[4][0]), len(sections[6][0]), len(table)))
+        for version in (4, 6):
+            for values in sections[version]:
+                if byteorder == "big":
+                    values.byteswap()
+                file.write(values.tobytes())
+                # keeps every section 8 byte aligned
+                file.write(bytes(-file.tell() % 8))
+        file.write(table)
+    replace(temporary, destination)
+    return kept
+
+
+def compile_index(source: str) -> str:
+    """Path of the index for source, building it first if it is missing or older than source."""
+    destination = f"{source}.idx"
+    if not exists(destination) or getmtime(destination) < getmtime(source):
+        print(f"Compiled {build_index(source, destination)} GeoIP ranges from {source}")
+    return destination
+
+
+class WideKeys:
+    """Read-only sequence of 128-bit integers held as high and low 64-bit halves, for bisect to search."""
+    __slots__ = ("_high", "_low")
+
+    def __init__(self, high: Sequence[int], low: Sequence[int]):
+        self._high = high
+        self._low = low
+
+    def __len__(self) -> int:
+        return len(self._high)
+
+    def __getitem__(self, index: int) -> int:
+        return self._high[index] << 64 | self._low[index]
+
+
+class GeoIndex:
+    """
+    IP range to country and ASN lookups over an index file written by build_index. The file is memory-mapped rather
+    than read, so every process that opens it, pre-forked workers included, shares the same pages of the page cache.
+    Ranges are held as sorted arrays of integer start and end addresses and found by binary search.
+    """
+    _file: Any
+    _map: mmap
+    _views: List[memoryview]
+    _ipv4: Tuple[Sequence[int], ...]
+    _ipv6: Tuple[Sequence[int], ...]
+    _strings: int
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._map = mmap(self._file.fileno(), 0, access=ACCESS_READ)
+        if len(self._map) < INDEX_HEADER.size or self._map[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a GeoIP index.")
+        _, ipv4_count, ipv6_count, _ = INDEX_HEADER.unpack_from(self._map)
+
+        self._views = []
+        offset = INDEX_HEADER.size
+        sections = []
+        for count, codes in ((ipv4_count, "IIIII"), (ipv6_count, "QQQQIII")):
+            section = []
+            for code in codes:
+                values, offset = self.section(offset, count, code)
+                section.append(values)
+            sections.append(tuple(section))
+        self._ipv4, self._ipv6 = sections
+        self._strings = offset
+
+    def section(self, offset: int, count: int, code: str) -> Tuple[Sequence[int], int]:
+        size = count * array(code).itemsize
+        view = memoryview(self._map)[offset:offset + size]
+        self._views.append(view)
+        values = view.cast(code)
+        self._views.append(values)
+        if byteorder == "big":
+            # the index is little-endian, so big-endian machines read a private, swapped copy
+            values = array(code, values)
+            values.byteswap()
+        return values, offset + size + -size % 8
+
+    def lookup(self, address: str) -> Optional[GeoInfo]:
+        """(country, asn, organisation) for the range holding address, or None if it is in no range or invalid."""
+        try:
+            version, value = parse_address(address)
+        except ValueError:
+            return None
+        if version == 4:
+            starts, ends, asns, countries, organisations = self._ipv4
+            index = bisect_right(starts, value) - 1
+            if index < 0 or value > ends[index]:
+                return None
+        else:
+            start_high, start_low, end_high, end_low, asns, countries, organisations = self._ipv6
+            index = bisect_right(WideKeys(start_high, start_low), value) - 1
+            if index < 0 or value > (end_high[index] << 64 | end_low[index]):
+                return None
+        return self.string(countries[index]), asns[index] or None, self.string(organisations[index])
+
+    def string(self, offset: int) -> Optional[str]:
+        if not offset:
+            return None
+        start = self._strings + offset
+        length = int.from_bytes(self._map[start:start + 2], "little")
+        return self._map[start + 2:start + 2 + length].decode()
+
+    def close(self) -> None:
+        # the mmap cannot be closed while views of it exist
+        for view in reversed(getattr(self, "_views", [])):
+            view.release()
+        self._views = []
+        self._map.close()
+        self._file.close()
+
+    def __len__(self) -> int:
+        return len(self._ipv4[0]) + len(self._ipv6[0])
+
+    @property
+    def counts(self) -> Dict[str, int]:
+        return {"ipv4": len(self._ipv4[0]), "ipv6": len(self._ipv6[0])}
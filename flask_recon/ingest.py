@@ -0,0 +1,145 @@
+from queue import Queue, Full, Empty
+from threading import Thread, Event
+from time import monotonic
+from typing import List, Optional, Union
+
+from psycopg2 import OperationalError
+
+from flask_recon.capture import CapturedRequest
+from flask_recon.database import DatabaseHandler
+from flask_recon.spool import SpoolGuard
+from flask_recon.structures import IncomingRequest
+
+
+class IngestionQueue:
+    """
+    Write-behind buffer for captured requests. Requests are queued by the request threads and written by a single
+    background thread in batches, with one commit per batch. Requests queued as raw CapturedRequests are parsed by
+    the same thread just before they are written. queue may be given to read from a queue that other code
+    fills directly, as the writer process of a RequestWriter does. Batches are written through database_handler,
+    which may be a SpoolGuard so that they are spooled when the database is unavailable. Without one, a batch that
+    cannot reach the database is retried with backoff from retry_delay up to max_retry_delay seconds; the queue fills
+    in the meantime, so further requests are refused by submit. A batch still unwritten when the queue is closed is
+    dropped.
+    """
+    _database_handler: Union[DatabaseHandler, SpoolGuard]
+    _queue: Queue
+    _batch_size: int
+    _flush_interval: float
+    _retry_delay: float
+    _max_retry_delay: float
+    _writer: Thread
+    _stopping: Event
+
+    def __init__(self, database_handler: Union[DatabaseHandler, SpoolGuard], batch_size: int = 500,
+                 flush_interval: float = 1.0, max_size: int = 10_000, queue: Optional[Queue] = None,
+                 retry_delay: float = 1.0, max_retry_delay: float = 30.0):
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1.")
+        if flush_interval <= 0:
+            raise ValueError("Flush interval must be positive.")
+
+        self._database_handler = database_handler
+        self._queue = queue if queue is not None else Queue(maxsize=max_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._writer = Thread(target=self.run, name="flask-recon-ingestion", daemon=True)
+        self._stopping = Event()
+
+    def start(self) -> None:
+        self._writer.start()
+
+    def submit(self, request: Union[IncomingRequest, CapturedRequest]) -> bool:
+        """Queues a request for writing. Returns False if the queue is full or closed."""
+        if self._stopping.is_set():
+            return False
+        try:
+            self._queue.put_nowait(request)
+        except Full:
+            return False
+        return True
+
+    def close(self, timeout: float = 30.0) -> None:
+        """Stops accepting requests and waits for everything already queued to be written."""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        if self._writer.is_alive():
+            self._writer.join(timeout)
+
+    def run(self) -> None:
+        while not self._stopping.is_set():
+            self.flush(self.next_batch())
+
+        while batch := self.drain(self._batch_size):
+            self.flush(batch)
+
+    def next_batch(self) -> List[Union[IncomingRequest, CapturedRequest]]:
+        batch = []
+        deadline = monotonic() + self._flush_interval
+        while len(batch) < self._batch_size and not self._stopping.is_set():
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch + self.drain(self._batch_size - len(batch))
+
+    def drain(self, limit: int) -> List[Union[IncomingRequest, CapturedRequest]]:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def flush(self, batch: List[Union[IncomingRequest, CapturedRequest]]) -> None:
+        requests = []
+        for request in batch:
+            if isinstance(request, CapturedRequest):
+                try:
+                    request = request.parse()
+                except Exception as e:
+                    print(f"Failed to parse captured request {request.method} {request.path}: {e}")
+                    continue
+            requests.append(request)
+        if requests:
+            self.write(requests)
+
+    def write(self, requests: List[IncomingRequest]) -> None:
+        """
+        Writes requests in one transaction. If that fails, the batch is split in half and each half retried, so a
+        request the database rejects, such as one with an over-long path, is dropped on its own rather than with the
+        rest of its batch. A batch that fails because the database is unreachable is retried whole until it is
+        written or the queue is closed.
+        """
+        delay = self._retry_delay
+        while True:
+            try:
+                self._database_handler.insert_requests(requests)
+                return
+            except OperationalError as e:
+                if self._stopping.is_set():
+                    print(f"Dropped {len(requests)} requests on shutdown, the database could not be reached: {e}")
+                    return
+                print(f"Failed to write {len(requests)} requests, retrying in {delay:g}s: {e}")
+                # close wakes this early for one last attempt
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self._max_retry_delay)
+            except Exception as e:
+                if len(requests) == 1:
+                    print(f"Failed to write request {requests[0].method.value} {requests[0].uri}: {e}")
+                    return
+                middle = len(requests) // 2
+                self.write(requests[:middle])
+                self.write(requests[middle:])
+                return
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
@@ -0,0 +1,70 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from json import dumps, loads
+from typing import Any, Callable, List, Optional, Tuple
+from urllib.parse import urlencode
+
+from werkzeug.datastructures import MultiDict
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """Encodes the sort key of the last row on a page as an opaque, URL-safe keyset cursor."""
+    return urlsafe_b64encode(dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    values = loads(urlsafe_b64decode(cursor.encode()))
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor.")
+    return values
+
+
+def parse_page_arguments(args: MultiDict) -> Tuple[int, bool, Optional[List[Any]], bool]:
+    """
+    Reads limit, direction and an after or before cursor from query arguments. Returns (limit, descending, cursor,
+    backwards), where a before cursor is turned into a query in the opposite direction whose rows must be reversed by
+    page_cursors. Raises ValueError if any of the arguments are invalid.
+    """
+    limit = int(args.get("limit", DEFAULT_PAGE_SIZE))
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"Limit must be between 1 and {MAX_PAGE_SIZE}.")
+
+    direction = args.get("direction", "desc").lower()
+    if direction not in ("asc", "desc"):
+        raise ValueError("Direction must be asc or desc.")
+
+    after, before = args.get("after"), args.get("before")
+    if after and before:
+        raise ValueError("Only one of after and before can be given.")
+    if before:
+        return limit, direction == "asc", decode_cursor(before), True
+    return limit, direction == "desc", decode_cursor(after) if after else None, False
+
+
+def page_cursors(rows: List[Any], key: Callable[[Any], List[Any]], limit: int, cursor: Optional[List[Any]],
+                 backwards: bool) -> Tuple[List[Any], Optional[str], Optional[str]]:
+    """
+    Puts a page fetched with parse_page_arguments back in display order and returns it with the cursors of the next
+    and previous pages. key returns the sort key of a row.
+    """
+    if backwards:
+        rows = rows[::-1]
+        has_next, has_previous = True, len(rows) == limit
+    else:
+        has_next, has_previous = len(rows) == limit, cursor is not None
+    next_cursor = encode_cursor(key(rows[-1])) if rows and has_next else None
+    previous_cursor = encode_cursor(key(rows[0])) if rows and has_previous else None
+    return rows, next_cursor, previous_cursor
+
+
+def page_query_string(args: MultiDict, name: str, cursor: Optional[str]) -> Optional[str]:
+    """Returns the current query string with the after or before cursor replaced, or None if there is no cursor."""
+    if cursor is None:
+        return None
+    args = MultiDict(args)
+    args.pop("after", None)
+    args.pop("before", None)
+    args[name] = cursor
+    return urlencode(list(args.items(multi=True)))
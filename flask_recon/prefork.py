@@ -0,0 +1,213 @@
+from os import fork, getpid, kill, pipe, read, write, close, waitpid, WNOHANG, _exit, WIFSIGNALED, WTERMSIG, \
+    WEXITSTATUS
+from select import select
+from signal import signal, SIGTERM, SIGINT, SIGHUP, SIGKILL, SIG_IGN, SIG_DFL
+from socket import socket, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from sys import stdout, stderr
+from threading import Thread
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Optional, Tuple
+
+from werkzeug.serving import select_address_family, get_sockaddr
+
+from flask_recon.server import Listener
+from flask_recon.writer import RequestWriter
+
+try:
+    from socket import SO_REUSEPORT
+except ImportError:  # not available on Windows
+    SO_REUSEPORT = None
+
+
+class PreforkServer:
+    """
+    Serves a Listener from workers pre-forked processes. Each worker builds its own Listener from listener_factory, so
+    it has its own database connections, caches and background threads, and binds its own socket to the same address
+    with SO_REUSEPORT, leaving the kernel to spread incoming connections across them. The parent only supervises:
+    workers that die are restarted after restart_delay, SIGHUP starts a new generation of workers and retires the old
+    one once the new one is listening, and SIGTERM or SIGINT stops every worker, killing any still running after
+    shutdown_timeout seconds. With a writer, the writer process is forked and restarted the same way before any
+    worker, and is stopped after the last worker has exited, so that it writes everything they submitted.
+    """
+    _listener_factory: Callable[[], Listener]
+    _host: str
+    _port: int
+    _workers: int
+    _ssl_context: Optional[Tuple[str, str]]
+    _restart_delay: float
+    _shutdown_timeout: float
+    _children: Dict[int, int]
+    _writer: Optional[RequestWriter]
+    _writer_pid: Optional[int] = None
+    _writer_stopping: bool = False
+    _stop_deadline: Optional[float] = None
+    _generation: int = 0
+    _next_restart: float = 0.0
+    _stopping: bool = False
+    _reloading: bool = False
+
+    def __init__(self, listener_factory: Callable[[], Listener], host: str, port: int, workers: int,
+                 ssl_context: Optional[Tuple[str, str]] = None, restart_delay: float = 1.0,
+                 shutdown_timeout: float = 30.0, writer: Optional[RequestWriter] = None):
+        if SO_REUSEPORT is None:
+            raise RuntimeError("Pre-forked workers need SO_REUSEPORT, which this platform does not support.")
+        if workers < 1:
+            raise ValueError("There must be at least 1 worker.")
+
+        self._listener_factory = listener_factory
+        self._host = host
+        self._port = port
+        self._workers = workers
+        self._ssl_context = ssl_context
+        self._restart_delay = restart_delay
+        self._shutdown_timeout = shutdown_timeout
+        self._children = {}
+        self._writer = writer
+
+    def run(self) -> None:
+        # fails fast if the address is taken by something that is not sharing it
+        self.bind().close()
+        signal(SIGTERM, self.stop)
+        signal(SIGINT, self.stop)
+        signal(SIGHUP, self.reload)
+        print(f"Serving on {self._host}:{self._port} with {self._workers} workers (pid {getpid()})")
+        if self._writer is not None:
+            self._writer_pid = self.fork_process("Writer", self._writer.run)
+        self.spawn_generation()
+
+        while self._children or self._writer_pid is not None:
+            self.reap()
+            if self._stopping:
+                self.shut_down()
+            elif self._reloading:
+                self._reloading = False
+                retiring = list(self._children)
+                self._generation += 1
+                self.spawn_generation()
+                self.signal_workers(SIGTERM, retiring)
+            elif monotonic() >= self._next_restart:
+                if self._writer is not None and self._writer_pid is None:
+                    self._writer_pid = self.fork_process("Writer", self._writer.run)
+                for _ in range(self._workers - self.current_workers):
+                    close(self.spawn())
+            sleep(0.1)
+        if self._writer is not None:
+            self._writer.close()
+
+    def stop(self, *_) -> None:
+        self._stopping = True
+
+    def reload(self, *_) -> None:
+        self._reloading = True
+
+    def shut_down(self) -> None:
+        """Stops the workers, then the writer once no worker is left to submit to it."""
+        if self._stop_deadline is None:
+            self._stop_deadline = monotonic() + self._shutdown_timeout
+            self.signal_workers(SIGTERM)
+        elif not self._children and self._writer_pid is not None and not self._writer_stopping:
+            self._writer_stopping = True
+            self._stop_deadline = monotonic() + self._shutdown_timeout
+            self.signal_workers(SIGTERM, [self._writer_pid])
+        elif monotonic() >= self._stop_deadline:
+            self.signal_workers(SIGKILL, list(self._children) if self._children else [self._writer_pid])
+
+    def reap(self) -> None:
+        while True:
+            try:
+                pid, status = waitpid(-1, WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid == self._writer_pid:
+                self._writer_pid, name = None, "Writer"
+            elif self._children.pop(pid, None) == self._generation:
+                name = "Worker"
+            else:
+                continue
+            if self._stopping:
+                continue
+            reason = f"signal {WTERMSIG(status)}" if WIFSIGNALED(status) else f"status {WEXITSTATUS(status)}"
+            print(f"{name} {pid} exited with {reason}, restarting")
+            self._next_restart = monotonic() + self._restart_delay
+
+    def spawn_generation(self) -> None:
+        """Starts a full set of workers and waits until each is listening, or has given up."""
+        readers = [self.spawn() for _ in range(self._workers)]
+        deadline = monotonic() + self._shutdown_timeout
+        while readers and (remaining := deadline - monotonic()) > 0:
+            ready, _, _ = select(readers, [], [], remaining)
+            for reader in ready:
+                read(reader, 1)
+                close(reader)
+                readers.remove(reader)
+        for reader in readers:
+            close(reader)
+
+    def spawn(self) -> int:
+        """Forks a worker, returning a descriptor that becomes readable once it is listening."""
+        reader, writer = pipe()
+        pid = self.fork_process("Worker", self.serve, writer)
+        close(writer)
+        self._children[pid] = self._generation
+        return reader
+
+    @staticmethod
+    def fork_process(name: str, target: Callable[..., None], *args) -> int:
+        if (pid := fork()) == 0:
+            code = 0
+            try:
+                target(*args)
+            except Exception as e:
+                print(f"{name} {getpid()} failed: {e}")
+                code = 1
+            finally:
+                # _exit skips the parent's atexit handlers inherited through fork, and does not flush on its own
+                stdout.flush()
+                stderr.flush()
+                _exit(code)
+        return pid
+
+    def serve(self, ready: int) -> None:
+        # Ctrl+C reaches the whole process group, but only the parent decides when workers stop
+        signal(SIGINT, SIG_IGN)
+        signal(SIGHUP, SIG_IGN)
+        signal(SIGTERM, SIG_DFL)
+        listener = self._listener_factory()
+        sock = self.bind()
+        sock.listen(128)
+        server = listener.create_server(self._host, self._port, fd=sock.fileno(), ssl_context=self._ssl_context)
+        sock.close()
+        # serve_forever only stops when shutdown is called from another thread
+        signal(SIGTERM, lambda *_: Thread(target=server.shutdown, daemon=True).start())
+        try:
+            write(ready, b"1")
+        except BrokenPipeError:
+            pass  # restarted workers have no one waiting on them
+        close(ready)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            listener.close()
+            listener.database_handler.close()
+
+    def bind(self) -> socket:
+        address_family = select_address_family(self._host, self._port)
+        sock = socket(address_family, SOCK_STREAM)
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.bind(get_sockaddr(self._host, self._port, address_family))
+        return sock
+
+    def signal_workers(self, signum: int, pids: Optional[List[int]] = None) -> None:
+        for pid in self._children if pids is None else pids:
+            try:
+                kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    @property
+    def current_workers(self) -> int:
+        return sum(generation == self._generation for generation in self._children.values())
@@ -0,0 +1,141 @@
+from array import array
+from collections import OrderedDict
+from heapq import nlargest
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+# window name: (window length in seconds, ring buffer buckets)
+DEFAULT_WINDOWS: Dict[str, Tuple[float, int]] = {
+    "1s": (1.0, 10),
+    "1m": (60.0, 12),
+    "1h": (3600.0, 12),
+}
+
+
+class ActorRates:
+    """
+    Request counts for one actor, as one ring buffer of buckets per window. The rings are laid end to end in two flat
+    arrays, the counts and the index of the time bucket each count belongs to, so that a bucket left over from an
+    earlier turn of the ring is recognised and reset instead of counted.
+    """
+    __slots__ = ("_counts", "_buckets", "_last_seen")
+    _counts: array
+    _buckets: array
+    _last_seen: float
+
+    def __init__(self, size: int):
+        self._counts = array("L", [0]) * size
+        self._buckets = array("q", [0]) * size
+        self._last_seen = 0.0
+
+    def add(self, windows: Tuple[Tuple[str, float, int, int], ...], now: float) -> None:
+        self._last_seen = now
+        for _, width, buckets, offset in windows:
+            bucket = int(now // width)
+            slot = offset + bucket % buckets
+            if self._buckets[slot] != bucket:
+                self._buckets[slot] = bucket
+                self._counts[slot] = 0
+            self._counts[slot] += 1
+
+    def count(self, width: float, buckets: int, offset: int, now: float) -> int:
+        oldest = int(now // width) - buckets
+        return sum(count for count, bucket in zip(self._counts[offset:offset + buckets],
+                                                  self._buckets[offset:offset + buckets]) if bucket > oldest)
+
+    def counts(self, windows: Tuple[Tuple[str, float, int, int], ...], now: float) -> Dict[str, int]:
+        return {name: self.count(width, buckets, offset, now) for name, width, buckets, offset in windows}
+
+    @property
+    def last_seen(self) -> float:
+        return self._last_seen
+
+
+class RateTracker:
+    """
+    Live per-actor request counts over sliding windows, kept in memory so that they can be checked on every request
+    without touching the database. Each window is a ring of buckets, so its count covers the window to within one
+    bucket. At most max_actors are tracked; the least recently seen are evicted first, and actors idle for longer than
+    the longest window are evicted as new ones arrive.
+    """
+    _windows: Tuple[Tuple[str, float, int, int], ...]
+    _size: int
+    _actors: OrderedDict
+    _max_actors: int
+    _idle_timeout: float
+    _lock: Lock
+    _evicted: int = 0
+
+    def __init__(self, windows: Optional[Dict[str, Tuple[float, int]]] = None, max_actors: int = 20_000):
+        windows = windows or DEFAULT_WINDOWS
+        if max_actors < 1:
+            raise ValueError("Max actors must be at least 1.")
+        if any(length <= 0 or buckets < 1 for length, buckets in windows.values()):
+            raise ValueError("Windows must have a positive length and at least 1 bucket.")
+
+        offsets, offset = [], 0
+        for name, (length, buckets) in windows.items():
+            offsets.append((name, length / buckets, buckets, offset))
+            offset += buckets
+        self._windows = tuple(offsets)
+        self._size = offset
+        self._actors = OrderedDict()
+        self._max_actors = max_actors
+        self._idle_timeout = max(length for length, _ in windows.values())
+        self._lock = Lock()
+
+    def record(self, host: str, now: Optional[float] = None) -> Dict[str, int]:
+        """Counts a request from host, returning its request count in each window, this request included."""
+        now = monotonic() if now is None else now
+        with self._lock:
+            if (rates := self._actors.get(host)) is None:
+                rates = self._actors[host] = ActorRates(self._size)
+                rates.add(self._windows, now)
+                self.evict(now)
+            else:
+                self._actors.move_to_end(host)
+                rates.add(self._windows, now)
+            return rates.counts(self._windows, now)
+
+    def rates(self, host: str, now: Optional[float] = None) -> Dict[str, int]:
+        now = monotonic() if now is None else now
+        with self._lock:
+            if (rates := self._actors.get(host)) is None:
+                return {name: 0 for name, _, _, _ in self._windows}
+            return rates.counts(self._windows, now)
+
+    def top(self, window: str, limit: int = 100, now: Optional[float] = None) -> List[Tuple[str, int]]:
+        """The limit actors with the most requests in window, as (host, count), busiest first."""
+        now = monotonic() if now is None else now
+        try:
+            _, width, buckets, offset = next(spec for spec in self._windows if spec[0] == window)
+        except StopIteration:
+            raise ValueError(f"Unknown window {window}, expected one of {', '.join(self.windows)}.")
+        with self._lock:
+            self.evict(now)
+            actors = list(self._actors.items())
+        # counted outside the lock, so a large table does not hold up the request threads
+        counts = ((host, rates.count(width, buckets, offset, now)) for host, rates in actors)
+        return [(host, count) for host, count in nlargest(limit, counts, key=lambda item: item[1]) if count]
+
+    def evict(self, now: float) -> None:
+        """Drops actors past max_actors or idle for longer than the longest window. Called with the lock held."""
+        while self._actors:
+            host, rates = next(iter(self._actors.items()))
+            if len(self._actors) <= self._max_actors and now - rates.last_seen <= self._idle_timeout:
+                break
+            del self._actors[host]
+            self._evicted += 1
+
+    @property
+    def windows(self) -> List[str]:
+        return [name for name, _, _, _ in self._windows]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "actors": len(self._actors),
+            "max_actors": self._max_actors,
+            "evicted": self._evicted
+        }
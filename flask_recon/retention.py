@@ -0,0 +1,59 @@
+from threading import Thread, Event
+from typing import Optional
+
+from flask_recon.database import DatabaseHandler
+
+
+class PartitionMaintainer:
+    """
+    Keeps the monthly requests partitions ahead of the clock from a background thread and, if a retention period is
+    set, rolls up and removes partitions that have fallen out of it.
+    """
+    _database_handler: DatabaseHandler
+    _months_ahead: int
+    _retention_days: Optional[int]
+    _drop: bool
+    _interval: float
+    _worker: Thread
+    _stopping: Event
+
+    def __init__(self, database_handler: DatabaseHandler, months_ahead: int = 3, retention_days: Optional[int] = None,
+                 drop: bool = True, interval: float = 3600.0):
+        if months_ahead < 1:
+            raise ValueError("Partitions must be created at least one month ahead.")
+        if retention_days is not None and retention_days < 1:
+            raise ValueError("Retention must be at least one day.")
+
+        self._database_handler = database_handler
+        self._months_ahead = months_ahead
+        self._retention_days = retention_days
+        self._drop = drop
+        self._interval = interval
+        self._worker = Thread(target=self.run, name="flask-recon-partitions", daemon=True)
+        self._stopping = Event()
+
+    def start(self) -> None:
+        self._worker.start()
+
+    def close(self, timeout: float = 30.0) -> None:
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        if self._worker.is_alive():
+            self._worker.join(timeout)
+
+    def run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self.maintain()
+            except Exception as e:
+                print(f"Partition maintenance failed: {e}")
+            self._stopping.wait(self._interval)
+
+    def maintain(self) -> None:
+        if created := self._database_handler.create_request_partitions(self._months_ahead):
+            print(f"Created request partitions {', '.join(created)}")
+        if self._retention_days is None:
+            return
+        if removed := self._database_handler.apply_retention(self._retention_days, self._drop):
+            print(f"Rolled up and {'dropped' if self._drop else 'detached'} request partitions {', '.join(removed)}")
@@ -1,12 +1,15 @@
 from datetime import datetime
-from typing import List, Dict, Callable
+from typing import List, Dict, Callable, Tuple, Optional, Any
 
 from flask import request, render_template, Response
 
 from flask_recon import Listener, RemoteHost, IncomingRequest
-from flask_recon.database import db_error_handler
+from flask_recon.database import db_error_handler, REQUEST_DETAIL_FIELDS
+from flask_recon.export import export_response
+from flask_recon.pagination import parse_page_arguments, page_cursors, page_query_string
 
 BASE_DIRECTORY = "flask-recon"
+HOST_ROW_INDEXES = {"host": 0, "valid": 1, "invalid": 2, "total": 3, "threat_level": 4}
 
 
 class Api:
@@ -19,19 +22,71 @@ class Api:
         return self._listener.database_handler.get_all_endpoints()
 
     def all_hosts(self):
-        return self._listener.database_handler.get_remote_hosts()
+        try:
+            hosts, next_cursor, previous_cursor = page_remote_hosts(self._listener)
+        except ValueError as e:
+            return str(e), 400
+        return hosts, 200, cursor_headers(next_cursor, previous_cursor)
 
     def hosts_by_endpoint(self):
-        endpoint = request.args.get("endpoint")
-        return self._listener.database_handler.get_hosts_by_endpoint(endpoint)
+        try:
+            hosts, next_cursor, previous_cursor = page_hosts_by_endpoint(self._listener)
+        except ValueError as e:
+            return str(e), 400
+        return hosts, 200, cursor_headers(next_cursor, previous_cursor)
 
     def requests_by_endpoint(self):
         endpoint = request.args.get("endpoint")
-        return self._listener.database_handler.get_requests(endpoint)
+        if endpoint is None:
+            return "Missing endpoint parameter", 400
+        try:
+            requests, next_cursor, previous_cursor = page_requests(self._listener, endpoint=endpoint,
+                                                                   fields=request_fields())
+        except ValueError as e:
+            return str(e), 400
+        return [req.as_dict for req in requests], 200, cursor_headers(next_cursor, previous_cursor)
 
     def requests_by_host(self):
         host = request.args.get("host")
-        return self._listener.database_handler.get_requests(host=RemoteHost(host))
+        if host is None:
+            return "Missing host parameter", 400
+        try:
+            requests, next_cursor, previous_cursor = page_requests(self._listener, host=RemoteHost(host),
+                                                                   fields=request_fields())
+        except ValueError as e:
+            return str(e), 400
+        return [req.as_dict for req in requests], 200, cursor_headers(next_cursor, previous_cursor)
+
+    def requests_with_header(self):
+        header = request.args.get("header")
+        if header is None:
+            return "Missing header parameter", 400
+        value = request.args.get("value")
+        try:
+            fields = request_fields()
+            requests, next_cursor, previous_cursor = fetch_page(
+                lambda limit, descending, after: self._listener.database_handler.search(
+                    has_header=header, header_contains={header: value} if value is not None else None,
+                    all_must_match=True, limit=limit, descending=descending, after=after, fields=fields),
+                request_key)
+        except ValueError as e:
+            return str(e), 400
+        return [req.as_dict for req in requests], 200, cursor_headers(next_cursor, previous_cursor)
+
+    def actor_cache_stats(self):
+        return self._listener.database_handler.actor_cache_stats
+
+    def actor_rates(self):
+        if (rate_tracker := self._listener.rate_tracker) is None:
+            return "Rate tracking is not enabled", 404
+        if (host := request.args.get("host")) is not None:
+            return {"host": host, **rate_tracker.rates(host)}
+        try:
+            limit = int(request.args.get("limit", 100))
+            top = rate_tracker.top(request.args.get("window", "1m"), limit)
+        except ValueError as e:
+            return str(e), 400
+        return {"top": [{"host": host, "count": count} for host, count in top], **rate_tracker.stats}
 
     @property
     def routes(self) -> Dict[str, Callable]:
@@ -41,6 +96,9 @@ class Api:
             f"/{BASE_DIRECTORY}/api/hosts-by-endpoint": self.hosts_by_endpoint,
             f"/{BASE_DIRECTORY}/api/requests-by-endpoint": self.requests_by_endpoint,
             f"/{BASE_DIRECTORY}/api/requests-by-host": self.requests_by_host,
+            f"/{BASE_DIRECTORY}/api/requests-with-header": self.requests_with_header,
+            f"/{BASE_DIRECTORY}/api/actor-cache-stats": self.actor_cache_stats,
+            f"/{BASE_DIRECTORY}/api/actor-rates": self.actor_rates,
         }
 
 
@@ -54,36 +112,44 @@ class WebApp:
         return render_template("view_endpoints.html", endpoints=self._listener.database_handler.get_all_endpoints())
 
     def view_hosts(self):
-        return render_template("view_hosts.html", hosts=self._listener.database_handler.get_remote_hosts())
+        try:
+            hosts, next_cursor, previous_cursor = page_remote_hosts(self._listener)
+        except ValueError as e:
+            return str(e), 400
+        return render_template("view_hosts.html", hosts=hosts, **page_links(next_cursor, previous_cursor))
 
     def html_hosts_by_endpoint(self):
         endpoint = request.args.get("endpoint")
-        return render_template("hosts_by_endpoint.html",
-                               hosts=self._listener.database_handler.get_hosts_by_endpoint(endpoint),
-                               endpoint=endpoint)
+        try:
+            hosts, next_cursor, previous_cursor = page_hosts_by_endpoint(self._listener)
+        except ValueError as e:
+            return str(e), 400
+        return render_template("hosts_by_endpoint.html", hosts=hosts, endpoint=endpoint,
+                               **page_links(next_cursor, previous_cursor))
 
     def html_requests_by_endpoint(self):
         endpoint = request.args.get("endpoint")
-        requests = self._listener.database_handler.get_requests(endpoint=endpoint)
-        self.update_tls(requests)
+        if endpoint is None:
+            return "Missing endpoint parameter", 400
+        try:
+            requests, next_cursor, previous_cursor = page_requests(self._listener, endpoint=endpoint, fields=())
+        except ValueError as e:
+            return str(e), 400
         return render_template("view_requests.html", requests=requests, endpoint=endpoint,
-                               title=f"Requests to {endpoint}")
+                               title=f"Requests to {endpoint}", **page_links(next_cursor, previous_cursor))
 
     def html_requests_by_host(self):
         host = request.args.get("host")
         if host is None:
             return "Missing host parameter", 400
 
-        endpoint = request.args.get("endpoint")
-        remote_host = RemoteHost(host)
-
-        if endpoint is not None:
-            requests = self._listener.database_handler.get_requests(endpoint=endpoint, host=remote_host)
-        else:
-            requests = self._listener.database_handler.get_requests(host=remote_host)
-
-        self.update_tls(requests)
-        return render_template("view_requests.html", requests=requests, title=f"Requests from {host}")
+        try:
+            requests, next_cursor, previous_cursor = page_requests(self._listener, endpoint=request.args.get("endpoint"),
+                                                                   host=RemoteHost(host), fields=())
+        except ValueError as e:
+            return str(e), 400
+        return render_template("view_requests.html", requests=requests, title=f"Requests from {host}",
+                               **page_links(next_cursor, previous_cursor))
 
     def html_search(self):
         if any([
@@ -92,16 +158,37 @@ class WebApp:
             (uri := request.args.get("input_uri")),
             (headers := request.args.get("input_headers")),
             (query_string := request.args.get("input_query_string")),
-            (body := request.args.get("input_body"))
+            (body := request.args.get("input_body")),
+            (has_header := request.args.get("input_has_header"))
         ]):
             case_sensitive = request.args.get("case_sensitive") == "on"
             all_must_match = request.args.get("all_must_match") == "on"
-            results = self._listener.database_handler.search(method=method, all_must_match=all_must_match,
-                                                             uri=uri, host=host, query_string=query_string, body=body,
-                                                             case_sensitive=case_sensitive, headers=headers)
-            return render_template("search.html", requests=results)
+            full_text = request.args.get("full_text") == "on"
+            try:
+                results, next_cursor, previous_cursor = fetch_page(
+                    lambda limit, descending, after: self._listener.database_handler.search(
+                        method=method, all_must_match=all_must_match, uri=uri, host=host, query_string=query_string,
+                        body=body, case_sensitive=case_sensitive, full_text=full_text, headers=headers,
+                        has_header=has_header, limit=limit, descending=descending, after=after, fields=()),
+                    request_key)
+            except ValueError as e:
+                return str(e), 400
+            return render_template("search.html", requests=results, **page_links(next_cursor, previous_cursor))
         return render_template("search.html")
 
+    def view_request(self):
+        request_id = request.args.get("request_id")
+        if request_id is None:
+            return "Missing request_id parameter", 400
+        try:
+            req = self._listener.database_handler.get_request(int(request_id))
+        except ValueError:
+            return "Invalid request_id parameter", 400
+        if req is None:
+            return "Request not found", 404
+        return render_template("view_requests.html", requests=[req], show_details=True,
+                               title=f"Request {req.request_id}")
+
     def csv_request_dump(self):
         request_id = request.args.get("request_id")
         if request_id is None:
@@ -115,25 +202,20 @@ class WebApp:
             return "Invalid request_id parameter", 400
 
     def home(self):
-        try:
-            last_actor, last_actor_time = self._listener.database_handler.get_last_actor()
-        except TypeError:
-            last_actor, last_actor_time = None, None
-        last_method, last_endpoint, last_threat_level = self._listener.database_handler.get_last_endpoint()
-        time_between_requests = self._listener.database_handler.get_average_time_between_requests()
-        last_request_time = self._listener.database_handler.get_last_request_time()
-        time_since_last_request = datetime.now() - last_request_time
+        metrics = self._listener.dashboard.metrics
+        if not metrics:
+            return "Dashboard not yet available", 503
         return render_template(
             "home.html",
-            total_requests=self._listener.database_handler.get_request_count(),
-            total_endpoints=self._listener.database_handler.get_endpoint_count(),
-            total_actors=self._listener.database_handler.get_actor_count(),
-            time_since_last_request=self.parse_time(str(time_since_last_request)),
-            last_endpoint=last_endpoint,
-            last_actor_time=last_actor_time,
-            last_request_method=last_method,
-            time_between_requests=self.parse_time(str(time_between_requests)),
-            last_actor=last_actor
+            total_requests=metrics["total_requests"],
+            total_endpoints=metrics["total_endpoints"],
+            total_actors=metrics["total_actors"],
+            time_since_last_request=self.parse_time(str(datetime.now() - metrics["last_request_time"])),
+            last_endpoint=metrics["last_endpoint"],
+            last_actor_time=metrics["last_actor_time"],
+            last_request_method=metrics["last_request_method"],
+            time_between_requests=self.parse_time(str(metrics["time_between_requests"])),
+            last_actor=metrics["last_actor"]
         )
 
     def register(self):
@@ -197,20 +279,26 @@ class WebApp:
         host = request.args.get("host")
         if host is None:
             return "Missing host parameter", 400
+        actor_id = self._listener.database_handler.get_actor_id(RemoteHost(host))
+        if actor_id == -1:
+            return "Actor not found", 404
+        return export_response(self._listener.database_handler.stream_requests(actor_id=actor_id), "csv",
+                               f"actor-{actor_id}")
+
+    def export(self):
+        host = request.args.get("host")
+        actor_id = self._listener.database_handler.get_actor_id(RemoteHost(host)) if host is not None else None
+        if actor_id == -1:
+            return "Actor not found", 404
         try:
-            actor_id = self._listener.database_handler.get_actor_id(RemoteHost(host))
-            actor_requests = self._listener.database_handler.search(actor_id=int(actor_id))
-            if not actor_requests:
-                return "Actor not found", 404
-            return Response(
-                f"{actor_requests[0].csv_headers}\n" + "\n".join([req.as_csv for req in actor_requests]),
-                headers={
-                    "Content-Type": "text/csv",
-                    "Content-Disposition": f"attachment; filename=actor-{actor_id}.csv"
-                }
-            )
-        except ValueError:
-            return "Invalid actor_id parameter", 400
+            start = datetime.fromisoformat(t) if (t := request.args.get("start")) else None
+            end = datetime.fromisoformat(t) if (t := request.args.get("end")) else None
+            rows = self._listener.database_handler.stream_requests(
+                actor_id=actor_id, endpoint=request.args.get("endpoint"), start=start, end=end)
+            return export_response(rows, request.args.get("format", "csv"), "requests",
+                                   compress=request.args.get("gzip") in ("1", "true"))
+        except ValueError as e:
+            return str(e), 400
 
     @staticmethod
     def parse_time(t: str) -> str:
@@ -221,11 +309,6 @@ class WebApp:
     def favicon():
         return open("favicon.ico", "rb").read(), 200
 
-    @staticmethod
-    def update_tls(reqs: List[IncomingRequest]):
-        for req in reqs:
-            req.determine_threat_level()
-
     @property
     def routes(self) -> Dict[str, Callable]:
         return {
@@ -238,6 +321,8 @@ class WebApp:
             f"/{BASE_DIRECTORY}/search": self.html_search,
             f"/{BASE_DIRECTORY}/csv-request-dump": self.csv_request_dump,
             f"/{BASE_DIRECTORY}/csv-actor-dump": self.csv_actor_dump,
+            f"/{BASE_DIRECTORY}/request": self.view_request,
+            f"/{BASE_DIRECTORY}/export": self.export,
             f"/{BASE_DIRECTORY}/register": self.register,
             f"/{BASE_DIRECTORY}/login": self.login,
             f"/{BASE_DIRECTORY}/analyse-request": self.analyse_request,
@@ -245,7 +330,73 @@ class WebApp:
         }
 
 
+def fetch_page(fetch: Callable[[int, bool, Optional[List[Any]]], List[Any]],
+               key: Callable[[Any], List[Any]]) -> Tuple[List[Any], Optional[str], Optional[str]]:
+    """
+    Calls fetch(limit, descending, after) with the paging arguments of the current request, returning the page with
+    the cursors of the next and previous pages.
+    """
+    limit, descending, cursor, backwards = parse_page_arguments(request.args)
+    return page_cursors(fetch(limit, descending, cursor), key, limit, cursor, backwards)
+
+
+def cursor_headers(next_cursor: Optional[str], previous_cursor: Optional[str]) -> Dict[str, str]:
+    return {"X-Next-Cursor": next_cursor or "", "X-Previous-Cursor": previous_cursor or ""}
+
+
+def page_links(next_cursor: Optional[str], previous_cursor: Optional[str]) -> Dict[str, Optional[str]]:
+    return {
+        "next_page": page_query_string(request.args, "after", next_cursor),
+        "previous_page": page_query_string(request.args, "before", previous_cursor)
+    }
+
+
+def request_fields() -> Tuple[str, ...]:
+    """Reads the comma-separated fields query argument, defaulting to every field in REQUEST_DETAIL_FIELDS."""
+    if (fields := request.args.get("fields")) is None:
+        return REQUEST_DETAIL_FIELDS
+    return tuple(field for field in fields.split(",") if field)
+
+
+def request_key(req: IncomingRequest) -> List[Any]:
+    return [req.timestamp.isoformat(), req.request_id]
+
+
+def page_requests(listener: Listener, endpoint: Optional[str] = None, host: Optional[RemoteHost] = None,
+                  fields: Tuple[str, ...] = REQUEST_DETAIL_FIELDS
+                  ) -> Tuple[List[IncomingRequest], Optional[str], Optional[str]]:
+    return fetch_page(
+        lambda limit, descending, after: listener.database_handler.get_requests(
+            endpoint=endpoint, host=host, limit=limit, descending=descending, after=after, fields=fields),
+        request_key)
+
+
+def page_remote_hosts(listener: Listener) -> Tuple[List[Tuple[str, int, int, int, int, int, Optional[str], Optional[int],
+                                                              Optional[str]]], Optional[str], Optional[str]]:
+    order_by = request.args.get("order", "total")
+    if order_by not in HOST_ROW_INDEXES:
+        raise ValueError(f"Hosts can only be ordered by {', '.join(HOST_ROW_INDEXES)}.")
+    # rows are (host, valid, invalid, total, threat_level, actor_id, country, asn, as_organisation)
+    return fetch_page(
+        lambda limit, descending, after: listener.database_handler.get_remote_hosts(
+            limit=limit, order_by=order_by, descending=descending, after=after),
+        lambda host: [host[HOST_ROW_INDEXES[order_by]], host[5]])
+
+
+def page_hosts_by_endpoint(listener: Listener) -> Tuple[List[Tuple[Dict[str, Any], int]], Optional[str],
+                                                        Optional[str]]:
+    endpoint = request.args.get("endpoint")
+    if endpoint is None:
+        raise ValueError("Missing endpoint parameter")
+    return fetch_page(
+        lambda limit, descending, after: listener.database_handler.get_hosts_by_endpoint(
+            endpoint, limit=limit, descending=descending, after=after),
+        lambda host: [host[1], host[0]["actor_id"]])
+
+
 def add_routes(listener: Listener, run_api: bool = True, run_webapp: bool = True):
+    if run_webapp and listener.dashboard is None:
+        listener.enable_dashboard()
     routes = {
         **(Api(listener).routes if run_api else {}),
         **(WebApp(listener).routes if run_webapp else {})
@@ -0,0 +1,154 @@
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from flask_recon.flags import KNOWN_FLAGS, KnownFlags, FlagMatcher, RequestType, AttackType
+from flask_recon.structures import IncomingRequest, RequestBatch, RequestMethod
+
+METHOD_SCORES = {
+    RequestMethod.POST: 10,
+    RequestMethod.PUT: 10,
+    RequestMethod.DELETE: 8,
+    RequestMethod.PATCH: 8,
+    RequestMethod.PRI: 8,
+}
+
+BatchScores = Tuple[np.ndarray, List[List[RequestType]], List[List[AttackType]], List[List[Tuple[str, str]]]]
+
+
+class MatchMatrix:
+    """
+    Sparse matrix, in CSR form, of the flags matched by each distinct value scored against one matcher. Values are
+    matched once however many requests share them, and row -1 is an empty row for requests the matcher was not run on.
+    """
+    _matcher: FlagMatcher
+    _rows: Dict[str, int]
+    _indptr: List[int]
+    _indices: List[int]
+
+    def __init__(self, matcher: FlagMatcher):
+        self._matcher = matcher
+        self._rows = {}
+        self._indptr = [0]
+        self._indices = []
+
+    def row(self, value: str) -> int:
+        if (row := self._rows.get(value)) is None:
+            row = self._rows[value] = len(self._indptr) - 1
+            self._indices.extend(self._matcher.match_indices(value))
+            self._indptr.append(len(self._indices))
+        return row
+
+    def flags(self, row: int) -> Tuple[int, ...]:
+        if row < 0:
+            return ()
+        return tuple(self._indices[self._indptr[row]:self._indptr[row + 1]])
+
+    def totals(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Per-row (score sum, match count), with the empty row -1 appended."""
+        counts = np.diff(np.array(self._indptr, dtype=np.int64))
+        scores = np.array([flag.score for flag in self._matcher.flags], dtype=np.float64)
+        sums = np.bincount(np.repeat(np.arange(len(counts)), counts),
+                           weights=scores[np.array(self._indices, dtype=np.intp)], minlength=len(counts))
+        return np.append(sums, 0.0), np.append(counts, 0)
+
+    @staticmethod
+    def averages(matrix: "MatchMatrix", rows: np.ndarray, not_run: float, unmatched: float) -> np.ndarray:
+        """
+        Average flag score of each request's row, as IncomingRequest.calc_avg_tl_flags computes it, or unmatched
+        where nothing matched and not_run where the matcher was not run.
+        """
+        sums, counts = matrix.totals()
+        sums, counts = sums[rows], counts[rows]
+        averages = np.divide(sums, counts, out=np.full(len(rows), unmatched, dtype=np.float64), where=counts > 0)
+        return np.where(rows >= 0, averages, not_run)
+
+
+def score_columns(methods: Sequence[Any], paths: Sequence[str], query_strings: Sequence[Optional[str]],
+                  headers: Sequence[Optional[Dict[str, Any]]], bodies: Sequence[Any],
+                  known_flags: KnownFlags = KNOWN_FLAGS) -> BatchScores:
+    """
+    Scores requests given as columns, returning (threat_levels, request_types, attack_types, matched_flags) with the
+    same values IncomingRequest.determine_threat_level gives for each request. Flags are matched once per distinct
+    user agent, path and query string into sparse match matrices, and the component scores and their rounded average
+    are computed over whole columns.
+    """
+    ua_matrix, payload_matrix = MatchMatrix(known_flags.ua_matcher), MatchMatrix(known_flags.payload_matcher)
+    ua_rows, uri_rows, query_rows, method_scores, has_body, proxy = [], [], [], [], [], []
+    for method, path, query_string, request_headers, body in zip(methods, paths, query_strings, headers, bodies):
+        if request_headers and any(key.lower() == "user-agent" for key in request_headers):
+            ua_rows.append(ua_matrix.row(request_headers.get("user-agent") or request_headers.get("User-Agent")))
+        else:
+            ua_rows.append(-1)
+        method_scores.append(METHOD_SCORES.get(method, 5 if method == "CONNECT" else 6))
+        proxy.append(method == "CONNECT")
+        uri_rows.append(-1 if path == "/" else payload_matrix.row(path))
+        query_rows.append(payload_matrix.row(query_string) if query_string else -1)
+        has_body.append(bool(body))
+
+    ua_rows, uri_rows, query_rows = (np.array(rows, dtype=np.intp) for rows in (ua_rows, uri_rows, query_rows))
+    # summed in the order determine_threat_level adds them, so the floats and their rounding agree exactly
+    total = (np.array(method_scores, dtype=np.float64)
+             + MatchMatrix.averages(payload_matrix, uri_rows, not_run=0, unmatched=6)
+             + MatchMatrix.averages(payload_matrix, query_rows, not_run=5, unmatched=0.0)
+             + np.where(np.array(has_body, dtype=bool), 10, 0)
+             + MatchMatrix.averages(ua_matrix, ua_rows, not_run=5, unmatched=0.0))
+    threat_levels = np.rint(total / 5).astype(np.int64)  # rounds half to even, like round()
+
+    request_types, attack_types, matched_flags = [], [], []
+    classified = {}
+    for key in zip(ua_rows.tolist(), uri_rows.tolist(), query_rows.tolist(), proxy):
+        if (classification := classified.get(key)) is None:
+            classification = classified[key] = classify_matches(
+                [known_flags.ua_matcher.flags[index] for index in ua_matrix.flags(key[0])],
+                [known_flags.payload_matcher.flags[index] for index in payload_matrix.flags(key[1])],
+                [known_flags.payload_matcher.flags[index] for index in payload_matrix.flags(key[2])],
+                key[3],
+            )
+        request_types.append(classification[0])
+        attack_types.append(classification[1])
+        matched_flags.append(classification[2])
+    return threat_levels, request_types, attack_types, matched_flags
+
+
+def classify_matches(ua_flags: List[Any], uri_flags: List[Any], query_flags: List[Any],
+                     proxy: bool) -> Tuple[List[RequestType], List[AttackType], List[Tuple[str, str]]]:
+    """The request types, attack types and matched flags determine_threat_level derives from a request's matches."""
+    total_request_types, total_attack_types, matched_flags = [], [], []
+    for kind, flags in (("user_agent", ua_flags), ("payload", uri_flags), ("payload", query_flags)):
+        for flag in flags:
+            total_request_types.extend(flag.request_types)
+            if flag.attack_types:
+                total_attack_types.extend(flag.attack_types)
+            matched_flags.append((kind, flag.flag))
+        if proxy and kind == "user_agent":
+            total_request_types.append(RequestType.PROXY_ATTEMPT)
+    return (IncomingRequest.rank_types(total_request_types) or [RequestType.OTHER],
+            IncomingRequest.rank_types(total_attack_types), list(dict.fromkeys(matched_flags)))
+
+
+def score_requests(requests: Sequence[IncomingRequest], known_flags: KnownFlags = KNOWN_FLAGS) -> BatchScores:
+    return score_columns([request.method for request in requests], [request.uri for request in requests],
+                         [request.query_string for request in requests], [request.headers for request in requests],
+                         [request.body for request in requests], known_flags)
+
+
+def score_batch(batch: RequestBatch, known_flags: KnownFlags = KNOWN_FLAGS) -> BatchScores:
+    """Scores a RequestBatch read with the headers and body fields, parsing methods as they are on capture."""
+    if batch.headers is None or batch.bodies is None:
+        raise ValueError("Scoring a batch requires its headers and body fields.")
+    return score_columns([RequestMethod.from_str(method) for method in batch.methods], batch.paths,
+                         batch.query_strings, batch.headers, batch.bodies, known_flags)
+
+
+def score_rows(rows: List[Tuple]) -> List[Tuple[int, int, List[str], List[str], str, List[Tuple[str, str]]]]:
+    """Batch scored equivalent of classify_rows, taking and returning rows of the same shape."""
+    version = KNOWN_FLAGS.version
+    threat_levels, request_types, attack_types, matched_flags = score_columns(
+        [RequestMethod.from_str(row[1]) for row in rows], [row[2] for row in rows], [row[3] for row in rows],
+        [row[4] for row in rows], [row[5] for row in rows],
+    )
+    return [(row[0], threat_level, [request_type.value for request_type in row_request_types],
+             [attack_type.value for attack_type in row_attack_types], version, row_matched_flags)
+            for row, threat_level, row_request_types, row_attack_types, row_matched_flags in zip(
+                rows, threat_levels.tolist(), request_types, attack_types, matched_flags)]
@@ -1,13 +1,28 @@
-from re import compile
+from atexit import register
+from datetime import datetime
 from time import sleep
-from typing import Tuple, Dict, Optional
+from typing import Tuple, Dict, Optional, Union, TYPE_CHECKING
 
 from flask import Flask, request, Response
+from werkzeug.serving import BaseWSGIServer, make_server
 
+from flask_recon.capture import CapturedRequest, resolve_environ_address, resolve_remote_address, unpack_request
+from flask_recon.classify import Reclassifier
+from flask_recon.dashboard import DashboardSnapshot
 from flask_recon.database import DatabaseHandler
+from flask_recon.geoip import GeoIndex, compile_index
+from flask_recon.ingest import IngestionQueue
+from flask_recon.rates import RateTracker
+from flask_recon.retention import PartitionMaintainer
+from flask_recon.spool import CircuitBreaker, Spool, SpoolGuard, SpoolReplayer
+from flask_recon.tarpit import Tarpit, TarpitRequestHandler, TARPIT_ENVIRON_KEY
 from flask_recon.structures import IncomingRequest, RequestMethod, HALT_PAYLOAD
 from flask_recon.util import RequestAnalyser
 
+if TYPE_CHECKING:
+    # writer needs SIGHUP and AF_UNIX, which do not exist on Windows
+    from flask_recon.writer import RequestWriter
+
 PORTS = {
     "80": "http",
     "443": "https"
@@ -16,12 +31,26 @@ PORTS = {
 
 class Listener:
     _database_handler: DatabaseHandler
+    _database_config: Dict[str, str]
+    _ingestion_queue: Optional[IngestionQueue] = None
+    _writer: Optional["RequestWriter"] = None
+    _spool: Optional[Spool] = None
+    _spool_guard: Optional[SpoolGuard] = None
+    _spool_replayer: Optional[SpoolReplayer] = None
+    _tarpit: Optional[Tarpit] = None
+    _reclassifier: Optional[Reclassifier] = None
+    _partition_maintainer: Optional[PartitionMaintainer] = None
+    _dashboard: Optional[DashboardSnapshot] = None
     _flask: Flask
     _port: int
     _halt_scanner_threads: bool
     _max_halt_messages: int
+    _halt_message: bytes
     _request_analyser: RequestAnalyser
-    _ip_regex = compile(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
+    _capture_max_body: Optional[int] = None
+    _rate_tracker: Optional[RateTracker] = None
+    _min_halt_rate: int = 0
+    _max_honeypot_rate: Optional[int] = None
 
     def __init__(self, flask: Flask, halt_scanner_threads: bool = True, max_halt_messages: int = 100_000,
                  port: int = 80):
@@ -29,6 +58,7 @@ class Listener:
         self._port = port
         self._halt_scanner_threads = halt_scanner_threads
         self._max_halt_messages = max_halt_messages
+        self._halt_message = ((HALT_PAYLOAD * 1024) * 1024).encode() if halt_scanner_threads else b""
         self._flask = flask
         self.add_routes()
 
@@ -36,58 +66,261 @@ class Listener:
         return self._flask.route(*args, **kwargs)
 
     def run(self, *args, **kwargs):
-        self._flask.run(*args, **kwargs)
+        if self._tarpit is not None:
+            kwargs.setdefault("request_handler", TarpitRequestHandler)
+        try:
+            self._flask.run(*args, **kwargs)
+        finally:
+            self.close()
+
+    def create_server(self, host: str, port: int, fd: Optional[int] = None,
+                      ssl_context: Optional[Tuple[str, str]] = None) -> BaseWSGIServer:
+        """A threaded server for the app, as Listener.run starts, optionally on an already bound and listening socket."""
+        return make_server(host, port, self._flask, threaded=True, ssl_context=ssl_context, fd=fd,
+                           request_handler=TarpitRequestHandler if self._tarpit is not None else None)
+
+    def close(self):
+        if self._ingestion_queue is not None:
+            self._ingestion_queue.close()
+        if self._tarpit is not None:
+            self._tarpit.close()
+        if self._reclassifier is not None:
+            self._reclassifier.close()
+        if self._partition_maintainer is not None:
+            self._partition_maintainer.close()
+        if self._dashboard is not None:
+            self._dashboard.close()
+        if self._spool_replayer is not None:
+            self._spool_replayer.close()
+            self._spool.close()
 
-    def connect_database(self, dbname: str, user: str, password: str, host: str, port: str):
+    def connect_database(self, dbname: str, user: str, password: str, host: str, port: str, min_connections: int = 1,
+                         max_connections: int = 10, background_jobs: bool = True):
+        """
+        Connects to the database. background_jobs watches the honeypots table and starts reclassification and partition
+        maintenance, all of which a process submitting to a RequestWriter leaves to the writer.
+        """
+        self._database_config = {
+            "dbname": dbname,
+            "user": user,
+            "password": password,
+            "host": host,
+            "port": port
+        }
         self._database_handler = DatabaseHandler(
-            dbname=dbname,
-            user=user,
-            password=password,
-            host=host,
-            port=port
+            **self._database_config,
+            min_connections=min_connections,
+            max_connections=max_connections
+        )
+        if background_jobs:
+            self._database_handler.watch_honeypots()
+            self.enable_reclassification()
+            self.enable_partition_maintenance()
+
+    def enable_reclassification(self, poll_interval: float = 30.0, batch_size: int = 1000):
+        """
+        Rescores stored requests in the background when static/flags.json changes, instead of on every read. Only
+        requests the change can affect are rescored.
+        """
+        if self._reclassifier is not None:
+            self._reclassifier.close()
+        self._reclassifier = Reclassifier(
+            database_handler=self._database_handler,
+            poll_interval=poll_interval,
+            batch_size=batch_size
+        )
+        self._reclassifier.start()
+        register(self._reclassifier.close)
+
+    def enable_partition_maintenance(self, months_ahead: int = 3, retention_days: Optional[int] = None,
+                                     drop: bool = True, interval: float = 3600.0):
+        """
+        Creates monthly requests partitions ahead of time. With retention_days, partitions older than that are rolled up
+        into hourly request_rollups and then dropped, or only detached if drop is False.
+        """
+        if self._partition_maintainer is not None:
+            self._partition_maintainer.close()
+        self._partition_maintainer = PartitionMaintainer(
+            database_handler=self._database_handler,
+            months_ahead=months_ahead,
+            retention_days=retention_days,
+            drop=drop,
+            interval=interval
+        )
+        self._partition_maintainer.start()
+        register(self._partition_maintainer.close)
+
+    def enable_dashboard(self, refresh_interval: float = 30.0):
+        """Keeps the home page metrics in memory, refreshing them from the database every refresh_interval seconds."""
+        if self._dashboard is not None:
+            self._dashboard.close()
+        self._dashboard = DashboardSnapshot(self._database_handler, refresh_interval)
+        self._dashboard.start()
+        register(self._dashboard.close)
+
+    def enable_async_ingestion(self, batch_size: int = 500, flush_interval: float = 1.0, max_queue_size: int = 10_000):
+        """
+        Queues captured requests and writes them from a background thread in batches, so responses no longer wait on
+        the database. Requests are written synchronously while the queue is full.
+        """
+        self._ingestion_queue = IngestionQueue(
+            database_handler=self._spool_guard or self._database_handler,
+            batch_size=batch_size,
+            flush_interval=flush_interval,
+            max_size=max_queue_size
+        )
+        self._ingestion_queue.start()
+        register(self._ingestion_queue.close)
+
+    def enable_spool(self, directory: str = "spool", segment_size: int = 64 * 1024 * 1024,
+                     max_size: int = 1024 * 1024 * 1024, fsync: bool = False, failure_threshold: int = 3,
+                     reset_timeout: float = 30.0, slow_call_duration: float = 2.0, replay_batch_size: int = 1_000,
+                     replay_rate: Optional[float] = 5_000.0, replay_interval: float = 5.0):
+        """
+        Spools requests to append-only segment files in this process's subdirectory of directory when writing them
+        fails, or when failure_threshold writes in a row have failed or taken over slow_call_duration seconds, until a
+        trial write reset_timeout seconds later succeeds. Spooled requests are loaded back in batches of
+        replay_batch_size, at up to replay_rate requests per second, once the database is healthy again, along with
+        those left by processes that have exited. Requests the database rejects are moved to a dead letter file.
+        Segments are rotated at segment_size bytes, and requests are dropped while the spool holds max_size bytes. Must
+        be enabled before async ingestion or capture.
+        """
+        if self._ingestion_queue is not None:
+            raise ValueError("The spool must be enabled before async ingestion.")
+
+        breaker = CircuitBreaker(
+            failure_threshold=failure_threshold,
+            reset_timeout=reset_timeout,
+            slow_call_duration=slow_call_duration
+        )
+        self._spool = Spool(directory, segment_size=segment_size, max_size=max_size, fsync=fsync)
+        self._spool_guard = SpoolGuard(self._database_handler, self._spool, breaker)
+        self._spool_replayer = SpoolReplayer(
+            database_handler=self._database_handler,
+            spool=self._spool,
+            breaker=breaker,
+            batch_size=replay_batch_size,
+            max_rate=replay_rate,
+            interval=replay_interval
         )
+        self._spool_replayer.start()
+        register(self._spool.close)
+        register(self._spool_replayer.close)
+
+    def enable_geoip(self, source: str):
+        """
+        Records the country and autonomous system of each new actor, looked up in the CSV or MMDB dataset at source.
+        The dataset is compiled to an index beside it when that is missing or out of date, and the index is
+        memory-mapped, so pre-forked workers share one copy of it.
+        """
+        self._database_handler.set_geo_index(GeoIndex(compile_index(source)))
+
+    def enable_writer(self, writer: "RequestWriter"):
+        """
+        Submits captured requests to a RequestWriter running in another process, instead of writing them from this
+        one. Requests the writer cannot take in time are dropped.
+        """
+        self._writer = writer
+
+    def enable_tarpit(self, max_connections: int = 10_000, message_size: int = 1024, interval: float = 1.0,
+                      max_bytes_per_connection: int = 16 * 1024 * 1024, max_seconds_per_connection: float = 3600.0,
+                      egress_bytes_per_second: int = 1024 * 1024):
+        """
+        Hands halted scanner connections to an event loop thread instead of holding a server thread per scanner.
+        Requires the server to be started with Listener.run, or with TarpitRequestHandler as its request handler;
+        otherwise the halt stream falls back to the request thread.
+        """
+        self._tarpit = Tarpit(
+            max_connections=max_connections,
+            max_messages=self._max_halt_messages,
+            message_size=message_size,
+            interval=interval,
+            max_bytes_per_connection=max_bytes_per_connection,
+            max_seconds_per_connection=max_seconds_per_connection,
+            egress_bytes_per_second=egress_bytes_per_second
+        )
+        self._tarpit.start()
+        register(self._tarpit.close)
+
+    def enable_capture(self, max_body_size: int = 1024 * 1024):
+        """
+        Records each request as its raw WSGI pieces and responds straight away. Header parsing, address resolution and
+        scoring happen on the ingestion thread, which is enabled if it is not already, or in the writer process. Bodies
+        are kept up to max_body_size bytes.
+        """
+        if self._ingestion_queue is None and self._writer is None:
+            self.enable_async_ingestion()
+        self._capture_max_body = max_body_size
+
+    def enable_rate_tracking(self, max_actors: int = 20_000, min_halt_rate: int = 0,
+                             max_honeypot_rate: Optional[int] = None):
+        """
+        Tracks each actor's request rate over the last second, minute and hour in memory. Scanners are only halted once
+        they have sent min_halt_rate requests in the last minute, and actors sending more than max_honeypot_rate
+        requests a second are no longer served honeypots. With pre-forked workers, each worker tracks the requests it
+        received.
+        """
+        self._rate_tracker = RateTracker(max_actors=max_actors)
+        self._min_halt_rate = min_halt_rate
+        self._max_honeypot_rate = max_honeypot_rate
 
     def error_handler(self, _):
+        if self._capture_max_body is not None:
+            return self.capture_request()
         return self.handle_request(*self.unpack_request_values(request))
 
+    def capture_request(self):
+        captured = CapturedRequest(self._port, request.environ, request.stream.read(self._capture_max_body))
+        self.store(captured)
+        rates = self._rate_tracker.record(resolve_environ_address(request.environ)) if self._rate_tracker else None
+        return self.respond(captured.path, captured.is_acceptable, rates)
+
     def handle_request(self, headers: Dict[str, str], method: str, remote_address: str, uri: str, query_string: str,
                        body: Dict[str, str]):
-        if all([header in headers.keys() for header in ["X-Forwarded-For", "Cf-Ray", "Cf-Connecting-Ip", "Cf-Ray"]]):
-            connecting_ip = headers["Cf-Connecting-Ip"]
-            forwarded_for = headers["X-Forwarded-For"]
-            print(connecting_ip, forwarded_for)
-            source = connecting_ip if connecting_ip != forwarded_for else forwarded_for
-            print(source)
-            remote_address = source if self._ip_regex.match(source) else remote_address
-            print(remote_address)
-
         req = IncomingRequest(self._port).from_components(
-            host=remote_address,
+            host=resolve_remote_address(headers, remote_address),
             request_method=RequestMethod.from_str(method),
             request_headers=headers,
             request_uri=uri,
             query_string=query_string,
             request_body=body,
-            timestamp="",
+            timestamp=datetime.now(),
         )
-        self._database_handler.insert_request(req)
-        if req.is_acceptable:
+        self.store(req)
+        rates = self._rate_tracker.record(req.host.address) if self._rate_tracker else None
+        return self.respond(req.uri, req.is_acceptable, rates)
+
+    def store(self, req: Union[IncomingRequest, CapturedRequest]):
+        if self._writer is not None:
+            self._writer.submit(req)
+            self._writer.refresh_honeypots(self._database_handler)
+        elif self._ingestion_queue is None or not self._ingestion_queue.submit(req):
+            (self._spool_guard or self._database_handler).insert_request(
+                req.parse() if isinstance(req, CapturedRequest) else req)
+
+    def respond(self, uri: str, acceptable: bool, rates: Optional[Dict[str, int]] = None):
+        if acceptable:
             return "404 Not Found", 404
 
-        file = self.grab_payload_file(req.uri)
-        if (honeypot_response := self._database_handler.get_honeypot(file)) is not None:
-            response = Response("", status=200, headers=self.text_response_headers(len(honeypot_response)))
-            yield honeypot_response
-            return response
+        file = self.grab_payload_file(uri)
+        flooding = rates is not None and self._max_honeypot_rate is not None and rates["1s"] > self._max_honeypot_rate
+        if not flooding and (honeypot := self._database_handler.get_honeypot(file)) is not None:
+            content, content_length = honeypot
+            return Response(content, status=200, headers=self.text_response_headers(content_length))
 
-        if self._halt_scanner_threads:
-            for _ in range(self._max_halt_messages):
-                yield (HALT_PAYLOAD * 1024) * 1024
-                sleep(1)
-            return "", 200
+        if self._halt_scanner_threads and (rates is None or rates["1m"] >= self._min_halt_rate):
+            if self._tarpit is not None and TARPIT_ENVIRON_KEY in request.environ and self._tarpit.has_capacity:
+                request.environ[TARPIT_ENVIRON_KEY] = self._tarpit
+                return Response(status=200, headers=self.text_response_headers(self._tarpit.content_length))
+            return Response(self.halt_scanner(), status=200)
 
         return "404 Not Found", 404
 
+    def halt_scanner(self):
+        for _ in range(self._max_halt_messages):
+            yield self._halt_message
+            sleep(1)
+
     @staticmethod
     def process_connect_target(target: str) -> Optional[str]:
         if target.startswith("/"):
@@ -110,13 +343,7 @@ class Listener:
 
     @staticmethod
     def unpack_request_values(req: request) -> Tuple[Dict[str, str], str, str, str, str, Dict[str, str]]:
-        args = req.args.to_dict()
-        query_string = "&".join([f"{k}={v}" for k, v in args.items()])
-        if 'Content-Type' in req.headers and req.headers['Content-Type'] == 'application/json':
-            body = dict(req.json)
-        else:
-            body = {}
-        return dict(req.headers), req.method, req.remote_addr, req.path, query_string, body
+        return unpack_request(req)
 
     @staticmethod
     def grab_payload_file(path: str) -> str:
@@ -148,6 +375,14 @@ class Listener:
     def database_handler(self) -> DatabaseHandler:
         return self._database_handler
 
+    @property
+    def rate_tracker(self) -> Optional[RateTracker]:
+        return self._rate_tracker
+
+    @property
+    def dashboard(self) -> Optional[DashboardSnapshot]:
+        return self._dashboard
+
     @property
     def request_analyser(self) -> RequestAnalyser:
         return self._request_analyser
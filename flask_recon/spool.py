@@ -0,0 +1,445 @@
+from datetime import datetime
+from json import dumps, loads
+from mmap import mmap, ACCESS_READ
+from os import fsync, getpid, listdir, makedirs, remove, replace, rmdir
+from os.path import exists, getsize, isdir, join
+from threading import Thread, Event, Lock
+from time import monotonic
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, TextIO
+
+from psycopg2 import OperationalError
+
+from flask_recon.database import DatabaseHandler
+from flask_recon.structures import IncomingRequest, RequestMethod
+
+try:
+    from fcntl import flock, LOCK_EX, LOCK_NB
+except ImportError:  # Windows, where the server only ever runs as one process
+    flock = None
+
+SEGMENT_SUFFIX = ".seg"
+OFFSET_SUFFIX = ".offset"
+LOCK_FILE = ".lock"
+DEAD_LETTER_FILE = "dead_letters.jsonl"
+
+
+class CircuitBreaker:
+    """
+    Trips open after failure_threshold consecutive failed or slow calls, so that callers stop waiting on a database
+    that is down or stalled. After reset_timeout seconds one trial call is let through; it closes the breaker if it
+    succeeds in time and reopens it otherwise.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half open"
+    _failure_threshold: int
+    _reset_timeout: float
+    _slow_call_duration: float
+    _state: str
+    _failures: int
+    _opened_at: float
+    _lock: Lock
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0, slow_call_duration: float = 2.0):
+        if failure_threshold < 1:
+            raise ValueError("Failure threshold must be at least 1.")
+
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._slow_call_duration = slow_call_duration
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            # a trial that never reported back is given up on after the same timeout, so the breaker cannot stick
+            if monotonic() - self._opened_at >= self._reset_timeout:
+                self._state = self.HALF_OPEN
+                self._opened_at = monotonic()
+                return True
+            return False
+
+    def succeeded(self, elapsed: float) -> None:
+        if elapsed > self._slow_call_duration:
+            self.failed()
+            return
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def failed(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self._failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = monotonic()
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+
+class Spool:
+    """
+    Durable local buffer for requests that could not be written to the database. Requests are appended as
+    length-prefixed JSON records to numbered segment files, with sequential writes only, and a new segment is started
+    once the current one reaches segment_size bytes. Closed segments are read back through mmap. Requests that would
+    take the spool past max_size bytes are dropped.
+
+    Each process spools to its own subdirectory of directory, named after its pid, and holds a lock on it for as long
+    as the spool is open, so pre-forked workers never share a segment. The directories of processes that have exited
+    are found with orphans and replayed by whichever process locks them first. Without fcntl, as on Windows, the lock
+    is not taken and every other directory is treated as orphaned.
+    """
+    _root: str
+    _name: str
+    _directory: str
+    _lock_file: TextIO
+    _segment_size: int
+    _max_size: int
+    _fsync: bool
+    _segment: Optional[BinaryIO] = None
+    _segment_index: int
+    _segment_bytes: int = 0
+    _size: int
+    _dropped: int = 0
+    _lock: Lock
+
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024, max_size: int = 1024 * 1024 * 1024,
+                 fsync: bool = False, name: Optional[str] = None):
+        """Opens the subdirectory name of directory, or this process's own one. Raises ValueError if it is locked."""
+        self._root = directory
+        self._name = name or str(getpid())
+        self._directory = join(directory, self._name)
+        makedirs(self._directory, exist_ok=True)
+        self._lock_file = open(join(self._directory, LOCK_FILE), "a")
+        if flock is not None:
+            try:
+                flock(self._lock_file.fileno(), LOCK_EX | LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise ValueError(f"{self._directory} is in use by another process.")
+        self._segment_size = segment_size
+        self._max_size = max_size
+        self._fsync = fsync
+        # segments left by an earlier process are closed, and new ones are numbered after them
+        segments = self.segments()
+        self._segment_index = int(segments[-1][:-len(SEGMENT_SUFFIX)]) + 1 if segments else 0
+        self._size = sum(getsize(self.path(segment)) for segment in segments)
+        self._lock = Lock()
+
+    def append(self, requests: List[IncomingRequest]) -> int:
+        """Appends requests to the current segment, returning how many fit within max_size."""
+        appended = 0
+        with self._lock:
+            for request in requests:
+                payload = dumps(self.encode(request)).encode()
+                if self._size + 4 + len(payload) > self._max_size:
+                    break
+                if self._segment is not None and self._segment_bytes >= self._segment_size:
+                    self.close_segment()
+                if self._segment is None:
+                    self.open_segment()
+                self._segment.write(len(payload).to_bytes(4, "big") + payload)
+                self._segment_bytes += 4 + len(payload)
+                self._size += 4 + len(payload)
+                appended += 1
+            if self._segment is not None:
+                self._segment.flush()
+                if self._fsync:
+                    fsync(self._segment.fileno())
+        if dropped := len(requests) - appended:
+            previous, self._dropped = self._dropped, self._dropped + dropped
+            if not previous or previous // 1000 != (self._dropped - 1) // 1000:
+                print(f"Spool is full, {self._dropped} requests dropped")
+        return appended
+
+    def rotate(self) -> None:
+        """Closes the current segment so that it can be replayed. The next append starts a new one."""
+        with self._lock:
+            self.close_segment()
+
+    def open_segment(self) -> None:
+        # the directory is removed when a spool is closed empty, which a late append may follow
+        makedirs(self._directory, exist_ok=True)
+        self._segment = open(self.path(f"{self._segment_index:012d}{SEGMENT_SUFFIX}"), "ab")
+        self._segment_index += 1
+        self._segment_bytes = 0
+
+    def close_segment(self) -> None:
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def close(self) -> None:
+        """Closes the current segment and releases the directory, removing it if nothing is left to replay."""
+        self.rotate()
+        if self._lock_file.closed:
+            return
+        try:
+            if not self.segments():
+                remove(join(self._directory, LOCK_FILE))
+                rmdir(self._directory)
+        except OSError:
+            pass
+        self._lock_file.close()
+
+    def orphans(self) -> Iterator["Spool"]:
+        """
+        Yields a Spool for each directory beside this one whose process has exited, locked until it is closed. The
+        caller must close each one.
+        """
+        for name in sorted(listdir(self._root)):
+            if name == self._name or not isdir(join(self._root, name)):
+                continue
+            try:
+                yield Spool(self._root, self._segment_size, self._max_size, self._fsync, name=name)
+            except (ValueError, OSError):
+                continue
+
+    def segments(self) -> List[str]:
+        if not isdir(self._directory):
+            return []
+        return sorted(name for name in listdir(self._directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def closed_segments(self) -> List[str]:
+        """Segments no longer being appended to, oldest first."""
+        current = self._segment.name if self._segment is not None else None
+        return [segment for segment in self.segments() if self.path(segment) != current]
+
+    def read(self, segment: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        """
+        Yields (end offset, record) for each record in a closed segment after its replay offset. A record cut short by
+        a crash while it was being written ends the segment.
+        """
+        offset = self.replayed_offset(segment)
+        with open(self.path(segment), "rb") as file:
+            if getsize(self.path(segment)) <= offset:
+                return
+            with mmap(file.fileno(), 0, access=ACCESS_READ) as view:
+                while offset + 4 <= len(view):
+                    end = offset + 4 + int.from_bytes(view[offset:offset + 4], "big")
+                    if end > len(view):
+                        return
+                    yield end, loads(view[offset + 4:end])
+                    offset = end
+
+    def replayed_offset(self, segment: str) -> int:
+        if not exists(offset_path := self.path(segment) + OFFSET_SUFFIX):
+            return 0
+        with open(offset_path) as file:
+            return int(file.read() or 0)
+
+    def mark_replayed(self, segment: str, offset: int) -> None:
+        # written beside the offset file and moved over it, so a crash cannot leave it empty
+        offset_path = self.path(segment) + OFFSET_SUFFIX
+        with open(offset_path + ".tmp", "w") as file:
+            file.write(str(offset))
+        replace(offset_path + ".tmp", offset_path)
+
+    def dead_letter(self, record: Dict[str, Any], error: Exception) -> None:
+        """Sets aside a record the database rejects, so that replay can move past it."""
+        with open(join(self._root, DEAD_LETTER_FILE), "a") as file:
+            file.write(dumps({"error": str(error).strip(), "request": record}) + "\n")
+
+    def remove(self, segment: str) -> None:
+        size = getsize(self.path(segment))
+        remove(self.path(segment))
+        if exists(offset_path := self.path(segment) + OFFSET_SUFFIX):
+            remove(offset_path)
+        with self._lock:
+            self._size -= size
+
+    def path(self, segment: str) -> str:
+        return join(self._directory, segment)
+
+    @staticmethod
+    def encode(request: IncomingRequest) -> Dict[str, Any]:
+        timestamp = request.timestamp if isinstance(request.timestamp, datetime) else datetime.now()
+        return {
+            "host": request.host.address,
+            "timestamp": timestamp.isoformat(),
+            "method": request.method.value,
+            "path": request.uri,
+            "query_string": request.query_string,
+            "headers": request.headers,
+            "body": request.body,
+            "port": request.local_port,
+        }
+
+    @staticmethod
+    def decode(record: Dict[str, Any]) -> IncomingRequest:
+        return IncomingRequest(record["port"]).from_components(
+            host=record["host"],
+            request_method=RequestMethod.from_str(record["method"]),
+            request_headers=record["headers"],
+            request_uri=record["path"],
+            query_string=record["query_string"],
+            request_body=record["body"],
+            timestamp=datetime.fromisoformat(record["timestamp"]),
+        )
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+
+class SpoolGuard:
+    """
+    Stands in for a DatabaseHandler when writing requests. Writes go through a circuit breaker, and requests are
+    appended to the spool instead whenever a write fails or the breaker is open, so a database that is down or
+    stalled neither loses them nor holds up the caller.
+    """
+    _database_handler: DatabaseHandler
+    _spool: Spool
+    _breaker: CircuitBreaker
+
+    def __init__(self, database_handler: DatabaseHandler, spool: Spool, breaker: CircuitBreaker):
+        self._database_handler = database_handler
+        self._spool = spool
+        self._breaker = breaker
+
+    def insert_request(self, request: IncomingRequest) -> None:
+        self.write(self._database_handler.insert_request, request, [request])
+
+    def insert_requests(self, requests: List[IncomingRequest]) -> None:
+        self.write(self._database_handler.insert_requests, requests, requests)
+
+    def write(self, insert: Callable[[Any], None], argument: Any, requests: List[IncomingRequest]) -> None:
+        if not self._breaker.allow():
+            self._spool.append(requests)
+            return
+        started = monotonic()
+        try:
+            insert(argument)
+        except Exception as e:
+            # only a database that cannot be reached counts against the breaker; requests it rejected are spooled
+            # too, and set aside one by one on replay
+            if isinstance(e, OperationalError):
+                self._breaker.failed()
+            print(f"Spooling {len(requests)} requests, the database write failed: {e}")
+            self._spool.append(requests)
+            return
+        self._breaker.succeeded(monotonic() - started)
+
+
+class SpoolReplayer:
+    """
+    Background thread that loads spooled requests back into the database once it is reachable, in batches of
+    batch_size with at most max_rate requests per second, oldest segment first, followed by the spools of processes
+    that have exited. Progress through a segment is recorded after every batch, so a failed or interrupted replay
+    resumes from the last batch recorded; a crash between a batch's commit and its record can write that batch twice.
+    A request the database rejects is moved to the dead letter file beside the spool directories.
+    """
+    _database_handler: DatabaseHandler
+    _spool: Spool
+    _breaker: CircuitBreaker
+    _batch_size: int
+    _max_rate: Optional[float]
+    _interval: float
+    _worker: Thread
+    _stopping: Event
+
+    def __init__(self, database_handler: DatabaseHandler, spool: Spool, breaker: CircuitBreaker,
+                 batch_size: int = 1_000, max_rate: Optional[float] = 5_000.0, interval: float = 5.0):
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1.")
+
+        self._database_handler = database_handler
+        self._spool = spool
+        self._breaker = breaker
+        self._batch_size = batch_size
+        self._max_rate = max_rate
+        self._interval = interval
+        self._worker = Thread(target=self.run, name="flask-recon-spool-replayer", daemon=True)
+        self._stopping = Event()
+
+    def start(self) -> None:
+        self._worker.start()
+
+    def close(self, timeout: float = 30.0) -> None:
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        if self._worker.is_alive():
+            self._worker.join(timeout)
+
+    def run(self) -> None:
+        while not self._stopping.wait(self._interval):
+            try:
+                self.replay()
+            except Exception as e:
+                self._breaker.failed()
+                print(f"Spool replay failed: {e}")
+
+    def replay(self) -> int:
+        """
+        Replays every request in this process's spool and in orphaned ones if the breaker allows it, returning how
+        many were written. While the breaker is open, the first batch is its trial call.
+        """
+        replayed, started = 0, monotonic()
+        if self._spool.size and self._breaker.allow():
+            self._spool.rotate()
+            replayed += self.replay_spool(self._spool, replayed, started)
+        for orphan in self._spool.orphans():
+            try:
+                if self._stopping.is_set() or (orphan.size and not self._breaker.allow()):
+                    continue
+                replayed += self.replay_spool(orphan, replayed, started)
+            finally:
+                orphan.close()
+        if replayed:
+            elapsed = monotonic() - started
+            print(f"Replayed {replayed} spooled requests in {elapsed:.1f}s ({replayed / elapsed:.0f}/s)")
+        return replayed
+
+    def replay_spool(self, spool: Spool, replayed: int, started: float) -> int:
+        written = 0
+        for segment in spool.closed_segments():
+            batch, end = [], 0
+            for end, record in spool.read(segment):
+                batch.append(record)
+                if len(batch) >= self._batch_size:
+                    written += self.write(spool, segment, batch, end, replayed + written, started)
+                    batch = []
+                    if self._stopping.is_set():
+                        return written
+            if batch:
+                written += self.write(spool, segment, batch, end, replayed + written, started)
+            spool.remove(segment)
+        return written
+
+    def write(self, spool: Spool, segment: str, batch: List[Dict[str, Any]], end: int, replayed: int,
+              started: float) -> int:
+        if self._max_rate:
+            # keeps a recovering database from being flooded by the backlog
+            self._stopping.wait(max(0.0, (replayed + len(batch)) / self._max_rate - (monotonic() - started)))
+        write_started = monotonic()
+        written = self.insert(spool, batch)
+        self._breaker.succeeded(monotonic() - write_started)
+        spool.mark_replayed(segment, end)
+        return written
+
+    def insert(self, spool: Spool, records: List[Dict[str, Any]]) -> int:
+        """
+        Writes records in one transaction, splitting the batch in half and retrying each half if that fails, until
+        the records the database rejects are found and dead lettered. Failures to reach the database are raised.
+        """
+        try:
+            self._database_handler.insert_requests([Spool.decode(record) for record in records])
+            return len(records)
+        except OperationalError:
+            raise
+        except Exception as e:
+            if len(records) == 1:
+                print(f"Dead lettering spooled request {records[0].get('method')} {records[0].get('path')}: {e}")
+                spool.dead_letter(records[0], e)
+                return 0
+            middle = len(records) // 2
+            return self.insert(spool, records[:middle]) + self.insert(spool, records[middle:])
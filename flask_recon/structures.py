@@ -1,11 +1,14 @@
+from array import array
+from datetime import datetime, timedelta
 from enum import Enum
 from json import dumps
-from typing import Dict, Optional, List, Tuple
+from sys import intern
+from typing import Any, Dict, Optional, List, Tuple, Iterator
 
 import werkzeug.exceptions
 from flask import Request
 
-from flask_recon.flags import KNOWN_FLAGS, Flag, RequestType, AttackType
+from flask_recon.flags import KNOWN_FLAGS, Flag, FlagMatcher, RequestType, AttackType
 
 HALT_PAYLOAD = "STOP SCANNING"
 
@@ -49,12 +52,14 @@ class RequestMethod(Enum):
 
 
 class RemoteHost:
+    __slots__ = ("_address", "_open_ports")
     _address: str
-    _open_ports: Dict[int, bool]
+    _open_ports: Optional[Dict[int, bool]]
 
     def __init__(self, address: str):
-        self._address = address
-        self._open_ports = {}
+        self._address = intern(address) if address is not None else None
+        # most hosts never have an open port recorded, so the dict is only allocated for the first one
+        self._open_ports = None
 
     @property
     def address(self) -> str:
@@ -62,13 +67,18 @@ class RemoteHost:
 
     @property
     def open_ports(self) -> Dict[int, bool]:
-        return self._open_ports
+        return self._open_ports if self._open_ports is not None else {}
 
     def add_open_port(self, port: int) -> None:
+        if self._open_ports is None:
+            self._open_ports = {}
         self._open_ports[port] = True
 
 
 class IncomingRequest:
+    __slots__ = ("_host", "_local_port", "_request_method", "_request_headers", "_request_uri", "_query_string",
+                 "_request_body", "_timestamp", "_threat_level", "_request_id", "_request_types", "_attack_types",
+                 "_matched_flags", "_flags_version")
     _csv_sep: str = ","
     _host: RemoteHost
     _local_port: int
@@ -77,16 +87,20 @@ class IncomingRequest:
     _request_uri: str
     _query_string: Optional[str]
     _request_body: Optional[Dict[str, str]]
-    _is_acceptable: bool
-    _headers: dict
     _timestamp: str
     _threat_level: Optional[int]
     _request_id: Optional[int]
-    _request_types: Optional[List[RequestType]] = None
-    _attack_types: Optional[List[AttackType]] = None
+    _request_types: Optional[List[RequestType]]
+    _attack_types: Optional[List[AttackType]]
+    _matched_flags: Optional[List[Tuple[str, str]]]
+    _flags_version: Optional[str]
 
     def __init__(self, local_port: int):
         self._local_port = local_port
+        self._request_types = None
+        self._attack_types = None
+        self._matched_flags = None
+        self._flags_version = None
 
     def from_request(self, request: Request) -> "IncomingRequest":
         self._host = RemoteHost(request.remote_addr)
@@ -103,27 +117,37 @@ class IncomingRequest:
     def from_components(self, host: str, request_method: RequestMethod, request_headers: Optional[Dict[str, str]],
                         request_uri: str, query_string: Optional[str], request_body: Optional[Dict[str, str]],
                         timestamp: str, threat_level: Optional[int] = None,
-                        request_id: Optional[int] = None) -> "IncomingRequest":
+                        request_id: Optional[int] = None, request_types: Optional[List[str]] = None,
+                        attack_types: Optional[List[str]] = None) -> "IncomingRequest":
         self._host = RemoteHost(host)
-        self._request_method = request_method
+        # read paths pass the method as stored, and a page repeats a handful of methods and paths many times
+        self._request_method = intern(request_method) if isinstance(request_method, str) else request_method
         self._request_headers = request_headers
-        self._request_uri = request_uri
+        self._request_uri = intern(request_uri) if isinstance(request_uri, str) else request_uri
         self._query_string = query_string
         self._request_body = request_body
         self._timestamp = timestamp
         self._threat_level = threat_level
         self._request_id = request_id
+        if request_types is not None:
+            self._request_types = [RequestType.from_str(request_type) for request_type in request_types]
+        if attack_types is not None:
+            self._attack_types = [AttackType.from_str(attack_type) for attack_type in attack_types]
         return self
 
     def determine_threat_level(self):
         method_score, uri_score, query_score, body_score, ua_score = 5, 4, 5, 0, 5
         total_request_types, total_attack_types = [], []
+        matched_flags = []
+        self._flags_version = KNOWN_FLAGS.version
 
         if self._request_headers and "user-agent" in [k.lower() for k in self._request_headers.keys()]:
             ua = self._request_headers.get("user-agent") or self._request_headers.get("User-Agent")
-            ua_score, request_types, attack_types = self.calc_avg_tl_str(ua, KNOWN_FLAGS.known_ua_flags)
+            ua_flags = KNOWN_FLAGS.ua_matcher.match(ua)
+            ua_score, request_types, attack_types = self.calc_avg_tl_flags(ua_flags)
             total_request_types.extend(request_types)
             total_attack_types.extend(attack_types)
+            matched_flags.extend(("user_agent", flag.flag) for flag in ua_flags)
 
         if self._request_method in [RequestMethod.POST, RequestMethod.PUT]:
             method_score = 10
@@ -136,45 +160,42 @@ class IncomingRequest:
 
         if self._request_uri == "/":
             uri_score = 0
-        elif any(map(self._request_uri.__contains__, [flag.flag for flag in KNOWN_FLAGS.known_payload_flags])):
-            uri_score, request_types, attack_types = self.calc_avg_tl_str(self._request_uri,
-                                                                          KNOWN_FLAGS.known_payload_flags)
+        elif uri_flags := KNOWN_FLAGS.payload_matcher.match(self._request_uri):
+            uri_score, request_types, attack_types = self.calc_avg_tl_flags(uri_flags)
             total_request_types.extend(request_types)
             total_attack_types.extend(attack_types)
+            matched_flags.extend(("payload", flag.flag) for flag in uri_flags)
         else:
             uri_score = 6
 
         if self._query_string:
-            query_score, request_types, attack_types = self.calc_avg_tl_str(self._query_string,
-                                                                            KNOWN_FLAGS.known_payload_flags)
+            query_flags = KNOWN_FLAGS.payload_matcher.match(self._query_string)
+            query_score, request_types, attack_types = self.calc_avg_tl_flags(query_flags)
             total_request_types.extend(request_types)
             total_attack_types.extend(attack_types)
+            matched_flags.extend(("payload", flag.flag) for flag in query_flags)
         if self._request_body:
             body_score = 10
 
-        deduped_request_types = []
-        deduped_attack_types = []
-        for rtype in total_request_types:
-            if rtype not in deduped_request_types:
-                deduped_request_types.append(rtype)
-        for atype in total_attack_types:
-            if atype not in deduped_attack_types:
-                deduped_attack_types.append(atype)
-
-        if len(deduped_request_types) == 0:
-            deduped_request_types.append(RequestType.OTHER)
-        self._request_types = sorted(deduped_request_types, key=lambda x: total_request_types.count(x), reverse=True)
-        self._attack_types = sorted(deduped_attack_types, key=lambda x: total_attack_types.count(x), reverse=True)
+        self._request_types = self.rank_types(total_request_types) or [RequestType.OTHER]
+        self._attack_types = self.rank_types(total_attack_types)
         self._threat_level = int(round((method_score + uri_score + query_score + body_score + ua_score) / 5, 0))
+        self._matched_flags = list(dict.fromkeys(matched_flags))
 
     @staticmethod
-    def calc_avg_tl_str(value: str, flags: List[Flag]) -> Tuple[float, List[RequestType], List[AttackType]]:
+    def rank_types(types: List[Any]) -> List[Any]:
+        """Distinct types, most frequent first, with ties kept in order of first appearance."""
+        return sorted(dict.fromkeys(types), key=types.count, reverse=True)
+
+    @staticmethod
+    def calc_avg_tl_str(value: str, matcher: FlagMatcher) -> Tuple[float, List[RequestType], List[AttackType]]:
+        return IncomingRequest.calc_avg_tl_flags(matcher.match(value))
+
+    @staticmethod
+    def calc_avg_tl_flags(flags: List[Flag]) -> Tuple[float, List[RequestType], List[AttackType]]:
         threat_level, flag_count = 0, 0
         request_types, attack_types = [], []
         for flag in flags:
-            if flag.flag not in value:
-                continue
-
             threat_level += flag.score
             flag_count += 1
             request_types.extend(flag.request_types)
@@ -196,6 +217,23 @@ class IncomingRequest:
                 f"{self.escape_csv(self.query_string)}{s}{self.escape_csv(dumps(self.headers))}{s}"
                 f"{self.escape_csv(dumps(self.body))}{s}{self.timestamp}")
 
+    @property
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "host": self.host.address,
+            "method": getattr(self.method, "value", self.method),
+            "uri": self.uri,
+            "query_string": self.query_string,
+            "headers": self.headers,
+            "body": self.body,
+            "port": self.local_port,
+            "timestamp": str(self.timestamp),
+            "threat_level": self.threat_level,
+            "request_types": [request_type.value for request_type in self.request_types or []],
+            "attack_types": [attack_type.value for attack_type in self.attack_types or []],
+        }
+
     @staticmethod
     def escape_csv(value: str) -> str:
         value = value.replace('"', '""')
@@ -252,3 +290,175 @@ class IncomingRequest:
     @property
     def attack_types(self) -> Optional[List[AttackType]]:
         return self._attack_types
+
+    @property
+    def matched_flags(self) -> Optional[List[Tuple[str, str]]]:
+        """(kind, flag) pairs that matched when the threat level was last determined."""
+        return self._matched_flags
+
+    @property
+    def flags_version(self) -> Optional[str]:
+        return self._flags_version
+
+
+class RequestBatch:
+    """
+    Columnar page of requests, holding one array or list per field instead of one IncomingRequest per row. Numbers and
+    timestamps are packed into arrays, repeated strings are interned and repeated type lists shared, so large reads for
+    analytics take a fraction of the memory of a list of IncomingRequest. Rows are appended in the column order of
+    DatabaseHandler.get_request_page.
+    """
+    __slots__ = ("_request_ids", "_hosts", "_timestamps", "_methods", "_paths", "_query_strings", "_ports",
+                 "_threat_levels", "_request_types", "_attack_types", "_headers", "_bodies", "_type_lists")
+    _epoch = datetime(1970, 1, 1)
+    _request_ids: array
+    _hosts: List[str]
+    _timestamps: array
+    _methods: List[str]
+    _paths: List[str]
+    _query_strings: List[Optional[str]]
+    _ports: array
+    _threat_levels: array
+    _request_types: List[Tuple[str, ...]]
+    _attack_types: List[Tuple[str, ...]]
+    _headers: Optional[List[Optional[Dict[str, Any]]]]
+    _bodies: Optional[List[Optional[Dict[str, Any]]]]
+    _type_lists: Dict[Tuple[str, ...], Tuple[str, ...]]
+
+    def __init__(self, fields: Tuple[str, ...] = ()):
+        self._request_ids = array("q")
+        self._hosts = []
+        self._timestamps = array("q")
+        self._methods = []
+        self._paths = []
+        self._query_strings = []
+        self._ports = array("l")
+        self._threat_levels = array("h")
+        self._request_types = []
+        self._attack_types = []
+        self._headers = [] if "headers" in fields else None
+        self._bodies = [] if "body" in fields else None
+        self._type_lists = {}
+
+    def append(self, row: Tuple) -> None:
+        """
+        Appends a (host, timestamp, method, query_string, port, path, request_id, threat_level, request_types,
+        attack_types, headers, body) row.
+        """
+        host, timestamp, method, query_string, port, path, request_id, threat_level, request_types, attack_types, \
+            headers, body = row
+        self._request_ids.append(request_id)
+        self._hosts.append(intern(host))
+        # whole microseconds since the epoch, exactly as stored, without a datetime object per row
+        self._timestamps.append((timestamp - self._epoch) // timedelta(microseconds=1))
+        self._methods.append(intern(method))
+        self._paths.append(intern(path))
+        self._query_strings.append(query_string)
+        self._ports.append(port)
+        self._threat_levels.append(threat_level)
+        self._request_types.append(self._type_lists.setdefault(tuple(request_types), tuple(request_types)))
+        self._attack_types.append(self._type_lists.setdefault(tuple(attack_types), tuple(attack_types)))
+        if self._headers is not None:
+            self._headers.append(headers)
+        if self._bodies is not None:
+            self._bodies.append(body)
+
+    def __len__(self) -> int:
+        return len(self._request_ids)
+
+    def __getitem__(self, index: int) -> IncomingRequest:
+        """Materialises one row as an IncomingRequest."""
+        return IncomingRequest(self._ports[index]).from_components(
+            host=self._hosts[index],
+            timestamp=self.timestamp(index),
+            request_method=self._methods[index],
+            request_headers=self._headers[index] if self._headers is not None else None,
+            request_body=self._bodies[index] if self._bodies is not None else None,
+            query_string=self._query_strings[index],
+            request_uri=self._paths[index],
+            request_id=self._request_ids[index],
+            threat_level=self._threat_levels[index],
+            request_types=list(self._request_types[index]),
+            attack_types=list(self._attack_types[index]),
+        )
+
+    def __iter__(self) -> Iterator[IncomingRequest]:
+        return (self[index] for index in range(len(self)))
+
+    def timestamp(self, index: int) -> datetime:
+        return self._epoch + timedelta(microseconds=self._timestamps[index])
+
+    @property
+    def request_ids(self) -> array:
+        return self._request_ids
+
+    @property
+    def hosts(self) -> List[str]:
+        return self._hosts
+
+    @property
+    def timestamps(self) -> array:
+        """Microseconds since 1970-01-01, in the server's time zone like the stored timestamps."""
+        return self._timestamps
+
+    @property
+    def methods(self) -> List[str]:
+        return self._methods
+
+    @property
+    def paths(self) -> List[str]:
+        return self._paths
+
+    @property
+    def query_strings(self) -> List[Optional[str]]:
+        return self._query_strings
+
+    @property
+    def ports(self) -> array:
+        return self._ports
+
+    @property
+    def threat_levels(self) -> array:
+        return self._threat_levels
+
+    @property
+    def request_types(self) -> List[Tuple[str, ...]]:
+        return self._request_types
+
+    @property
+    def attack_types(self) -> List[Tuple[str, ...]]:
+        return self._attack_types
+
+    @property
+    def headers(self) -> Optional[List[Optional[Dict[str, Any]]]]:
+        return self._headers
+
+    @property
+    def bodies(self) -> Optional[List[Optional[Dict[str, Any]]]]:
+        return self._bodies
+
+
+def classify_rows(rows: List[Tuple]) -> List[Tuple[int, int, List[str], List[str], str, List[Tuple[str, str]]]]:
+    """
+    Scores (request_id, method, path, query_string, headers, body, port) rows with the loaded flags, returning
+    (request_id, threat_level, request_types, attack_types, flags_version, matched_flags) rows. Touches no database
+    state, so that bulk rescoring can run it in worker processes.
+    """
+    classified = []
+    for request_id, method, path, query_string, headers, body, port in rows:
+        request = IncomingRequest(port).from_components(
+            host="",
+            request_method=RequestMethod.from_str(method),
+            request_headers=headers,
+            request_uri=path,
+            query_string=query_string,
+            request_body=body,
+            timestamp="",
+            request_id=request_id,
+        )
+        request.determine_threat_level()
+        classified.append((request_id, request.threat_level,
+                           [request_type.value for request_type in request.request_types],
+                           [attack_type.value for attack_type in request.attack_types],
+                           request.flags_version, request.matched_flags))
+    return classified
@@ -0,0 +1,146 @@
+from asyncio import AbstractEventLoop, new_event_loop, sleep, Task
+from math import ceil
+from socket import socket
+from ssl import SSLSocket
+from threading import Thread
+from typing import Set, Optional
+
+from werkzeug.serving import WSGIRequestHandler
+
+from flask_recon.structures import HALT_PAYLOAD
+
+TARPIT_ENVIRON_KEY = "flask_recon.tarpit"
+
+
+class EgressBudget:
+    """Token bucket shared by every tarpitted connection, capping the total bytes per second sent to scanners."""
+    _loop: AbstractEventLoop
+    _rate: int
+    _tokens: float
+    _updated: float
+
+    def __init__(self, loop: AbstractEventLoop, bytes_per_second: int):
+        self._loop = loop
+        self._rate = bytes_per_second
+        self._tokens = bytes_per_second
+        self._updated = loop.time()
+
+    async def acquire(self, size: int) -> None:
+        # only ever awaited on the tarpit's event loop thread, so no lock is needed
+        while True:
+            now = self._loop.time()
+            self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= size:
+                self._tokens -= size
+                return
+            await sleep((size - self._tokens) / self._rate)
+
+
+class Tarpit:
+    """
+    Holds scanner connections open on a single asyncio event loop thread, sending one message per interval from a
+    shared preallocated buffer until a per-connection message, byte or time cap is reached.
+    """
+    _loop: AbstractEventLoop
+    _thread: Thread
+    _budget: EgressBudget
+    _payload: memoryview
+    _connections: Set[Task]
+    _max_connections: int
+    _max_messages: int
+    _interval: float
+    _max_bytes: int
+    _max_seconds: float
+
+    def __init__(self, max_connections: int = 10_000, max_messages: int = 100_000, message_size: int = 1024,
+                 interval: float = 1.0, max_bytes_per_connection: int = 16 * 1024 * 1024,
+                 max_seconds_per_connection: float = 3600.0, egress_bytes_per_second: int = 1024 * 1024):
+        if message_size > egress_bytes_per_second:
+            raise ValueError("Message size must not exceed the egress budget.")
+
+        self._loop = new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, name="flask-recon-tarpit", daemon=True)
+        self._budget = EgressBudget(self._loop, egress_bytes_per_second)
+        self._payload = memoryview((HALT_PAYLOAD * ceil(message_size / len(HALT_PAYLOAD))).encode()[:message_size])
+        self._connections = set()
+        self._max_connections = max_connections
+        self._max_messages = max_messages
+        self._interval = interval
+        self._max_bytes = max_bytes_per_connection
+        self._max_seconds = max_seconds_per_connection
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        if not self._loop.is_running():
+            return
+        self._loop.call_soon_threadsafe(self.cancel_all)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+
+    def cancel_all(self) -> None:
+        for task in self._connections:
+            task.cancel()
+
+    def hold(self, connection: socket) -> None:
+        """Takes ownership of a connection whose response headers have already been sent."""
+        self._loop.call_soon_threadsafe(self.spawn, connection)
+
+    def spawn(self, connection: socket) -> None:
+        if len(self._connections) >= self._max_connections:
+            connection.close()
+            return
+        task = self._loop.create_task(self.drip(connection))
+        self._connections.add(task)
+        task.add_done_callback(self._connections.discard)
+
+    async def drip(self, connection: socket) -> None:
+        connection.setblocking(False)
+        deadline = self._loop.time() + self._max_seconds
+        remaining = self.content_length
+        try:
+            while remaining > 0 and self._loop.time() < deadline:
+                chunk = self._payload[:min(len(self._payload), remaining)]
+                await self._budget.acquire(len(chunk))
+                await self._loop.sock_sendall(connection, chunk)
+                remaining -= len(chunk)
+                await sleep(self._interval)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+    @property
+    def has_capacity(self) -> bool:
+        return len(self._connections) < self._max_connections
+
+    @property
+    def active_connections(self) -> int:
+        return len(self._connections)
+
+    @property
+    def content_length(self) -> int:
+        """Total body size promised to each tarpitted connection."""
+        return min(self._max_messages * len(self._payload), self._max_bytes)
+
+
+class TarpitRequestHandler(WSGIRequestHandler):
+    """
+    Werkzeug request handler that advertises tarpit support to the application. If the application sets the tarpit in
+    the environ, the connection is handed to it once the response headers are sent instead of being closed.
+    """
+
+    def make_environ(self):
+        environ = super().make_environ()
+        if not isinstance(self.connection, SSLSocket):
+            environ[TARPIT_ENVIRON_KEY] = None
+        return environ
+
+    def finish(self) -> None:
+        super().finish()
+        tarpit: Optional[Tarpit] = getattr(self, "environ", {}).get(TARPIT_ENVIRON_KEY)
+        if tarpit is not None:
+            # detaching leaves the server closing an empty socket object rather than the connection itself
+            tarpit.hold(socket(fileno=self.connection.detach()))
@@ -15,6 +15,7 @@ TEMPLATE_FILES = [
     "flask_recon/templates/hosts.html",
     "flask_recon/templates/hosts_by_endpoint.html",
     "flask_recon/templates/navbar.html",
+    "flask_recon/templates/pagination.html",
     "flask_recon/templates/request_table.html",
     "flask_recon/templates/search.html",
     "flask_recon/templates/view_endpoints.html",
@@ -0,0 +1,173 @@
+from ctypes import c_longlong
+from multiprocessing import Value
+from os import rmdir, unlink
+from os.path import join
+from pickle import dumps, loads, HIGHEST_PROTOCOL
+from queue import Queue
+from signal import signal, SIGTERM, SIGINT, SIGHUP, SIG_IGN
+from socket import socket, AF_UNIX, SOCK_STREAM
+from tempfile import mkdtemp
+from threading import Event, Lock, Thread
+from typing import Dict, List, Optional, Union
+
+from flask_recon.capture import CapturedRequest
+from flask_recon.classify import Reclassifier
+from flask_recon.database import DatabaseHandler
+from flask_recon.geoip import GeoIndex, compile_index
+from flask_recon.ingest import IngestionQueue
+from flask_recon.retention import PartitionMaintainer
+from flask_recon.structures import IncomingRequest
+
+
+class RequestWriter:
+    """
+    A single process that writes the requests recorded by any number of capture processes. Each capture process
+    streams requests to the writer over its own connection to a Unix socket in a private directory, and the writer
+    process alone resolves actors and inserts them in batches. It also runs reclassification and partition maintenance,
+    and is the only process watching the honeypots table; capture processes reload their honeypot cache when the
+    writer's honeypot version moves. The database therefore sees the same few connections and the same commit rate
+    however many capture processes run.
+
+    The listening socket is opened when the RequestWriter is created, before any process is forked, so a restarted
+    writer process picks up where the last one stopped. When the writer falls behind, its queue fills and it stops
+    reading, and submit blocks for up to max_wait seconds. That slows the capture threads down, and through them the
+    clients. Requests that still cannot be sent are dropped and counted. With geoip_source, new actors are located
+    as Listener.enable_geoip does.
+    """
+    _database_config: Dict[str, str]
+    _socket_directory: str
+    _listening_socket: socket
+    _connection: Optional[socket] = None
+    _connection_lock: Lock
+    _honeypot_version: c_longlong
+    _seen_honeypot_version: int = 0
+    _max_queue_size: int
+    _batch_size: int
+    _flush_interval: float
+    _max_connections: int
+    _max_wait: float
+    _geoip_source: Optional[str]
+    _dropped: int = 0
+
+    def __init__(self, database_config: Dict[str, str], max_queue_size: int = 50_000, batch_size: int = 500,
+                 flush_interval: float = 1.0, max_connections: int = 4, max_wait: float = 1.0,
+                 geoip_source: Optional[str] = None):
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1.")
+
+        self._database_config = database_config
+        # mkdtemp creates the directory readable by this user only, so no one else can connect or read the socket
+        self._socket_directory = mkdtemp(prefix="flask-recon-writer-")
+        self._listening_socket = socket(AF_UNIX, SOCK_STREAM)
+        self._listening_socket.bind(self.socket_path)
+        self._listening_socket.listen(128)
+        self._connection_lock = Lock()
+        self._honeypot_version = Value("q", 0, lock=False)
+        self._max_queue_size = max_queue_size
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_connections = max_connections
+        self._max_wait = max_wait
+        self._geoip_source = geoip_source
+
+    def submit(self, request: Union[IncomingRequest, CapturedRequest]) -> bool:
+        """Sends a request to the writer process. Returns False if it was dropped because it could not be sent."""
+        frame = dumps(request, HIGHEST_PROTOCOL)
+        with self._connection_lock:
+            try:
+                if self._connection is None:
+                    self._connection = socket(AF_UNIX, SOCK_STREAM)
+                    self._connection.settimeout(self._max_wait)
+                    self._connection.connect(self.socket_path)
+                self._connection.sendall(len(frame).to_bytes(4, "big") + frame)
+                return True
+            except OSError:
+                # a frame may have been cut short, so the connection cannot be reused
+                self._connection.close()
+                self._connection = None
+        self._dropped += 1
+        if self._dropped % 1000 == 1:
+            print(f"Request writer is unavailable or behind, {self._dropped} requests dropped by this process")
+        return False
+
+    def refresh_honeypots(self, database_handler: DatabaseHandler) -> None:
+        """Reloads a capture process's honeypot cache if the writer has seen the honeypots change since."""
+        if (version := self._honeypot_version.value) != self._seen_honeypot_version:
+            self._seen_honeypot_version = version
+            database_handler.reload_honeypots()
+
+    def run(self) -> None:
+        """Body of the writer process. Returns once SIGTERM is received and everything queued has been written."""
+        stopping = Event()
+        signal(SIGINT, SIG_IGN)
+        signal(SIGHUP, SIG_IGN)
+        signal(SIGTERM, lambda *_: stopping.set())
+
+        database_handler = DatabaseHandler(**self._database_config, max_connections=self._max_connections)
+        if self._geoip_source is not None:
+            # actors are only ever created here, so capture processes need no index
+            database_handler.set_geo_index(GeoIndex(compile_index(self._geoip_source)))
+        queue = Queue(self._max_queue_size)
+        ingestion_queue = IngestionQueue(database_handler, batch_size=self._batch_size,
+                                         flush_interval=self._flush_interval, queue=queue)
+        reclassifier = Reclassifier(database_handler)
+        partition_maintainer = PartitionMaintainer(database_handler)
+        for component in (ingestion_queue, reclassifier, partition_maintainer):
+            component.start()
+        receivers = []
+        Thread(target=self.accept, args=(queue, receivers), name="flask-recon-writer-accept", daemon=True).start()
+        database_handler.watch_honeypots()
+        loaded = database_handler.honeypot_version
+        try:
+            while not stopping.wait(1.0):
+                # counted here rather than copied, so that a restarted writer never repeats a version already seen
+                if database_handler.honeypot_version != loaded:
+                    loaded = database_handler.honeypot_version
+                    self._honeypot_version.value += 1
+        finally:
+            # capture processes are stopped before the writer, so their connections end once what they sent is read
+            for receiver in receivers:
+                receiver.join(self._max_wait * 10)
+            ingestion_queue.close()
+            reclassifier.close()
+            partition_maintainer.close()
+            database_handler.close()
+
+    def accept(self, queue: Queue, receivers: List[Thread]) -> None:
+        while True:
+            connection, _ = self._listening_socket.accept()
+            receiver = Thread(target=self.receive, args=(connection, queue), name="flask-recon-writer-receive",
+                              daemon=True)
+            receiver.start()
+            receivers.append(receiver)
+
+    @staticmethod
+    def receive(connection: socket, queue: Queue) -> None:
+        """Reads one capture process's requests into queue, blocking while it is full so that the sender blocks too."""
+        stream = connection.makefile("rb")
+        try:
+            while len(header := stream.read(4)) == 4:
+                size = int.from_bytes(header, "big")
+                if len(frame := stream.read(size)) < size:
+                    break
+                queue.put(loads(frame))
+        finally:
+            stream.close()
+            connection.close()
+
+    def close(self) -> None:
+        """Removes the socket. Called by the process that created the RequestWriter once the writer has stopped."""
+        self._listening_socket.close()
+        try:
+            unlink(self.socket_path)
+            rmdir(self._socket_directory)
+        except OSError:
+            pass
+
+    @property
+    def socket_path(self) -> str:
+        return join(self._socket_directory, "writer.sock")
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
@@ -1,3 +1,10 @@
+DROP TABLE "request_rollups";
+DROP TABLE "rescore_checkpoints";
+DROP TABLE "reclassify_queue";
+DROP TABLE "request_flags";
+DROP TABLE "flag_sets";
+DROP TABLE "endpoint_actors";
+DROP TABLE "endpoint_stats";
 DROP TABLE "analysed_requests";
 DROP TABLE "analysed_actors";
 DROP TABLE "requests";
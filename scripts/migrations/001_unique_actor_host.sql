@@ -0,0 +1,23 @@
+-- Merges duplicate actors onto the lowest actor_id for their host, then enforces one actor per host.
+UPDATE "requests"
+SET "actor_id" = "keep"."actor_id"
+FROM "actors" AS "duplicate"
+         JOIN (SELECT "host", MIN("actor_id") AS "actor_id" FROM "actors" GROUP BY "host") AS "keep"
+              ON "keep"."host" = "duplicate"."host"
+WHERE "requests"."actor_id" = "duplicate"."actor_id"
+  AND "duplicate"."actor_id" <> "keep"."actor_id";
+
+UPDATE "analysed_actors"
+SET "actor_id" = "keep"."actor_id"
+FROM "actors" AS "duplicate"
+         JOIN (SELECT "host", MIN("actor_id") AS "actor_id" FROM "actors" GROUP BY "host") AS "keep"
+              ON "keep"."host" = "duplicate"."host"
+WHERE "analysed_actors"."actor_id" = "duplicate"."actor_id"
+  AND "duplicate"."actor_id" <> "keep"."actor_id";
+
+DELETE
+FROM "actors"
+WHERE "actor_id" NOT IN (SELECT MIN("actor_id") FROM "actors" GROUP BY "host");
+
+ALTER TABLE "actors"
+    ADD CONSTRAINT "actors_host_key" UNIQUE ("host");
@@ -0,0 +1,23 @@
+-- Per-endpoint statistics maintained on ingestion. Populate existing data afterwards with
+-- DatabaseHandler.backfill_endpoint_stats (db_util.backfill_endpoint_stats).
+CREATE TABLE IF NOT EXISTS "endpoint_stats"
+(
+    "path"             VARCHAR(255) PRIMARY KEY,
+    "hits"             BIGINT       NOT NULL DEFAULT 0,
+    "distinct_actors"  INTEGER      NOT NULL DEFAULT 0,
+    "first_seen"       TIMESTAMP    NOT NULL,
+    "last_seen"        TIMESTAMP    NOT NULL,
+    "max_threat_level" INTEGER      NOT NULL DEFAULT 0,
+    "last_method"      VARCHAR(255) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS "endpoint_stats_hits_idx" ON "endpoint_stats" ("hits" DESC, "path");
+CREATE INDEX IF NOT EXISTS "endpoint_stats_unique_last_seen_idx" ON "endpoint_stats" ("last_seen" DESC) WHERE "hits" = 1;
+
+CREATE TABLE IF NOT EXISTS "endpoint_actors"
+(
+    "path"     VARCHAR(255) NOT NULL,
+    "actor_id" INTEGER      NOT NULL,
+    PRIMARY KEY ("path", "actor_id"),
+    FOREIGN KEY ("actor_id") REFERENCES "actors" ("actor_id")
+);
@@ -0,0 +1,3 @@
+-- Supports the grouped host listings (get_remote_hosts, get_hosts_by_endpoint), which aggregate requests per actor.
+CREATE INDEX IF NOT EXISTS "requests_actor_id_idx" ON "requests" ("actor_id") INCLUDE ("acceptable", "threat_level");
+CREATE INDEX IF NOT EXISTS "requests_path_actor_id_idx" ON "requests" ("path", "actor_id");
@@ -0,0 +1,4 @@
+-- Supports keyset pagination of get_requests and search, which order by (timestamp, request_id).
+CREATE INDEX IF NOT EXISTS "requests_timestamp_idx" ON "requests" ("timestamp", "request_id");
+CREATE INDEX IF NOT EXISTS "requests_actor_timestamp_idx" ON "requests" ("actor_id", "timestamp", "request_id");
+CREATE INDEX IF NOT EXISTS "requests_path_timestamp_idx" ON "requests" ("path", "timestamp", "request_id");
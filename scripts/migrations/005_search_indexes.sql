@@ -0,0 +1,12 @@
+-- Indexes for DatabaseHandler.search. The trigram indexes serve its LIKE/ILIKE '%term%' predicates, and the tsvector
+-- indexes serve its full_text mode.
+CREATE EXTENSION IF NOT EXISTS "pg_trgm";
+
+CREATE INDEX IF NOT EXISTS "requests_path_trgm_idx" ON "requests" USING GIN ("path" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_query_string_trgm_idx" ON "requests" USING GIN ("query_string" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_headers_trgm_idx" ON "requests" USING GIN ("headers" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_body_trgm_idx" ON "requests" USING GIN ("body" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "actors_host_trgm_idx" ON "actors" USING GIN ("host" gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS "requests_headers_tsv_idx" ON "requests" USING GIN (to_tsvector('simple', "headers"));
+CREATE INDEX IF NOT EXISTS "requests_body_tsv_idx" ON "requests" USING GIN (to_tsvector('simple', "body"));
@@ -0,0 +1,15 @@
+-- Stores request headers and bodies as JSONB, so they are returned decoded and can be queried by key and containment.
+-- The search indexes from 005 are rebuilt over the new column types.
+DROP INDEX IF EXISTS "requests_headers_trgm_idx", "requests_body_trgm_idx", "requests_headers_tsv_idx",
+    "requests_body_tsv_idx";
+
+ALTER TABLE "requests"
+    ALTER COLUMN "headers" TYPE JSONB USING "headers"::JSONB,
+    ALTER COLUMN "body" TYPE JSONB USING "body"::JSONB;
+
+CREATE INDEX IF NOT EXISTS "requests_headers_idx" ON "requests" USING GIN ("headers");
+CREATE INDEX IF NOT EXISTS "requests_body_idx" ON "requests" USING GIN ("body");
+CREATE INDEX IF NOT EXISTS "requests_headers_trgm_idx" ON "requests" USING GIN (("headers"::TEXT) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_body_trgm_idx" ON "requests" USING GIN (("body"::TEXT) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_headers_tsv_idx" ON "requests" USING GIN (to_tsvector('simple', "headers"));
+CREATE INDEX IF NOT EXISTS "requests_body_tsv_idx" ON "requests" USING GIN (to_tsvector('simple', "body"));
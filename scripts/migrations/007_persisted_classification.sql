@@ -0,0 +1,33 @@
+-- Stores each request's classification with the flag set that produced it, and the flags it matched, so that a change
+-- to static/flags.json only rescores the requests it affects. Existing requests are left with a NULL flags_version and
+-- are classified by the background Reclassifier.
+ALTER TABLE "requests"
+    ADD COLUMN IF NOT EXISTS "request_types" TEXT[] NOT NULL DEFAULT '{}',
+    ADD COLUMN IF NOT EXISTS "attack_types"  TEXT[] NOT NULL DEFAULT '{}',
+    ADD COLUMN IF NOT EXISTS "flags_version" VARCHAR(64);
+
+CREATE INDEX IF NOT EXISTS "requests_unclassified_idx" ON "requests" ("request_id") WHERE "flags_version" IS NULL;
+
+CREATE TABLE IF NOT EXISTS "flag_sets"
+(
+    "version"      VARCHAR(64) PRIMARY KEY,
+    "flags"        JSONB       NOT NULL,
+    "created"      TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "reclassified" TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS "request_flags"
+(
+    "kind"       VARCHAR(16) NOT NULL,
+    "flag"       TEXT        NOT NULL,
+    "request_id" INTEGER     NOT NULL,
+    PRIMARY KEY ("kind", "flag", "request_id"),
+    FOREIGN KEY ("request_id") REFERENCES "requests" ("request_id") ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS "request_flags_request_id_idx" ON "request_flags" ("request_id");
+
+CREATE TABLE IF NOT EXISTS "reclassify_queue"
+(
+    "request_id" INTEGER PRIMARY KEY
+);
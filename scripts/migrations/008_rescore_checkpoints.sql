@@ -0,0 +1,7 @@
+-- Records how far a bulk rescore with each flag set has got, so that an interrupted run resumes where it stopped.
+CREATE TABLE IF NOT EXISTS "rescore_checkpoints"
+(
+    "flags_version"   VARCHAR(64) PRIMARY KEY,
+    "last_request_id" INTEGER     NOT NULL,
+    "updated"         TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
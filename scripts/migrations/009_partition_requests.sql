@@ -0,0 +1,98 @@
+-- Range-partitions requests by month of "timestamp". The existing table is copied into monthly partitions named
+-- requests_YYYY_MM, covering its oldest row to three months ahead, and then dropped. DatabaseHandler creates further
+-- partitions as time passes, and can roll old ones up into request_rollups before dropping them.
+-- Primary keys on a partitioned table must include the partition key, so request_id alone is no longer unique and the
+-- foreign keys from request_flags and analysed_requests are dropped; request_id is still drawn from the same sequence.
+BEGIN;
+
+ALTER TABLE "request_flags" DROP CONSTRAINT IF EXISTS "request_flags_request_id_fkey";
+ALTER TABLE "analysed_requests" DROP CONSTRAINT IF EXISTS "analysed_requests_request_id_fkey";
+
+ALTER TABLE "requests" RENAME TO "requests_unpartitioned";
+ALTER TABLE "requests_unpartitioned" DROP CONSTRAINT "requests_pkey";
+DROP INDEX IF EXISTS "requests_actor_id_idx", "requests_path_actor_id_idx", "requests_timestamp_idx",
+    "requests_actor_timestamp_idx", "requests_path_timestamp_idx", "requests_path_trgm_idx",
+    "requests_query_string_trgm_idx", "requests_headers_idx", "requests_body_idx", "requests_headers_trgm_idx",
+    "requests_body_trgm_idx", "requests_headers_tsv_idx", "requests_body_tsv_idx", "requests_unclassified_idx";
+
+CREATE TABLE "requests"
+(
+    "request_id"    INTEGER      NOT NULL DEFAULT nextval('requests_request_id_seq'),
+    "actor_id"      INTEGER      NOT NULL,
+    "timestamp"     TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "method"        VARCHAR(255) NOT NULL,
+    "path"          VARCHAR(255) NOT NULL,
+    "body"          JSONB,
+    "headers"       JSONB,
+    "query_string"  TEXT,
+    "port"          INTEGER      NOT NULL,
+    "acceptable"    BOOLEAN      NOT NULL,
+    "threat_level"  INTEGER      NOT NULL DEFAULT 0,
+    "request_types" TEXT[]       NOT NULL DEFAULT '{}',
+    "attack_types"  TEXT[]       NOT NULL DEFAULT '{}',
+    "flags_version" VARCHAR(64),
+    PRIMARY KEY ("request_id", "timestamp"),
+    FOREIGN KEY ("actor_id") REFERENCES "actors" ("actor_id")
+) PARTITION BY RANGE ("timestamp");
+
+ALTER SEQUENCE "requests_request_id_seq" OWNED BY "requests"."request_id";
+
+CREATE TABLE "requests_default" PARTITION OF "requests" DEFAULT;
+
+DO
+$$
+    DECLARE
+        month TIMESTAMP := date_trunc('month', COALESCE((SELECT MIN("timestamp") FROM "requests_unpartitioned"),
+                                                        CURRENT_TIMESTAMP));
+    BEGIN
+        WHILE month < date_trunc('month', CURRENT_TIMESTAMP) + INTERVAL '3 months'
+            LOOP
+                EXECUTE format('CREATE TABLE %I PARTITION OF "requests" FOR VALUES FROM (%L) TO (%L)',
+                               'requests_' || to_char(month, 'YYYY_MM'), month, month + INTERVAL '1 month');
+                month := month + INTERVAL '1 month';
+            END LOOP;
+    END
+$$;
+
+INSERT INTO "requests" ("request_id", "actor_id", "timestamp", "method", "path", "body", "headers", "query_string",
+                        "port", "acceptable", "threat_level", "request_types", "attack_types", "flags_version")
+SELECT "request_id", "actor_id", "timestamp", "method", "path", "body", "headers", "query_string", "port",
+       "acceptable", "threat_level", "request_types", "attack_types", "flags_version"
+FROM "requests_unpartitioned";
+
+DROP TABLE "requests_unpartitioned";
+
+CREATE INDEX "requests_actor_id_idx" ON "requests" ("actor_id") INCLUDE ("acceptable", "threat_level");
+CREATE INDEX "requests_path_actor_id_idx" ON "requests" ("path", "actor_id");
+CREATE INDEX "requests_timestamp_idx" ON "requests" ("timestamp", "request_id");
+CREATE INDEX "requests_actor_timestamp_idx" ON "requests" ("actor_id", "timestamp", "request_id");
+CREATE INDEX "requests_path_timestamp_idx" ON "requests" ("path", "timestamp", "request_id");
+CREATE INDEX "requests_headers_idx" ON "requests" USING GIN ("headers");
+CREATE INDEX "requests_body_idx" ON "requests" USING GIN ("body");
+CREATE INDEX "requests_headers_tsv_idx" ON "requests" USING GIN (to_tsvector('simple', "headers"));
+CREATE INDEX "requests_body_tsv_idx" ON "requests" USING GIN (to_tsvector('simple', "body"));
+CREATE INDEX "requests_unclassified_idx" ON "requests" ("request_id") WHERE "flags_version" IS NULL;
+
+CREATE TABLE IF NOT EXISTS "request_rollups"
+(
+    "hour"             TIMESTAMP    NOT NULL,
+    "path"             VARCHAR(255) NOT NULL,
+    "actor_id"         INTEGER      NOT NULL,
+    "hits"             INTEGER      NOT NULL,
+    "acceptable"       INTEGER      NOT NULL,
+    "threat_level_sum" BIGINT       NOT NULL,
+    "max_threat_level" INTEGER      NOT NULL,
+    PRIMARY KEY ("hour", "path", "actor_id"),
+    FOREIGN KEY ("actor_id") REFERENCES "actors" ("actor_id")
+);
+
+CREATE INDEX IF NOT EXISTS "request_rollups_actor_id_idx" ON "request_rollups" ("actor_id");
+CREATE INDEX IF NOT EXISTS "request_rollups_path_actor_id_idx" ON "request_rollups" ("path", "actor_id");
+
+COMMIT;
+
+-- rebuilt outside the transaction, so that a server without pg_trgm is still migrated
+CREATE INDEX IF NOT EXISTS "requests_path_trgm_idx" ON "requests" USING GIN ("path" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_query_string_trgm_idx" ON "requests" USING GIN ("query_string" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_headers_trgm_idx" ON "requests" USING GIN (("headers"::TEXT) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_body_trgm_idx" ON "requests" USING GIN (("body"::TEXT) gin_trgm_ops);
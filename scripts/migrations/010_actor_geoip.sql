@@ -0,0 +1,5 @@
+-- Country and autonomous system of each actor, looked up once when the actor is created. NULL when unknown.
+ALTER TABLE "actors"
+    ADD COLUMN IF NOT EXISTS "country"         CHAR(2),
+    ADD COLUMN IF NOT EXISTS "asn"             BIGINT,
+    ADD COLUMN IF NOT EXISTS "as_organisation" VARCHAR(255);
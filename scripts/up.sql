@@ -1,24 +1,121 @@
+CREATE EXTENSION IF NOT EXISTS "pg_trgm";
+
 CREATE TABLE IF NOT EXISTS "actors"
 (
-    "actor_id"     SERIAL PRIMARY KEY,
-    "host"         VARCHAR(255) NOT NULL,
-    "flagged"      BOOLEAN      NOT NULL DEFAULT FALSE,
-    "threat_level" INTEGER      NOT NULL DEFAULT 0
+    "actor_id"        SERIAL PRIMARY KEY,
+    "host"            VARCHAR(255) NOT NULL UNIQUE,
+    "flagged"         BOOLEAN      NOT NULL DEFAULT FALSE,
+    "threat_level"    INTEGER      NOT NULL DEFAULT 0,
+    "country"         CHAR(2),
+    "asn"             BIGINT,
+    "as_organisation" VARCHAR(255)
 );
 
+CREATE INDEX IF NOT EXISTS "actors_host_trgm_idx" ON "actors" USING GIN ("host" gin_trgm_ops);
+
+-- partitioned by month; DatabaseHandler.create_request_partitions adds requests_YYYY_MM partitions ahead of time
 CREATE TABLE IF NOT EXISTS "requests"
 (
-    "request_id"   SERIAL PRIMARY KEY,
-    "actor_id"     INTEGER      NOT NULL,
-    "timestamp"    TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP,
-    "method"       VARCHAR(255) NOT NULL,
-    "path"         VARCHAR(255) NOT NULL,
-    "body"         TEXT,
-    "headers"      TEXT,
-    "query_string" TEXT,
-    "port"         INTEGER      NOT NULL,
-    "acceptable"   BOOLEAN      NOT NULL,
-    "threat_level" INTEGER      NOT NULL DEFAULT 0,
+    "request_id"    SERIAL,
+    "actor_id"      INTEGER      NOT NULL,
+    "timestamp"     TIMESTAMP    NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "method"        VARCHAR(255) NOT NULL,
+    "path"          VARCHAR(255) NOT NULL,
+    "body"          JSONB,
+    "headers"       JSONB,
+    "query_string"  TEXT,
+    "port"          INTEGER      NOT NULL,
+    "acceptable"    BOOLEAN      NOT NULL,
+    "threat_level"  INTEGER      NOT NULL DEFAULT 0,
+    "request_types" TEXT[]       NOT NULL DEFAULT '{}',
+    "attack_types"  TEXT[]       NOT NULL DEFAULT '{}',
+    "flags_version" VARCHAR(64),
+    PRIMARY KEY ("request_id", "timestamp"),
+    FOREIGN KEY ("actor_id") REFERENCES "actors" ("actor_id")
+) PARTITION BY RANGE ("timestamp");
+
+CREATE TABLE IF NOT EXISTS "requests_default" PARTITION OF "requests" DEFAULT;
+
+CREATE INDEX IF NOT EXISTS "requests_actor_id_idx" ON "requests" ("actor_id") INCLUDE ("acceptable", "threat_level");
+CREATE INDEX IF NOT EXISTS "requests_path_actor_id_idx" ON "requests" ("path", "actor_id");
+CREATE INDEX IF NOT EXISTS "requests_timestamp_idx" ON "requests" ("timestamp", "request_id");
+CREATE INDEX IF NOT EXISTS "requests_actor_timestamp_idx" ON "requests" ("actor_id", "timestamp", "request_id");
+CREATE INDEX IF NOT EXISTS "requests_path_timestamp_idx" ON "requests" ("path", "timestamp", "request_id");
+CREATE INDEX IF NOT EXISTS "requests_path_trgm_idx" ON "requests" USING GIN ("path" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_query_string_trgm_idx" ON "requests" USING GIN ("query_string" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_headers_idx" ON "requests" USING GIN ("headers");
+CREATE INDEX IF NOT EXISTS "requests_body_idx" ON "requests" USING GIN ("body");
+CREATE INDEX IF NOT EXISTS "requests_headers_trgm_idx" ON "requests" USING GIN (("headers"::TEXT) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_body_trgm_idx" ON "requests" USING GIN (("body"::TEXT) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS "requests_headers_tsv_idx" ON "requests" USING GIN (to_tsvector('simple', "headers"));
+CREATE INDEX IF NOT EXISTS "requests_body_tsv_idx" ON "requests" USING GIN (to_tsvector('simple', "body"));
+CREATE INDEX IF NOT EXISTS "requests_unclassified_idx" ON "requests" ("request_id") WHERE "flags_version" IS NULL;
+
+CREATE TABLE IF NOT EXISTS "flag_sets"
+(
+    "version"      VARCHAR(64) PRIMARY KEY,
+    "flags"        JSONB       NOT NULL,
+    "created"      TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "reclassified" TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS "request_flags"
+(
+    "kind"       VARCHAR(16) NOT NULL,
+    "flag"       TEXT        NOT NULL,
+    "request_id" INTEGER     NOT NULL,
+    PRIMARY KEY ("kind", "flag", "request_id")
+);
+
+CREATE INDEX IF NOT EXISTS "request_flags_request_id_idx" ON "request_flags" ("request_id");
+
+CREATE TABLE IF NOT EXISTS "reclassify_queue"
+(
+    "request_id" INTEGER PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS "rescore_checkpoints"
+(
+    "flags_version"   VARCHAR(64) PRIMARY KEY,
+    "last_request_id" INTEGER     NOT NULL,
+    "updated"         TIMESTAMP   NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS "request_rollups"
+(
+    "hour"             TIMESTAMP    NOT NULL,
+    "path"             VARCHAR(255) NOT NULL,
+    "actor_id"         INTEGER      NOT NULL,
+    "hits"             INTEGER      NOT NULL,
+    "acceptable"       INTEGER      NOT NULL,
+    "threat_level_sum" BIGINT       NOT NULL,
+    "max_threat_level" INTEGER      NOT NULL,
+    PRIMARY KEY ("hour", "path", "actor_id"),
+    FOREIGN KEY ("actor_id") REFERENCES "actors" ("actor_id")
+);
+
+CREATE INDEX IF NOT EXISTS "request_rollups_actor_id_idx" ON "request_rollups" ("actor_id");
+CREATE INDEX IF NOT EXISTS "request_rollups_path_actor_id_idx" ON "request_rollups" ("path", "actor_id");
+
+CREATE TABLE IF NOT EXISTS "endpoint_stats"
+(
+    "path"             VARCHAR(255) PRIMARY KEY,
+    "hits"             BIGINT       NOT NULL DEFAULT 0,
+    "distinct_actors"  INTEGER      NOT NULL DEFAULT 0,
+    "first_seen"       TIMESTAMP    NOT NULL,
+    "last_seen"        TIMESTAMP    NOT NULL,
+    "max_threat_level" INTEGER      NOT NULL DEFAULT 0,
+    "last_method"      VARCHAR(255) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS "endpoint_stats_hits_idx" ON "endpoint_stats" ("hits" DESC, "path");
+CREATE INDEX IF NOT EXISTS "endpoint_stats_unique_last_seen_idx" ON "endpoint_stats" ("last_seen" DESC) WHERE "hits" = 1;
+
+CREATE TABLE IF NOT EXISTS "endpoint_actors"
+(
+    "path"     VARCHAR(255) NOT NULL,
+    "actor_id" INTEGER      NOT NULL,
+    PRIMARY KEY ("path", "actor_id"),
     FOREIGN KEY ("actor_id") REFERENCES "actors" ("actor_id")
 );
 
@@ -34,8 +131,7 @@ CREATE TABLE IF NOT EXISTS "analysed_requests"
     "analysis_id" SERIAL PRIMARY KEY,
     "request_id"  INTEGER NOT NULL,
     "analysis"    TEXT,
-    "notes"       TEXT,
-    FOREIGN KEY ("request_id") REFERENCES "requests" ("request_id")
+    "notes"       TEXT
 );
 
 CREATE TABLE IF NOT EXISTS "analysed_actors"